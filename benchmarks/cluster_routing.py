@@ -0,0 +1,249 @@
+# python -m benchmarks.cluster_routing
+# BACKPLANE=postgres BACKPLANE_URL=postgresql://... python -m benchmarks.cluster_routing
+# проверка кластера из нескольких узлов: каждый узел - отдельный процесс со своими Bus, Cluster и Cash,
+# шина - концентратор Unix-сокетов (по умолчанию) или Postgres. Клиенты подключаются к узлам напрямую
+# через реестр соединений, сценарий проверяет доставку комнатных кадров через владельца, список онлайн
+# и состав комнат на всех узлах, уход узла (штатный и по таймауту heartbeat) и вход нового узла
+import asyncio
+import itertools
+import json
+import os
+import signal
+import socket
+import sys
+import tempfile
+import uuid
+
+HEARTBEAT = 0.3
+SETTLE = 0.5
+ROOM = 0
+OTHER = 0
+
+
+class IdleSocket:
+    # только то, что реестр и писатель Outbox используют у соединения websockets
+    def __init__(self):
+        self.id = uuid.uuid4()
+        self.subprotocol = None
+        self.received = []
+
+    async def send(self, data):
+        self.received.append(json.loads(data)["#"]["text"])
+
+    async def close(self, code: int = 1000, reason: str = ""):
+        pass
+
+
+async def node(name: str):
+    # один узел кластера: команды построчно из stdin, ответы - строкой json в stdout
+    import core.backplane
+    from core.broadcast import room_broadcast
+    from core.bus import Bus
+    from core.cluster import Cluster
+    from core.io import output
+    from core.lifecycle import ConnectionManager
+    from core.managers import Token
+    from core.presence import PresenceIndex
+    from core.sessions import SessionStore
+    from core.user_cash import room_members
+
+    await Bus.start(core.backplane.configured(), name)
+    await Cluster.start()
+    sockets = {}
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    print(json.dumps(name), flush=True)
+    while line := await reader.readline():
+        command = json.loads(line)
+        op = command.pop("op")
+        reply = None
+        if op == "connect":
+            sockets[command["session"]] = socket_ = IdleSocket()
+            user = ConnectionManager.register(socket_)
+            user.ID = command["user"]
+            user.nickname = command["nickname"]
+            user.location_id = command["room"]
+            user.token = Token.generate(user.ID)
+            SessionStore.issue(user)
+        elif op == "disconnect":
+            ConnectionManager.unregister(sockets[command["session"]])
+        elif op == "say":
+            room_broadcast(command["room"], output("message", {"text": command["text"]}))
+        elif op == "state":
+            reply = {
+                "nodes": sorted(Cluster.nodes),
+                "presence": sorted(PresenceIndex.users),
+                "members": {room: sorted(member["user_id"] for member in room_members(room))
+                            for room in command["rooms"]},
+                "sessions": sorted({session.user_id for session in SessionStore.sessions.values()}),
+                "received": {session: socket_.received for session, socket_ in sockets.items()},
+                "owners": {room: Cluster.owner(room) for room in command["rooms"]},
+                "cluster": Cluster.snapshot(),
+            }
+        elif op == "leave":
+            break
+        await asyncio.sleep(0)
+        print(json.dumps(reply), flush=True)
+    await Cluster.stop()
+    await Bus.close()
+
+
+class Node:
+    def __init__(self, name: str, process: asyncio.subprocess.Process):
+        self.name = name
+        self.process = process
+
+    @classmethod
+    async def start(cls, name: str) -> "Node":
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "benchmarks.cluster_routing", name,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+        )
+        # узел готов, когда подключился к шине
+        await process.stdout.readline()
+        return cls(name, process)
+
+    async def call(self, op: str, **fields):
+        self.process.stdin.write(json.dumps({"op": op, **fields}).encode() + b"\n")
+        await self.process.stdin.drain()
+        return json.loads(await self.process.stdout.readline())
+
+    async def leave(self):
+        self.process.stdin.write(json.dumps({"op": "leave"}).encode() + b"\n")
+        await self.process.stdin.drain()
+        await self.process.wait()
+
+    async def kill(self):
+        self.process.send_signal(signal.SIGKILL)
+        await self.process.wait()
+
+
+failures = 0
+
+
+def check(title: str, actual, expected):
+    global failures
+    ok = actual == expected
+    failures += not ok
+    print(f"{'ok  ' if ok else 'FAIL'} {title}" + ("" if ok else f": {actual!r} != {expected!r}"))
+
+
+async def expect(title: str, nodes, field: str, expected):
+    for node_ in nodes:
+        state = await node_.call("state", rooms=[ROOM, OTHER])
+        check(f"{title} [{node_.name}]", state[field], expected)
+
+
+def members(room, other) -> dict:
+    return {str(ROOM): room, str(OTHER): other}
+
+
+async def received(*nodes) -> dict:
+    result = {}
+    for node_ in nodes:
+        result.update((await node_.call("state", rooms=[]))["received"])
+    return result
+
+
+async def scenario():
+    from core.backplane import Hub
+
+    hub = None
+    if os.environ["BACKPLANE"] == "unix":
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(os.environ["BUS_PATH"])
+        sock.listen()
+        await Hub.start(sock)
+        hub = Hub
+    a, b, c = [await Node.start(name) for name in "abc"]
+    await asyncio.sleep(SETTLE)
+    await expect("три узла в кластере", (a, b, c), "nodes", ["a", "b", "c"])
+    await expect("комнатой владеет c", (a, b, c), "owners", {str(ROOM): "c", str(OTHER): "a"})
+
+    # alice (1) подключена к a и b, bob (2) - к b в другой комнате, carol (3) - к c
+    await a.call("connect", session="alice@a", user=1, nickname="alice", room=ROOM)
+    await b.call("connect", session="alice@b", user=1, nickname="alice", room=ROOM)
+    await b.call("connect", session="bob@b", user=2, nickname="bob", room=OTHER)
+    await c.call("connect", session="carol@c", user=3, nickname="carol", room=ROOM)
+    await asyncio.sleep(SETTLE)
+    await expect("список онлайн", (a, b, c), "presence", [1, 2, 3])
+    await expect("состав комнат", (a, b, c), "members", members([1, 3], [2]))
+
+    await a.call("say", room=ROOM, text="hello")
+    await asyncio.sleep(SETTLE)
+    check("кадр комнаты дошел через владельца до участников на всех узлах и только до них",
+          await received(a, b, c), {"alice@a": ["hello"], "alice@b": ["hello"], "bob@b": [], "carol@c": ["hello"]})
+
+    # сессия alice на b остается: на остальных узлах она по-прежнему онлайн и в комнате
+    await a.call("disconnect", session="alice@a")
+    await asyncio.sleep(SETTLE)
+    await expect("alice ушла с a, но осталась на b", (a, b, c), "presence", [1, 2, 3])
+    await expect("состав комнат без изменений", (a, b, c), "members", members([1, 3], [2]))
+
+    # штатный уход владельца: комната переходит к оставшимся, состояние c вычищается
+    await a.call("connect", session="dave@a", user=4, nickname="dave", room=ROOM)
+    await c.leave()
+    await asyncio.sleep(SETTLE)
+    await expect("c ушел штатно", (a, b), "nodes", ["a", "b"])
+    await expect("комната перешла к b", (a, b), "owners", {str(ROOM): "b", str(OTHER): "a"})
+    await expect("пользователи c сняты", (a, b), "presence", [1, 2, 4])
+    await expect("участники c сняты", (a, b), "members", members([1, 4], [2]))
+    await a.call("say", room=ROOM, text="after leave")
+    await asyncio.sleep(SETTLE)
+    check("маршрут через нового владельца", await received(a, b),
+          {"alice@a": ["hello"], "alice@b": ["hello", "after leave"], "bob@b": [], "dave@a": ["after leave"]})
+
+    # b пропадает без прощания: его исключают по heartbeat
+    await b.kill()
+    await asyncio.sleep(4 * HEARTBEAT + SETTLE)
+    await expect("b исключен по таймауту", (a,), "nodes", ["a"])
+    await expect("комнаты у единственного узла", (a,), "owners", {str(ROOM): "a", str(OTHER): "a"})
+    await expect("пользователи b сняты", (a,), "presence", [4])
+    await expect("участники b сняты", (a,), "members", members([4], []))
+
+    # новичок получает состояние кластера, не дожидаясь изменений
+    d = await Node.start("d")
+    await asyncio.sleep(SETTLE)
+    await expect("d вошел", (a, d), "nodes", ["a", "d"])
+    await expect("d знает пользователей a", (d,), "presence", [4])
+    await expect("d знает участников комнат a", (d,), "members", members([4], []))
+    # у alice на a осталась сессия после отключения - по ней можно восстановиться и на d
+    await expect("d знает сессии a", (d,), "sessions", [1, 4])
+    await d.call("connect", session="erin@d", user=5, nickname="erin", room=ROOM)
+    await d.call("say", room=ROOM, text="from d")
+    await asyncio.sleep(SETTLE)
+    check("маршрут с нового узла", (await received(a))["dave@a"], ["after leave", "from d"])
+    for node_ in (a, d):
+        print(node_.name, (await node_.call("state", rooms=[]))["cluster"])
+        await node_.leave()
+    if hub is not None:
+        await hub.stop()
+
+
+def rooms():
+    # комната, которой владеет c, пока в кластере a, b и c, а без c - b; вторая - всегда у a
+    from core.cluster import HashRing
+
+    def owners(room):
+        return HashRing("abc").owner(room), HashRing("ab").owner(room), HashRing("ad").owner(room)
+    room = next(room for room in itertools.count(1) if owners(room)[:2] == ("c", "b"))
+    other = next(room for room in itertools.count(1) if owners(room) == ("a", "a", "a"))
+    return room, other
+
+
+def main():
+    if len(sys.argv) > 1:
+        asyncio.run(node(sys.argv[1]))
+        return
+    os.environ["HEARTBEAT_INTERVAL"] = str(HEARTBEAT)
+    os.environ.setdefault("BACKPLANE", "unix")
+    os.environ["BUS_PATH"] = os.path.join(tempfile.mkdtemp(), "bus.sock")
+    global ROOM, OTHER
+    ROOM, OTHER = rooms()
+    asyncio.run(scenario())
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+import asyncio
+import sys
+import time
+
+import websockets
+
+from core.lifecycle import ConnectionManager
+from core.user_cash import Cash
+from main import handler
+
+
+def registry_sizes():
+    return len(Cash.online), len(Cash.sessions), len(Cash.location)
+
+
+async def churn(total: int, batch: int):
+    async with websockets.serve(handler, "localhost", 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        url = f"ws://localhost:{port}"
+        baseline = registry_sizes()
+
+        start = time.perf_counter()
+        for _ in range(0, total, batch):
+            clients = await asyncio.gather(*(websockets.connect(url) for _ in range(batch)))
+            await asyncio.gather(*(c.recv() for c in clients))
+            # половина закрывается корректно, половина обрывается без close-фрейма
+            for c in clients[::2]:
+                c.transport.abort()
+            await asyncio.gather(*(c.close() for c in clients[1::2]))
+        elapsed = time.perf_counter() - start
+
+        for _ in range(50):
+            if registry_sizes() == baseline:
+                break
+            await asyncio.sleep(0.1)
+        after = registry_sizes()
+
+        cpu_start = time.process_time()
+        await asyncio.sleep(2)
+        idle_cpu = time.process_time() - cpu_start
+
+    print(f"соединений: {total}, время: {elapsed:.2f} с ({total / elapsed:,.0f} соединений/с)")
+    print(f"реестры (online, sessions, location): до {baseline}, после {after}")
+    print(f"открыто {ConnectionManager.opened}, закрыто {ConnectionManager.closed}")
+    print(f"CPU в простое после отключений: {idle_cpu:.3f} с за 2 с")
+    ok = after == baseline and ConnectionManager.opened == ConnectionManager.closed and idle_cpu < 0.2
+    print("OK" if ok else "FAIL")
+    return ok
+
+
+if __name__ == '__main__':
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    sys.exit(0 if asyncio.run(churn(total, batch=250)) else 1)
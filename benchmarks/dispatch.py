@@ -0,0 +1,44 @@
+import inspect
+import json
+import time
+
+from core.io import InputModel
+from events.dispatch import dispatcher
+from events.inputs import input_event_mapping
+
+FRAMES = [
+    json.dumps({"@": "send public", "#": {"text": "привет всем"}, "$": "token"}),
+    json.dumps({"@": "get one user", "#": {"user_id": 42}, "$": "token"}),
+    json.dumps({"@": "update permission", "#": {"user_id": 42, "local_rank": "moderator"}, "$": "token"}),
+    json.dumps({"@": "signin", "#": {"nickname": "user", "password": "password"}}),
+]
+
+
+def before(message: str):
+    data = InputModel.model_validate_json(message)
+    event = input_event_mapping.get(data.event)
+    model = inspect.signature(event.__init__).parameters['model'].annotation
+    return event, model(**data.payload)
+
+
+def after(message: str):
+    return dispatcher.decode(message)
+
+
+def measure(func, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for frame in FRAMES:
+            func(frame)
+    return rounds * len(FRAMES) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    rounds = 20000
+    measure(before, 1000)
+    measure(after, 1000)
+    old = measure(before, rounds)
+    new = measure(after, rounds)
+    print(f"inspect.signature + двойная валидация: {old:,.0f} кадров/с")
+    print(f"таблица диспетчеризации:               {new:,.0f} кадров/с")
+    print(f"ускорение: x{new / old:.1f}")
@@ -0,0 +1,121 @@
+import datetime
+import time
+
+from pydantic import BaseModel
+from pydantic_core import to_json
+
+from core.codecs import json_codec
+from core.io import output, Error
+from core.metrics import Metrics
+from events.exc import NonAuthorized, NotFoundError
+from events.outputs import Successfully, NewToken, OneUserInfo, OnlineUserListInfo, SystemMessage, RoomHistory
+from services.accounts.aliases import AccountAliases
+from services.accounts.models import AuthModelOut
+from services.messages.models import PublicMessageOut, PublicMessageHistoryOut, Author
+from services.rooms.aliases import RoomAliases, LocalRankAliases, LocalRanks
+
+AUTHOR = Author(user_id=123456, nickname="nickname", local_rank=LocalRanks.MODERATOR)
+CREATED_AT = datetime.datetime(2024, 1, 1, 12, 30, 15, 123456)
+MESSAGE = PublicMessageOut(text="привет всем, как дела?", creator=AUTHOR, created_at=CREATED_AT)
+PROFILE = {
+    AccountAliases.ID: 123456,
+    AccountAliases.nickname: "nickname",
+    AccountAliases.created_at: datetime.date(2024, 1, 1),
+    AccountAliases.location: {RoomAliases.ID: 1, RoomAliases.title: "главная"},
+    AccountAliases.status: "online",
+}
+ONLINE = [{AccountAliases.ID: i, AccountAliases.nickname: f"user{i}", RoomAliases.ID: 1} for i in range(50)]
+HISTORY = [
+    PublicMessageHistoryOut(text="сообщение", creator=AUTHOR, created_at=CREATED_AT, message_id=i).model_dump(by_alias=True)
+    for i in range(50)
+]
+DELTA = {"room_id": 1, "version": 7, "op": "join", "member": {
+    AccountAliases.ID: 1, AccountAliases.nickname: "nickname", LocalRankAliases.rank: LocalRanks.USER}}
+GREETING = output("успешное подключение").freeze()
+REQUEST_ID = 17
+
+
+def legacy_encode(data: dict) -> str:
+    # прежний Frame.encode: pydantic_core.to_json под Metrics.measure на каждый новый кадр
+    with Metrics.measure("serialization"):
+        return to_json(data).decode()
+
+
+def legacy_output(event: str, model=None, request_id=None) -> str:
+    # прежний BaseOutEvent: model_dump под Metrics.measure, затем кодирование всего кадра
+    with Metrics.measure("serialization"):
+        payload = model.model_dump(by_alias=True) if isinstance(model, BaseModel) else model
+    data = {"@": event}
+    if payload is not None:
+        data["#"] = payload
+    if request_id is not None:
+        data["&"] = request_id
+    return legacy_encode(data)
+
+
+def legacy_error(error: str, payload=None, request_id=None) -> str:
+    # прежний InternalError: модель Error на каждое исключение
+    model = Error(error=error, payload=payload)
+    if request_id is None:
+        return legacy_encode(model.model_dump(by_alias=True, exclude={"request_id"}))
+    return legacy_encode(model.model_copy(update={"request_id": request_id}).model_dump(by_alias=True))
+
+
+# тип события -> (прежний путь, текущий путь): оба строят кадр и возвращают его json
+CASES = {
+    "greeting": (
+        lambda: legacy_encode({"@": "успешное подключение", "#": None, "$": None}),
+        lambda: GREETING.encode(json_codec),
+    ),
+    "success": (
+        lambda: legacy_output("success", "ник изменен", REQUEST_ID),
+        lambda: Successfully().frame("ник изменен", request_id=REQUEST_ID).encode(json_codec),
+    ),
+    "new_token": (
+        lambda: legacy_output("new_token", AuthModelOut(token="0" * 32), REQUEST_ID),
+        lambda: NewToken().frame(AuthModelOut(token="0" * 32), request_id=REQUEST_ID).encode(json_codec),
+    ),
+    "user_info": (
+        lambda: legacy_output("user_info", PROFILE, REQUEST_ID),
+        lambda: OneUserInfo().frame(PROFILE, request_id=REQUEST_ID).encode(json_codec),
+    ),
+    "online_list (50)": (
+        lambda: legacy_output("online_list", ONLINE, REQUEST_ID),
+        lambda: OnlineUserListInfo().frame(ONLINE, request_id=REQUEST_ID).encode(json_codec),
+    ),
+    "system": (
+        lambda: legacy_output("system", MESSAGE),
+        lambda: SystemMessage().frame(MESSAGE).encode(json_codec),
+    ),
+    "room history (50)": (
+        lambda: legacy_output("room history", HISTORY, REQUEST_ID),
+        lambda: RoomHistory().frame(HISTORY, request_id=REQUEST_ID).encode(json_codec),
+    ),
+    "presence delta": (
+        lambda: legacy_encode({"@": "presence delta", "#": DELTA, "$": None}),
+        lambda: output("presence delta", DELTA).encode(json_codec),
+    ),
+    "error non authorized": (
+        lambda: legacy_error("вы не авторизованы", None, REQUEST_ID),
+        lambda: NonAuthorized()(REQUEST_ID).encode(json_codec),
+    ),
+    "error not found": (
+        lambda: legacy_error("не найдено", "пользователь не найден", REQUEST_ID),
+        lambda: NotFoundError("пользователь не найден")(REQUEST_ID).encode(json_codec),
+    ),
+}
+
+
+def cost(func, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+if __name__ == '__main__':
+    rounds = 20000
+    print(f"{'событие':22} {'было, мкс':>10} {'стало, мкс':>11}")
+    for name, (legacy, current) in CASES.items():
+        assert legacy() == current(), name  # кадры на проводе не меняются
+        print(f"{name:22} {cost(legacy, rounds):10.2f} {cost(current, rounds):11.2f}")
@@ -0,0 +1,76 @@
+# python -m benchmarks.read_routing
+# стенд из двух баз sqlite: основная и "реплика" - копия основной, снятая до записи (реплика с отставанием).
+# показывает, куда уходят чтения: собственная запись пользователя видна ему сразу (из любого его соединения),
+# остальным - после репликации
+import asyncio
+import os
+import shutil
+import tempfile
+import uuid
+
+directory = tempfile.mkdtemp()
+PRIMARY = os.path.join(directory, "primary.db")
+REPLICA = os.path.join(directory, "replica.db")
+os.environ["PG_URL"] = f"sqlite+aiosqlite:///{PRIMARY}"
+os.environ["PG_REPLICA_URLS"] = f"sqlite+aiosqlite:///{REPLICA}"
+
+from sqlalchemy import insert, select  # noqa: E402
+
+import core.database  # noqa: E402
+from core.database import unit_of_work, ReadRouting  # noqa: E402
+from core.io import request_context  # noqa: E402
+from core.lifecycle import ConnectionManager  # noqa: E402
+from core.schemas import accounts  # noqa: E402
+from services.accounts.aliases import AccountAliases  # noqa: E402
+
+WRITER = 1
+READER = 2
+
+
+class IdleSocket:
+    # только то, что реестр читает у соединения websockets
+    def __init__(self):
+        self.id = uuid.uuid4()
+        self.subprotocol = None
+
+
+async def find(nickname: str):
+    async with unit_of_work(read_only=True) as db:
+        cursor = await db.execute(select(accounts.c[AccountAliases.ID]).where(accounts.c[AccountAliases.nickname] == nickname))
+        return cursor.scalar()
+
+
+def connect(user_id: int) -> IdleSocket:
+    socket = IdleSocket()
+    ConnectionManager.register(socket).ID = user_id
+    return socket
+
+
+async def as_connection(socket: IdleSocket, coroutine):
+    # как main.execute: команда выполняется в своей задаче со своим request_context
+    async def run():
+        request_context.set((id(socket), None))
+        return await coroutine
+    return await asyncio.create_task(run())
+
+
+async def main():
+    await core.database.init()
+    await core.database.dispose()
+    shutil.copyfile(PRIMARY, REPLICA)
+
+    async def signup():
+        async with unit_of_work() as db:
+            await db.execute(insert(accounts).values({AccountAliases.nickname: "fresh", AccountAliases.password: "-"}))
+        return await find("fresh")
+
+    print("запись и чтение тем же соединением:", await as_connection(connect(WRITER), signup()))
+    print("другое соединение того же пользователя:", await as_connection(connect(WRITER), find("fresh")))
+    print("другой пользователь (реплика отстает):", await as_connection(connect(READER), find("fresh")))
+    print(ReadRouting.snapshot())
+    await core.database.dispose()
+    shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,55 @@
+# PG_URL=sqlite+aiosqlite:////tmp/storm.db python -m benchmarks.reconnect_storm [пользователей]
+import asyncio
+import json
+import sys
+import time
+import uuid
+
+import websockets
+
+import core.database
+from core.managers import PasswordService
+from main import handler
+
+PORT = 8022
+
+
+async def request(command: str, payload: dict) -> str:
+    async with websockets.connect(f"ws://localhost:{PORT}") as ws:
+        await ws.recv()
+        await ws.send(json.dumps({"@": command, "#": payload}))
+        while True:
+            answer = json.loads(await ws.recv())
+            if "!" in answer:
+                raise RuntimeError(answer)
+            if answer["@"] == "new_token":
+                return answer["#"]["token"]
+
+
+async def storm(command: str, payloads: list) -> tuple:
+    # все клиенты переподключаются одновременно, как после перезагрузки балансировщика
+    start = time.perf_counter()
+    tokens = await asyncio.gather(*(request(command, payload) for payload in payloads))
+    return tokens, time.perf_counter() - start
+
+
+async def main(users: int):
+    await core.database.init()
+    PasswordService.start()
+    prefix = uuid.uuid4().hex[:6]
+    credentials = [{"nickname": f"{prefix}{i}", "password": "password"} for i in range(users)]
+    try:
+        async with websockets.serve(handler, "localhost", PORT):
+            await storm("signup", credentials)
+            tokens, signin = await storm("signin", credentials)
+            _, resume = await storm("resume", [{"token": token} for token in tokens])
+    finally:
+        PasswordService.stop()
+    print(f"{users} клиентов переподключаются одновременно")
+    print(f"signin (bcrypt): {signin:6.2f} с, {users / signin:8.1f} клиентов/с")
+    print(f"resume:          {resume:6.2f} с, {users / resume:8.1f} клиентов/с")
+    print(f"ускорение: x{signin / resume:.0f}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100))
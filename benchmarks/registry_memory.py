@@ -0,0 +1,201 @@
+# python -m benchmarks.registry_memory [соединений ...]
+# память реестра на одно простаивающее авторизованное соединение (tracemalloc): прежняя модель - ключи UUID,
+# Cash.ids с одной сессией на пользователя, очередь Outbox и семафор Pipeline у каждого соединения - против
+# текущей. Прежняя модель скопирована сюда без логики, которая не влияет на память простаивающего соединения
+import asyncio
+import gc
+import sys
+import time
+import tracemalloc
+import uuid
+from bisect import insort
+from collections import deque
+from typing import Dict, List, Optional, Set, Tuple
+
+from core.codecs import Codec, json_codec
+from core.config import MAX_IN_FLIGHT, OUTBOX_SIZE, OUTBOX_POLICY
+from core.lifecycle import ConnectionManager
+from core.outbox import OverflowPolicy
+from core.presence import PresenceFeed
+from services.accounts.aliases import AccountAliases
+from services.rooms.aliases import LocalRanks, LocalRankAliases
+
+ROOMS = 100
+
+
+class IdleSocket:
+    # только то, что реестр читает у соединения websockets
+    def __init__(self):
+        self.id = uuid.uuid4()
+        self.subprotocol = None
+
+
+class BaselineOutbox:
+    __slots__ = ["socket", "codec", "size", "policy", "queue", "task", "closed", "sent", "dropped", "coalesced",
+                 "max_depth"]
+
+    def __init__(self, socket, codec: Codec = json_codec):
+        self.socket = socket
+        self.codec = codec
+        self.size = OUTBOX_SIZE
+        self.policy = OverflowPolicy(OUTBOX_POLICY)
+        self.queue = deque()  # очередь заводилась сразу, а не на первый кадр
+        self.task = None
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+
+
+class BaselinePipeline:
+    __slots__ = ["semaphore", "tail", "tasks"]
+
+    def __init__(self, limit: int = MAX_IN_FLIGHT):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.tail = None
+        self.tasks = set()
+
+
+class BaselinePresenceIndex:
+    everyone: List[Tuple[str, int]] = []
+    rooms: Dict[int, List[Tuple[str, int]]] = {}
+    users: Dict[int, Tuple[str, str, Optional[int]]] = {}
+
+    @classmethod
+    def update(cls, user_id: int, nickname: str, room_id: Optional[int]):
+        current = cls.users.get(user_id)
+        if current is not None and current[1] == nickname and current[2] == room_id:
+            return
+        cls.remove(user_id)
+        entry = (nickname.casefold(), user_id)  # ключ - всегда отдельная строка
+        insort(cls.everyone, entry)
+        if room_id is not None:
+            insort(cls.rooms.setdefault(room_id, []), entry)
+        cls.users[user_id] = (entry[0], nickname, room_id)
+
+    @classmethod
+    def remove(cls, user_id: int):
+        current = cls.users.pop(user_id, None)
+        if current is None:
+            return
+        entry = (current[0], user_id)
+        cls.everyone.remove(entry)
+        if current[2] is not None:
+            cls.rooms[current[2]].remove(entry)
+
+
+class BaselineUser:
+    __slots__ = ["socket", "codec", "outbox", "pipeline", "connected_at", "last_seen", "subscribed", "token",
+                 "__ID", "__nickname", "local_rank", "__location_id"]
+
+    def __init__(self, socket, codec: Codec = json_codec):
+        self.__location_id = None
+        self.local_rank = None
+        self.__nickname = None
+        self.__ID = None
+        self.token = None
+        self.socket = socket
+        self.codec = codec
+        self.outbox = BaselineOutbox(socket, codec)
+        self.pipeline = BaselinePipeline()
+        self.connected_at = time.monotonic()
+        self.last_seen = self.connected_at
+        self.subscribed = False
+
+    @property
+    def ID(self):
+        return self.__ID
+
+    @ID.setter
+    def ID(self, value):
+        self.__ID = value
+        BaselineCash.ids[value] = self.socket.id
+        self.__update_presence()
+
+    @property
+    def nickname(self):
+        return self.__nickname
+
+    @nickname.setter
+    def nickname(self, value):
+        self.__nickname = value  # без sys.intern
+        self.__update_presence()
+
+    @property
+    def location_id(self):
+        return self.__location_id
+
+    @location_id.setter
+    def location_id(self, value):
+        BaselineCash.location.setdefault(value, set()).add(self.socket.id)
+        self.__location_id = value
+        self.__update_presence()
+        PresenceFeed.apply(value, PresenceFeed.JOIN, {
+            AccountAliases.ID: self.__ID,
+            AccountAliases.nickname: self.__nickname,
+            LocalRankAliases.rank: self.local_rank
+        })
+
+    def __update_presence(self):
+        if self.__ID is not None and self.__nickname is not None:
+            BaselinePresenceIndex.update(self.__ID, self.__nickname, self.__location_id)
+
+
+class BaselineCash:
+    online: Dict[uuid.UUID, BaselineUser] = {}
+    ids: Dict[int, uuid.UUID] = {}
+    location: Dict[int, Set[uuid.UUID]] = {}
+
+    @classmethod
+    def register(cls, socket: IdleSocket) -> BaselineUser:
+        user = cls.online[socket.id] = BaselineUser(socket)
+        return user
+
+    @classmethod
+    def clear(cls):
+        cls.online.clear()
+        cls.ids.clear()
+        cls.location.clear()
+        BaselinePresenceIndex.everyone.clear()
+        BaselinePresenceIndex.rooms.clear()
+        BaselinePresenceIndex.users.clear()
+
+
+def fill(register, sockets: List[IdleSocket]):
+    for i, socket in enumerate(sockets):
+        user = register(socket)
+        user.ID = i + 1
+        user.nickname = "".join(["user", str(i)])  # как после разбора кадра: новая строка на каждое соединение
+        user.local_rank = LocalRanks.USER
+        user.location_id = i % ROOMS + 1
+
+
+async def measure(connections: int, baseline: bool) -> float:
+    sockets = [IdleSocket() for _ in range(connections)]  # память самих соединений не считаем
+    PresenceFeed.logs.clear()
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    fill(BaselineCash.register if baseline else ConnectionManager.register, sockets)
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    if baseline:
+        BaselineCash.clear()
+    else:
+        for socket in sockets:
+            ConnectionManager.unregister(socket)
+    return used / connections
+
+
+async def main(sizes):
+    print(f"{'соединений':>10} {'было, байт':>11} {'стало, байт':>12} {'разница':>9}")
+    for connections in sizes:
+        before = await measure(connections, baseline=True)
+        after = await measure(connections, baseline=False)
+        print(f"{connections:>10} {before:11.0f} {after:12.0f} {(after - before) / before:9.0%}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main([int(i) for i in sys.argv[1:]] or [10000, 100000]))
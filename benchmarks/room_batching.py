@@ -0,0 +1,85 @@
+import asyncio
+import json
+import sys
+import time
+
+import websockets
+
+import core.batching
+from core.batching import RoomBatcher
+from core.lifecycle import ConnectionManager
+from core.user_cash import Cash
+
+ROOM = 1
+PORT = 8021
+
+
+async def handler(websocket):
+    user = ConnectionManager.register(websocket)
+    user.outbox.size = 10 ** 6  # без потерь: считаем стоимость доставки, а не политику переполнения
+    user.location_id = ROOM
+    try:
+        await websocket.wait_closed()
+    finally:
+        ConnectionManager.unregister(websocket)
+
+
+async def client(expected: int, done: asyncio.Event, counts: list):
+    async with websockets.connect(f"ws://localhost:{PORT}") as ws:
+        counts.append(0)
+        i = len(counts) - 1
+        while counts[i] < expected:
+            data = json.loads(await ws.recv())
+            counts[i] += len(data["#"]) if data["@"] == "новые сообщения" else 1
+        done.set()
+
+
+async def run(batching: bool, clients: int, messages: int, rate: int) -> dict:
+    # горячей комнату делает сам RoomBatcher: порог ниже темпа отправки
+    core.batching.ROOM_BATCH_RATE = rate / 10 if batching else 0
+    core.batching.ROOM_RATE_INTERVAL = 0.05
+    RoomBatcher.rates.clear()
+    counts: list = []
+    finished = [asyncio.Event() for _ in range(clients)]
+    async with websockets.serve(handler, "localhost", PORT):
+        tasks = [asyncio.create_task(client(messages, finished[i], counts)) for i in range(clients)]
+        while len(Cash.location.get(ROOM, ())) < clients:
+            await asyncio.sleep(0.01)
+        sent_before = sum(user.outbox.sent for user in Cash.online.values())
+        cpu = time.process_time()
+        start = time.perf_counter()
+        tick = 0.01
+        per_tick = max(1, int(rate * tick))
+        for i in range(0, messages, per_tick):
+            for j in range(i, min(i + per_tick, messages)):
+                RoomBatcher.publish(ROOM, {"text": f"сообщение {j}", "creator": {"user_id": 1}})
+            await asyncio.sleep(tick)
+        RoomBatcher.stop()
+        await asyncio.wait_for(asyncio.gather(*(event.wait() for event in finished)), 120)
+        cpu = time.process_time() - cpu
+        wall = time.perf_counter() - start
+        frames = sum(user.outbox.sent for user in Cash.online.values()) - sent_before
+        for task in tasks:
+            await task
+    delivered = clients * messages
+    return {
+        "frames": frames,
+        "frames_per_message": frames / delivered,
+        "cpu_us_per_message": cpu / delivered * 1e6,
+        "wall": wall,
+    }
+
+
+async def main(clients: int, messages: int, rate: int):
+    print(f"{clients} клиентов в комнате, {messages} сообщений, темп {rate}/с; "
+          f"CPU всего процесса, включая клиентов")
+    for batching in (False, True):
+        result = await run(batching, clients, messages, rate)
+        print(f"{'пакетами' if batching else 'по одному':10} кадров {result['frames']:7} "
+              f"({result['frames_per_message']:.3f} на доставку, ~send() на кадр), "
+              f"CPU {result['cpu_us_per_message']:6.1f} мкс на доставку, {result['wall']:.1f} с")
+
+
+if __name__ == '__main__':
+    args = [int(i) for i in sys.argv[1:]]
+    asyncio.run(main(*(args or [100, 2000, 1000])))
@@ -0,0 +1,50 @@
+# python -m benchmarks.token_auth
+# цена проверки токена на одну команду (декоратор protected): opaque, jwt с кэшем и jwt без кэша
+import time
+import uuid
+
+from core.lifecycle import ConnectionManager
+from core.managers import Token
+from core.security import protected
+
+ROUNDS = 20000
+
+
+class IdleSocket:
+    # только то, что реестр читает у соединения websockets
+    def __init__(self):
+        self.id = uuid.uuid4()
+        self.subprotocol = None
+
+
+class Command:
+    @protected
+    def __init__(self, socket, model, token):
+        pass
+
+
+def cost(socket, token: str, cold: bool) -> float:
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        if cold:
+            Token.verified.invalidate(token)
+        Command(socket, None, token)
+    return (time.perf_counter() - start) / ROUNDS * 1e6
+
+
+def main():
+    socket = IdleSocket()
+    user = ConnectionManager.register(socket)
+    user.ID = 123456
+    Token.key = Token.key or "benchmark"
+    print(f"{'токен':22} {'мкс на команду':>15}")
+    for kind, cold in ((Token.OPAQUE, False), (Token.JWT, False), (Token.JWT, True)):
+        Token.kind = kind
+        user.token = Token.generate(user.ID)
+        name = kind if kind == Token.OPAQUE else f"{kind} {'без кэша' if cold else 'с кэшем'}"
+        print(f"{name:22} {cost(socket, user.token, cold):15.2f}")
+    ConnectionManager.unregister(socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import datetime
+import time
+
+from core.codecs import codecs, Frame
+from core.io import output
+from events.dispatch import dispatcher
+from services.messages.models import PublicMessageOut, Author
+from services.rooms.aliases import LocalRanks
+
+MESSAGE = PublicMessageOut(
+    text="привет всем, как дела? " * 3,
+    creator=Author(user_id=123456, nickname="nickname", local_rank=LocalRanks.MODERATOR),
+    created_at=datetime.datetime(2024, 1, 1, 12, 30, 15, 123456),
+)
+RECIPIENTS = 100
+
+
+def encode(codec, rounds: int) -> float:
+    # новый кадр на каждую рассылку, как в SendPublic; кодирование один раз на формат
+    start = time.perf_counter()
+    for _ in range(rounds):
+        frame = output("новое сообщение", MESSAGE.model_dump(by_alias=True))
+        for _ in range(RECIPIENTS):
+            frame.encode(codec)
+    return rounds / (time.perf_counter() - start)
+
+
+def decode(codec, message, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        dispatcher.decode(codec.decode(message))
+    return rounds / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    rounds = 20000
+    repeats = 5
+    command = Frame({"@": "send public", "#": {"text": "привет всем, как дела?"}, "$": "0" * 32, "&": 17})
+    print(f"рассылка PublicMessageOut на {RECIPIENTS} получателей, разбор команды 'send public'")
+    results = {name: ([], []) for name in codecs}
+    # форматы чередуются, из повторов берется лучший: шум соседних процессов не достается одному формату
+    for _ in range(repeats):
+        for name, codec in codecs.items():
+            results[name][0].append(encode(codec, rounds // repeats))
+            results[name][1].append(decode(codec, command.encode(codec), rounds // repeats))
+    for name, codec in codecs.items():
+        frame = output("новое сообщение", MESSAGE.model_dump(by_alias=True)).encode(codec)
+        size = len(frame.encode() if isinstance(frame, str) else frame)
+        encoded, decoded = max(results[name][0]), max(results[name][1])
+        print(f"{name:18} кадр {size:4} байт, "
+              f"кодирование {encoded:10,.0f} рассылок/с, разбор {decoded:10,.0f} команд/с")
@@ -0,0 +1,118 @@
+# PG_URL=sqlite+aiosqlite:////tmp/scaling.db python -m benchmarks.worker_scaling [воркеров ...]
+# сервер запускается отдельным процессом с WORKERS=N, нагрузку дают несколько клиентских процессов
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+import uuid
+
+import websockets
+
+PORT = 8001
+CLIENT_PROCESSES = 4
+CLIENTS_PER_PROCESS = 25
+SENDERS_PER_PROCESS = 2
+MESSAGES = 100
+
+
+def start_server(workers: int) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "WORKERS": str(workers),
+        "RATE_LIMIT": "0",
+        "METRICS_PORT": "0",
+        "PUBLIC_WRITE_BEHIND": "1",
+        "OUTBOX_SIZE": str(10 ** 6),  # без потерь: считаем доставку, а не политику переполнения
+    }
+    server = subprocess.Popen([sys.executable, "main.py"], env=env, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("localhost", PORT), 0.2).close()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("сервер не запустился")
+
+
+async def connect(nickname: str):
+    ws = await websockets.connect(f"ws://localhost:{PORT}", max_queue=None)
+    await ws.recv()
+    await ws.send(json.dumps({"@": "signup", "#": {"nickname": nickname, "password": "password"}}))
+    while True:
+        answer = json.loads(await ws.recv())
+        if "!" in answer:
+            raise RuntimeError(answer)
+        if answer["@"] == "new_token":
+            return ws, answer["#"]["token"]
+
+
+async def receive(ws, expected: int):
+    received = 0
+    while received < expected:
+        answer = json.loads(await ws.recv())
+        if answer.get("@") == "новое сообщение":
+            received += 1
+
+
+async def group(prefix: str, ready, start, expected: int) -> float:
+    clients = [await connect(f"{prefix}{i}") for i in range(CLIENTS_PER_PROCESS)]
+    ready.wait()
+    await asyncio.get_running_loop().run_in_executor(None, start.wait)
+    began = time.perf_counter()
+    receivers = [asyncio.create_task(receive(ws, expected)) for ws, _ in clients]
+    for _ in range(MESSAGES):
+        for ws, token in clients[:SENDERS_PER_PROCESS]:
+            await ws.send(json.dumps({"@": "send public", "#": {"text": "нагрузка"}, "$": token}))
+    await asyncio.gather(*receivers)
+    elapsed = time.perf_counter() - began
+    for ws, _ in clients:
+        await ws.close()
+    return elapsed
+
+
+def client_process(prefix: str, ready, start, expected: int, results):
+    results.put(asyncio.run(group(prefix, ready, start, expected)))
+
+
+def run(workers: int) -> float:
+    context = multiprocessing.get_context("spawn")
+    server = start_server(workers)
+    try:
+        ready = context.Barrier(CLIENT_PROCESSES + 1)
+        start = context.Event()
+        results = context.Queue()
+        # все участники в главной комнате: каждое сообщение получает каждый клиент
+        expected = CLIENT_PROCESSES * SENDERS_PER_PROCESS * MESSAGES
+        prefix = uuid.uuid4().hex[:6]
+        processes = [
+            context.Process(target=client_process, args=(f"{prefix}{p}_", ready, start, expected, results))
+            for p in range(CLIENT_PROCESSES)
+        ]
+        for process in processes:
+            process.start()
+        ready.wait()
+        start.set()
+        elapsed = max(results.get(timeout=600) for _ in processes)
+        for process in processes:
+            process.join()
+        return expected * CLIENT_PROCESSES * CLIENTS_PER_PROCESS / elapsed
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == '__main__':
+    sizes = [int(i) for i in sys.argv[1:]] or [1, 2, 4]
+    print(f"ядер: {os.cpu_count()}, клиентов: {CLIENT_PROCESSES * CLIENTS_PER_PROCESS}, "
+          f"отправителей: {CLIENT_PROCESSES * SENDERS_PER_PROCESS} x {MESSAGES} сообщений")
+    base = None
+    for workers in sizes:
+        throughput = run(workers)
+        base = base or throughput
+        print(f"воркеров {workers}: {throughput:10,.0f} доставок/с (x{throughput / base:.2f})")
@@ -0,0 +1,288 @@
+import asyncio
+import hashlib
+import itertools
+import logging
+import time
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, List, Optional, Tuple
+
+from core.config import BACKPLANE, BACKPLANE_URL, BUS_PATH
+
+logger = logging.getLogger(__name__)
+
+RECEIVE = Callable[[bytes], None]
+
+# строка шины ограничена только размером кадра; по умолчанию StreamReader режет на 64 КБ
+LINE_LIMIT = 16 * 1024 * 1024
+
+
+class Backplane(ABC):
+    # транспорт между узлами: доставляет строки json всем узлам или одному по его имени.
+    # разбор сообщений и маршрутизация - в core.bus и core.cluster
+    @abstractmethod
+    async def start(self, node: str, receive: RECEIVE):
+        pass
+
+    @abstractmethod
+    def send(self, target: Optional[str], line: bytes):
+        # target None - всем узлам, кроме себя
+        pass
+
+    @abstractmethod
+    async def stop(self):
+        pass
+
+
+class MemoryBackplane(Backplane):
+    # кластер из одного узла без внешних зависимостей: трафик комнат идет тем же путем через владельца,
+    # что и в кластере. Bus и Cluster - одиночки процесса, второго узла в нем быть не может: несколько
+    # узлов проверяет benchmarks/cluster_routing - отдельными процессами на unix или postgres
+    async def start(self, node: str, receive: RECEIVE):
+        pass
+
+    def send(self, target: Optional[str], line: bytes):
+        # других узлов нет, себе Bus доставляет сам
+        pass
+
+    async def stop(self):
+        pass
+
+
+class UnixBackplane(Backplane):
+    # воркеры одного хоста: подключены к концентратору супервизора (Hub) по Unix-сокету.
+    # строка шины: "<узел или *>\t<json>\n", первая строка соединения - имя узла
+    def __init__(self, path: str):
+        self.path = path
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.listener: Optional[asyncio.Task] = None
+
+    async def start(self, node: str, receive: RECEIVE):
+        reader, self.writer = await asyncio.open_unix_connection(self.path, limit=LINE_LIMIT)
+        self.writer.write(node.encode() + b"\n")
+        self.listener = asyncio.create_task(self.__listen(reader, receive))
+
+    def send(self, target: Optional[str], line: bytes):
+        self.writer.write(b"".join([b"*" if target is None else target.encode(), b"\t", line, b"\n"]))
+
+    async def stop(self):
+        if self.listener is not None:
+            self.listener.cancel()
+            try:
+                await self.listener
+            except asyncio.CancelledError:
+                pass
+            self.listener = None
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    @staticmethod
+    async def __listen(reader: asyncio.StreamReader, receive: RECEIVE):
+        while line := await reader.readline():
+            receive(line)
+        logger.error("шина воркеров закрыта")
+
+
+class PostgresBackplane(Backplane):
+    # узлы на разных хостах через LISTEN/NOTIFY: общий канал для рассылки всем и свой канал у каждого узла.
+    # NOTIFY ограничен 8000 байт - длинные сообщения уходят частями и собираются на приемнике
+    BROADCAST = "demochat"
+    CHUNK = 1900  # символов: до 4 байт на символ в utf-8, с запасом под заголовок части
+    PARTS_TTL = 10.0  # секунд: части сообщения, оборванного на середине (отправитель упал, обрыв), выбрасываются
+    SEND_TIMEOUT = 5.0  # зависший NOTIFY - признак полуоткрытого соединения
+    RECONNECT_DELAY = 0.5  # первая пауза перед переподключением, дальше удваивается
+    RECONNECT_MAX_DELAY = 10.0
+    STOP_TIMEOUT = 2.0  # на отправку очереди при остановке: "node leave" должен уйти
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.connection = None
+        self.connected = asyncio.Event()
+        self.lost = asyncio.Event()
+        self.queue: Optional[asyncio.Queue] = None
+        self.sender: Optional[asyncio.Task] = None
+        self.keeper: Optional[asyncio.Task] = None
+        self.receive: Optional[RECEIVE] = None
+        self.ids = itertools.count()
+        self.node: Optional[str] = None
+        # заголовок сообщения -> (когда пришла первая часть, части); порядок вставки - порядок прихода
+        self.parts: Dict[str, Tuple[float, List[Optional[str]]]] = {}
+
+        self.reconnects: int = 0
+        self.expired_parts: int = 0
+
+    @staticmethod
+    def channel(node: str) -> str:
+        # имена каналов - идентификаторы Postgres до 63 символов
+        return "demochat_" + hashlib.md5(node.encode()).hexdigest()
+
+    async def start(self, node: str, receive: RECEIVE):
+        self.node = node
+        self.receive = receive
+        # первое подключение - при старте: без шины узел не запускается
+        await self.__connect()
+        self.queue = asyncio.Queue()
+        self.sender = asyncio.create_task(self.__send())
+        self.keeper = asyncio.create_task(self.__keep())
+
+    def send(self, target: Optional[str], line: bytes):
+        channel = self.BROADCAST if target is None else self.channel(target)
+        payload = line.decode()
+        if len(payload) <= self.CHUNK:
+            self.queue.put_nowait((channel, payload))
+            return
+        message_id = f"{self.node}:{next(self.ids)}"
+        chunks = [payload[i:i + self.CHUNK] for i in range(0, len(payload), self.CHUNK)]
+        for i, chunk in enumerate(chunks):
+            self.queue.put_nowait((channel, f"~{message_id} {i} {len(chunks)} {chunk}"))
+
+    async def stop(self):
+        if self.sender is not None and self.connected.is_set():
+            try:
+                await asyncio.wait_for(self.queue.join(), self.STOP_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning("не отправлено в шину Postgres при остановке: %d", self.queue.qsize())
+        for task in (self.keeper, self.sender):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.keeper = self.sender = None
+        connection, self.connection = self.connection, None
+        self.connected.clear()
+        if connection is not None:
+            await connection.close()
+
+    async def __connect(self):
+        import asyncpg  # драйвер уже нужен SQLAlchemy; импорт здесь - чтобы не требовать его для других шин
+
+        connection = await asyncpg.connect(self.dsn)
+        await connection.add_listener(self.BROADCAST, self.__notify)
+        await connection.add_listener(self.channel(self.node), self.__notify)
+        connection.add_termination_listener(self.__lost)
+        self.connection = connection
+        self.lost.clear()
+        self.connected.set()
+
+    def __lost(self, connection):
+        # LISTEN живет только на своем соединении: после обрыва подписываемся заново на новом
+        if connection is self.connection and self.connected.is_set():
+            self.connected.clear()
+            self.lost.set()
+
+    async def __keep(self):
+        while True:
+            await self.lost.wait()
+            logger.error("соединение шины Postgres потеряно, переподключение")
+            if not self.connection.is_closed():
+                self.connection.terminate()
+            delay = self.RECONNECT_DELAY
+            while not self.connected.is_set():
+                try:
+                    await self.__connect()
+                except Exception as e:
+                    logger.warning("шина Postgres недоступна (%s), повтор через %.1f с", e, delay)
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self.RECONNECT_MAX_DELAY)
+            self.reconnects += 1
+            logger.info("шина Postgres переподключена")
+
+    async def __send(self):
+        while True:
+            channel, payload = await self.queue.get()
+            # при обрыве сообщение ждет переподключения, а не теряется
+            while True:
+                await self.connected.wait()
+                connection = self.connection
+                try:
+                    await connection.execute("SELECT pg_notify($1, $2)", channel, payload, timeout=self.SEND_TIMEOUT)
+                    break
+                except Exception as e:
+                    if connection.is_closed() or isinstance(e, asyncio.TimeoutError):
+                        self.__lost(connection)
+                        continue
+                    logger.exception("ошибка отправки в шину Postgres")
+                    break
+            self.queue.task_done()
+
+    def __notify(self, connection, pid, channel: str, payload: str):
+        if not payload.startswith("~"):
+            self.receive(payload.encode())
+            return
+        header, _, chunk = payload[1:].partition(" ")
+        index, count, chunk = chunk.split(" ", 2)
+        now = time.monotonic()
+        while self.parts:
+            oldest = next(iter(self.parts))
+            if now - self.parts[oldest][0] <= self.PARTS_TTL:
+                break
+            del self.parts[oldest]
+            self.expired_parts += 1
+        if header not in self.parts:
+            self.parts[header] = (now, [None] * int(count))
+        parts = self.parts[header][1]
+        parts[int(index)] = chunk
+        if all(part is not None for part in parts):
+            del self.parts[header]
+            self.receive("".join(parts).encode())
+
+
+class Hub:
+    # концентратор в супервизоре для UnixBackplane: пересылает строку узлу-адресату
+    # или всем, кроме отправителя
+    server: Optional[asyncio.AbstractServer] = None
+    writers: Dict[bytes, asyncio.StreamWriter] = {}
+
+    relayed: int = 0
+
+    @classmethod
+    async def start(cls, sock):
+        cls.server = await asyncio.start_unix_server(cls.__handle, sock=sock, limit=LINE_LIMIT)
+
+    @classmethod
+    async def stop(cls):
+        if cls.server is not None:
+            cls.server.close()
+            for writer in cls.writers.values():
+                writer.close()
+            cls.writers.clear()
+            await cls.server.wait_closed()
+            cls.server = None
+
+    @classmethod
+    async def __handle(cls, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        node = (await reader.readline()).rstrip(b"\n")
+        cls.writers[node] = writer
+        try:
+            while line := await reader.readline():
+                target, _, message = line.partition(b"\t")
+                if target == b"*":
+                    for other, other_writer in cls.writers.items():
+                        if other != node:
+                            other_writer.write(message)
+                else:
+                    target_writer = cls.writers.get(target)
+                    if target_writer is not None:
+                        target_writer.write(message)
+                cls.relayed += 1
+        except ConnectionError:
+            pass
+        finally:
+            if cls.writers.get(node) is writer:
+                del cls.writers[node]
+            writer.close()
+
+
+def configured() -> Optional[Backplane]:
+    # транспорт из BACKPLANE; None - узел работает один
+    if not BACKPLANE:
+        return None
+    if BACKPLANE == "memory":
+        return MemoryBackplane()
+    if BACKPLANE == "unix":
+        return UnixBackplane(BUS_PATH)
+    if BACKPLANE == "postgres":
+        return PostgresBackplane(BACKPLANE_URL)
+    raise ValueError(f"неизвестная шина: {BACKPLANE}")
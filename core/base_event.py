@@ -5,6 +5,10 @@ from websockets import WebSocketServerProtocol
 
 
 class BaseEvent(ABC):
+    # команды, меняющие состояние соединения или порядок сообщений в комнате,
+    # выполняются по порядку; остальные - параллельно
+    ordered: bool = False
+
     @abstractmethod
     def __init__(self, socket: WebSocketServerProtocol, model, token: Optional[str]):
         self.socket = socket
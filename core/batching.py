@@ -0,0 +1,99 @@
+import asyncio
+import time
+from typing import Dict, List
+
+from core.broadcast import room_broadcast
+from core.config import ROOM_BATCH_RATE, ROOM_BATCH_WINDOW, ROOM_RATE_INTERVAL
+from core.io import output
+from core.user_cash import ROOM_ID
+
+
+class RoomRate:
+    __slots__ = ["started_at", "count", "hot"]
+
+    def __init__(self, now: float):
+        self.started_at = now
+        self.count = 0
+        self.hot = False
+
+    def hit(self, now: float) -> bool:
+        self.count += 1
+        elapsed = now - self.started_at
+        if elapsed >= ROOM_RATE_INTERVAL:
+            rate = self.count / elapsed
+            # включаемся на пороге, выключаемся на половине - без дребезга на границе
+            if not self.hot and rate >= ROOM_BATCH_RATE:
+                self.hot = True
+            elif self.hot and rate < ROOM_BATCH_RATE / 2:
+                self.hot = False
+            self.started_at = now
+            self.count = 0
+        return self.hot
+
+
+class RoomBatcher:
+    # в горячих комнатах сообщения за окно ROOM_BATCH_WINDOW уходят одним кадром "новые сообщения"
+    rates: Dict[ROOM_ID, RoomRate] = {}
+    pending: Dict[ROOM_ID, List[dict]] = {}
+    timers: Dict[ROOM_ID, asyncio.TimerHandle] = {}
+
+    direct: int = 0
+    batched: int = 0
+    batches: int = 0
+    max_batch: int = 0
+
+    @classmethod
+    def publish(cls, room_id: ROOM_ID, message: dict):
+        if not ROOM_BATCH_RATE:
+            cls.__deliver(room_id, [message])
+            return
+        now = time.monotonic()
+        rate = cls.rates.get(room_id)
+        if rate is None:
+            rate = cls.rates[room_id] = RoomRate(now)
+        hot = rate.hit(now)
+        batch = cls.pending.get(room_id)
+        if batch is not None:
+            # пока окно открыто, все сообщения идут в него - иначе нарушится порядок
+            batch.append(message)
+        elif hot:
+            cls.pending[room_id] = [message]
+            cls.timers[room_id] = asyncio.get_running_loop().call_later(ROOM_BATCH_WINDOW, cls.flush, room_id)
+        else:
+            cls.__deliver(room_id, [message])
+
+    @classmethod
+    def flush(cls, room_id: ROOM_ID):
+        timer = cls.timers.pop(room_id, None)
+        if timer is not None:
+            timer.cancel()
+        batch = cls.pending.pop(room_id, None)
+        if batch:
+            cls.__deliver(room_id, batch)
+
+    @classmethod
+    def stop(cls):
+        for room_id in list(cls.pending):
+            cls.flush(room_id)
+
+    @classmethod
+    def snapshot(cls) -> dict:
+        return {
+            "hot_rooms": sum(1 for rate in cls.rates.values() if rate.hot),
+            "direct": cls.direct,
+            "batched": cls.batched,
+            "batches": cls.batches,
+            "max_batch": cls.max_batch,
+        }
+
+    @classmethod
+    def __deliver(cls, room_id: ROOM_ID, messages: List[dict]):
+        if len(messages) == 1:
+            cls.direct += 1
+            room_broadcast(room_id, output("новое сообщение", messages[0]))
+            return
+        cls.batches += 1
+        cls.batched += len(messages)
+        if len(messages) > cls.max_batch:
+            cls.max_batch = len(messages)
+        room_broadcast(room_id, output("новые сообщения", messages))
@@ -0,0 +1,99 @@
+import logging
+import time
+from typing import Iterable, Optional, Set, Hashable
+
+from websockets import WebSocketServerProtocol
+
+from core.bus import Bus
+from core.cluster import Cluster
+from core.codecs import Frame, json_codec
+from core.metrics import Metrics
+from core.user_cash import Cash, ROOM_ID
+
+logger = logging.getLogger(__name__)
+
+
+class BroadcastStats:
+    # время - постановка в очереди получателей; доставку до сокетов меряют писатели Outbox (stage delivery)
+    broadcasts: int = 0
+    recipients: int = 0
+    failures: int = 0
+    total_time: float = 0.0
+    max_time: float = 0.0
+    last_time: float = 0.0
+    last_recipients: int = 0
+
+    @classmethod
+    def record(cls, recipients: int, failures: int, elapsed: float):
+        cls.broadcasts += 1
+        cls.recipients += recipients
+        cls.failures += failures
+        cls.total_time += elapsed
+        cls.last_time = elapsed
+        cls.last_recipients = recipients
+        if elapsed > cls.max_time:
+            cls.max_time = elapsed
+
+    @classmethod
+    def snapshot(cls) -> dict:
+        return {
+            "broadcasts": cls.broadcasts,
+            "recipients": cls.recipients,
+            "failures": cls.failures,
+            "total_time": cls.total_time,
+            "max_time": cls.max_time,
+            "last_time": cls.last_time,
+            "last_recipients": cls.last_recipients,
+        }
+
+
+def room_sockets(room_id: ROOM_ID, exclude: Optional[WebSocketServerProtocol] = None) -> Set[WebSocketServerProtocol]:
+    return {
+        Cash.online[handle].socket
+        for handle in Cash.location.get(room_id, ())
+        if exclude is None or handle != id(exclude)
+    }
+
+
+def send(socket: WebSocketServerProtocol, frame: Frame, key: Optional[Hashable] = None) -> bool:
+    user = Cash.get(socket)
+    if user is None:
+        return False
+    return user.outbox.put(frame, key)
+
+
+def broadcast(sockets: Iterable[WebSocketServerProtocol], frame: Frame, key: Optional[Hashable] = None) -> None:
+    # кадр только ставится в очереди получателей, кодируют и отправляют их собственные писатели
+    # (не больше одного кодирования на формат) - медленный клиент не задерживает остальных
+    start = time.perf_counter()
+    recipients = 0
+    failures = 0
+    for s in sockets:
+        recipients += 1
+        if not send(s, frame, key):
+            failures += 1
+    if not recipients:
+        return
+    elapsed = time.perf_counter() - start
+    BroadcastStats.record(recipients, failures, elapsed)
+    Metrics.observe_stage("broadcast_enqueue", elapsed)
+    logger.debug("broadcast: %d получателей, %d ошибок, %.3f мс", recipients, failures, elapsed * 1000)
+
+
+def room_broadcast(room_id: ROOM_ID,
+                   frame: Frame,
+                   exclude: Optional[WebSocketServerProtocol] = None,
+                   key: Optional[Hashable] = None) -> None:
+    # участники комнаты могут быть подключены к другим узлам: кадр уходит через владельца комнаты
+    # только туда, где они есть, вместе с готовым json, чтобы не кодировать его повторно
+    broadcast(room_sockets(room_id, exclude), frame, key)
+    if Bus.backplane is not None:
+        Cluster.fanout(room_id, room=room_id, frame=frame.data, json=frame.encode(json_codec), key=key)
+
+
+def _on_room(message: dict):
+    frame = Frame(message["frame"], {json_codec.name: message["json"]})
+    broadcast(room_sockets(message["room"]), frame, message["key"])
+
+
+Bus.subscribe("room", _on_room)
@@ -0,0 +1,83 @@
+import logging
+from typing import Callable, Dict, Optional
+
+from pydantic_core import from_json
+
+from core.backplane import Backplane
+from core.codecs import dumps
+
+logger = logging.getLogger(__name__)
+
+
+class Bus:
+    # сообщения между узлами (воркерами и хостами): одна json-строка {"op": ..., "node": отправитель, ...}
+    # поверх подключаемого транспорта core.backplane. Без транспорта - один процесс, publish ничего не делает
+    node: str = ""
+    handlers: Dict[str, Callable[[dict], None]] = {}
+    backplane: Optional[Backplane] = None
+
+    sent: int = 0
+    received: int = 0
+    failures: int = 0
+
+    @classmethod
+    def subscribe(cls, op: str, handler: Callable[[dict], None]):
+        cls.handlers[op] = handler
+
+    @classmethod
+    def publish(cls, op: str, **fields):
+        # всем узлам, кроме себя
+        cls.send(None, op, **fields)
+
+    @classmethod
+    def send(cls, target: Optional[str], op: str, **fields):
+        if cls.backplane is None:
+            return
+        fields["op"] = op
+        fields["node"] = cls.node
+        if target == cls.node:
+            cls.deliver(fields)
+            return
+        cls.backplane.send(target, dumps(fields).encode())
+        cls.sent += 1
+
+    @classmethod
+    def deliver(cls, message: dict):
+        try:
+            cls.handlers[message["op"]](message)
+        except Exception:
+            cls.failures += 1
+            logger.exception("ошибка обработки сообщения шины")
+
+    @classmethod
+    async def start(cls, backplane: Backplane, node: str):
+        cls.node = node
+        cls.backplane = backplane
+        await backplane.start(node, cls.__receive)
+
+    @classmethod
+    async def close(cls):
+        if cls.backplane is not None:
+            await cls.backplane.stop()
+            cls.backplane = None
+
+    @classmethod
+    def snapshot(cls) -> dict:
+        return {
+            "sent": cls.sent,
+            "received": cls.received,
+            "failures": cls.failures,
+        }
+
+    @classmethod
+    def __receive(cls, line: bytes):
+        cls.received += 1
+        try:
+            message = from_json(line)
+        except ValueError:
+            cls.failures += 1
+            logger.exception("невалидное сообщение шины")
+            return
+        # общий канал LISTEN/NOTIFY возвращает и собственные сообщения
+        if message.get("node") != cls.node:
+            cls.deliver(message)
@@ -0,0 +1,125 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+from sqlalchemy import select
+
+from core.bus import Bus
+from core.config import PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL, ROOM_CACHE_SIZE, RANK_CACHE_SIZE, RANK_CACHE_TTL, \
+    READ_YOUR_WRITES
+from core.database import unit_of_work, replicas
+from core.schemas import rooms, local_ranks
+from services.accounts.aliases import AccountAliases
+from services.rooms.aliases import RoomAliases, LocalRankAliases, LocalRanks
+
+
+class LRUCache:
+    # ограничен и по размеру (вытесняется самый давний), и по времени жизни записи
+    __slots__ = ["size", "ttl", "entries", "hits", "misses", "evictions", "expirations"]
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.entries: Dict[Hashable, Tuple[Any, float]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any):
+        if not self.size:
+            return
+        self.entries[key] = (value, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        self.entries.pop(key, None)
+
+    def snapshot(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+# карточки пользователей для "get one user": ID -> готовый GetOneUserOut без статуса
+profiles = LRUCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+# ID пользователя, чья карточка изменилась за последние READ_YOUR_WRITES секунд (верхняя граница отставания реплик)
+profile_changes = LRUCache(PROFILE_CACHE_SIZE, READ_YOUR_WRITES)
+# справочник комнат: ID -> название; названия не меняются, поэтому без срока жизни
+room_titles = LRUCache(ROOM_CACHE_SIZE, float("inf"))
+# (ID пользователя, ID комнаты) -> ранг; меняется только через UpdatePermission, который пишет сквозь кэш
+ranks = LRUCache(RANK_CACHE_SIZE, RANK_CACHE_TTL)
+
+
+async def room_title(room_id: int) -> Optional[str]:
+    title = room_titles.get(room_id)
+    if title is None:
+        query = select(rooms.c[RoomAliases.title]).where(rooms.c[RoomAliases.ID] == room_id)
+        async with unit_of_work(read_only=True) as db:
+            title = (await db.execute(query)).scalar()
+        if title is None and replicas:
+            # комнату могли только что создать: реплика может отставать
+            async with unit_of_work() as db:
+                title = (await db.execute(query)).scalar()
+        if title is not None:
+            room_titles.put(room_id, title)
+    return title
+
+
+async def local_rank(user_id: int, room_id: int) -> LocalRanks:
+    # отсутствие записи в local_ranks - обычный пользователь, это тоже кэшируется
+    rank = ranks.get((user_id, room_id))
+    if rank is None:
+        # ранги меняются только сквозь этот кэш, реплике достаточно догнать к его промаху
+        async with unit_of_work(read_only=True) as db:
+            cursor = await db.execute(
+                select(local_ranks.c[LocalRankAliases.rank])
+                .where(local_ranks.c[AccountAliases.ID] == user_id)
+                .where(local_ranks.c[RoomAliases.ID] == room_id)
+            )
+            rank = cursor.scalar() or LocalRanks.USER
+        ranks.put((user_id, room_id), rank)
+    return rank
+
+
+def forget_profile(user_id: int):
+    # карточка могла попасть в кэши других воркеров - сбрасываем и там
+    _invalidate_profile(user_id)
+    Bus.publish("profile", user=user_id)
+
+
+def profile_changed(user_id: int) -> bool:
+    # карточка менялась недавно: реплика может отдать старую, читать ее нужно с основной базы
+    return profile_changes.get(user_id) is not None
+
+
+def _invalidate_profile(user_id: int):
+    profiles.invalidate(user_id)
+    profile_changes.put(user_id, True)
+
+
+Bus.subscribe("profile", lambda message: _invalidate_profile(message["user"]))
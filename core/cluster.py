@@ -0,0 +1,205 @@
+import asyncio
+import hashlib
+import logging
+import time
+from bisect import bisect
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+from core.bus import Bus
+from core.config import HEARTBEAT_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+ROOM_ID = int
+NODE = str
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    # согласованное хеширование: при входе или уходе узла меняют владельца только его доли комнат
+    VNODES = 64
+
+    def __init__(self, nodes: Iterable[NODE]):
+        self.points: List[Tuple[int, NODE]] = sorted(
+            (_hash(f"{node}#{i}"), node) for node in nodes for i in range(self.VNODES)
+        )
+        self.keys: List[int] = [point for point, _ in self.points]
+
+    def owner(self, key: Hashable) -> Optional[NODE]:
+        if not self.points:
+            return None
+        i = bisect(self.keys, _hash(str(key))) % len(self.points)
+        return self.points[i][1]
+
+
+class Cluster:
+    # у каждой комнаты один узел-владелец по кольцу. Владелец знает, на каких узлах есть ее участники,
+    # и рассылает ее трафик только им: отправитель -> владелец -> узлы с участниками
+    nodes: Dict[NODE, float] = {}  # узел -> время последнего heartbeat
+    ring: HashRing = HashRing([])
+    rooms: Set[ROOM_ID] = set()  # комнаты с участниками на этом узле
+    directory: Dict[ROOM_ID, Set[NODE]] = {}  # для своих комнат: узлы с участниками
+    heartbeat: Optional[asyncio.Task] = None
+    # состояние, которое узлы держат друг о друге (присутствие, состав комнат, сессии): новичку отдается
+    # свое, за ушедшим или пропавшим узлом вычищается
+    joined: List[Callable[[NODE], None]] = []
+    departed: List[Callable[[NODE], None]] = []
+
+    routed: int = 0
+    relayed: int = 0
+    rebalances: int = 0
+
+    @classmethod
+    async def start(cls):
+        cls.nodes = {Bus.node: time.monotonic()}
+        cls.__rebalance()
+        Bus.publish("node")
+        cls.heartbeat = asyncio.create_task(cls.__beat())
+
+    @classmethod
+    async def stop(cls):
+        if cls.heartbeat is None:
+            return
+        cls.heartbeat.cancel()
+        try:
+            await cls.heartbeat
+        except asyncio.CancelledError:
+            pass
+        cls.heartbeat = None
+        Bus.publish("node leave")
+
+    @classmethod
+    def watch(cls, joined: Callable[[NODE], None], departed: Callable[[NODE], None]):
+        cls.joined.append(joined)
+        cls.departed.append(departed)
+
+    @classmethod
+    def owner(cls, room_id: ROOM_ID) -> Optional[NODE]:
+        return cls.ring.owner(room_id)
+
+    @classmethod
+    def join(cls, room_id: ROOM_ID):
+        # первый участник комнаты на этом узле: сообщаем владельцу комнаты
+        cls.rooms.add(room_id)
+        if Bus.backplane is not None:
+            Bus.send(cls.owner(room_id), "interest", room=room_id, member=True)
+
+    @classmethod
+    def leave(cls, room_id: ROOM_ID):
+        cls.rooms.discard(room_id)
+        if Bus.backplane is not None:
+            Bus.send(cls.owner(room_id), "interest", room=room_id, member=False)
+
+    @classmethod
+    def fanout(cls, room_id: ROOM_ID, **fields):
+        # локальные участники уже получили кадр - остальные узлы через владельца комнаты
+        if Bus.backplane is None:
+            return
+        cls.routed += 1
+        owner = cls.owner(room_id)
+        if owner == Bus.node:
+            cls.__relay(room_id, Bus.node, fields)
+        else:
+            Bus.send(owner, "route", room=room_id, fields=fields)
+
+    @classmethod
+    def snapshot(cls) -> dict:
+        return {
+            "nodes": len(cls.nodes),
+            "rooms": len(cls.rooms),
+            "owned_rooms": len(cls.directory),
+            "routed": cls.routed,
+            "relayed": cls.relayed,
+            "rebalances": cls.rebalances,
+        }
+
+    @classmethod
+    def __relay(cls, room_id: ROOM_ID, origin: NODE, fields: dict):
+        for node in cls.directory.get(room_id, ()):
+            if node != origin:
+                cls.relayed += 1
+                Bus.send(node, "room", **fields)
+
+    @classmethod
+    def __rebalance(cls):
+        cls.rebalances += 1
+        cls.ring = HashRing(cls.nodes)
+        # свои комнаты, ставшие чужими, забываем, ушедшие узлы вычеркиваем
+        for room_id in list(cls.directory):
+            members = cls.directory[room_id]
+            members.intersection_update(cls.nodes)
+            if not members or cls.owner(room_id) != Bus.node:
+                del cls.directory[room_id]
+        # новым владельцам - о своих комнатах; повторная заявка безвредна
+        for room_id in cls.rooms:
+            Bus.send(cls.owner(room_id), "interest", room=room_id, member=True)
+        logger.info("узлов в кластере: %d", len(cls.nodes))
+
+    @classmethod
+    def _on_node(cls, message: dict):
+        node = message["node"]
+        known = node in cls.nodes
+        cls.nodes[node] = time.monotonic()
+        if not known:
+            # новичку сразу отвечаем, не дожидаясь своего heartbeat
+            Bus.publish("node")
+            cls.__rebalance()
+            for joined in cls.joined:
+                joined(node)
+
+    @classmethod
+    def _on_node_leave(cls, message: dict):
+        node = message["node"]
+        if cls.nodes.pop(node, None) is not None:
+            cls.__rebalance()
+            cls.__forget(node)
+
+    @classmethod
+    def __forget(cls, node: NODE):
+        # вызывается и из heartbeat: ошибка одного обработчика не должна его остановить
+        for departed in cls.departed:
+            try:
+                departed(node)
+            except Exception:
+                logger.exception("ошибка очистки состояния узла %s", node)
+
+    @classmethod
+    def _on_interest(cls, message: dict):
+        room_id = message["room"]
+        if message["member"]:
+            cls.directory.setdefault(room_id, set()).add(message["node"])
+            return
+        members = cls.directory.get(room_id)
+        if members is not None:
+            members.discard(message["node"])
+            if not members:
+                del cls.directory[room_id]
+
+    @classmethod
+    def _on_route(cls, message: dict):
+        cls.__relay(message["room"], message["node"], message["fields"])
+
+    @classmethod
+    async def __beat(cls):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            now = time.monotonic()
+            cls.nodes[Bus.node] = now
+            Bus.publish("node")
+            expired = [node for node, seen in cls.nodes.items() if now - seen > 3 * HEARTBEAT_INTERVAL]
+            for node in expired:
+                logger.warning("узел %s не отвечает, исключен из кластера", node)
+                del cls.nodes[node]
+            if expired:
+                cls.__rebalance()
+            for node in expired:
+                cls.__forget(node)
+
+
+Bus.subscribe("node", Cluster._on_node)
+Bus.subscribe("node leave", Cluster._on_node_leave)
+Bus.subscribe("interest", Cluster._on_interest)
+Bus.subscribe("route", Cluster._on_route)
@@ -0,0 +1,225 @@
+import time
+from typing import Any, Dict, Optional, Union, Iterable
+
+from pydantic import BaseModel
+from pydantic_core import to_json, to_jsonable_python
+
+from core.metrics import Metrics
+from services.accounts.aliases import AccountAliases
+from services.messages.aliases import PublicAliases
+from services.models import PaginatorAliases
+from services.rooms.aliases import RoomAliases, LocalRankAliases
+
+try:
+    import msgpack
+except ImportError:  # необязательная зависимость: без нее клиентам доступен только json
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:  # необязательная зависимость: без нее json кодирует pydantic_core
+    orjson = None
+
+WIRE = Union[str, bytes]
+
+# номера событий для бинарного протокола, общие для команд и ответов; номера не переиспользуются
+EVENT_CODES: Dict[str, int] = {
+    "успешное подключение": 1,
+    "success": 2,
+    "new_token": 3,
+    "user_info": 4,
+    "online_list": 5,
+    "system": 6,
+    "online room list": 7,
+    "room history": 8,
+    "metrics": 9,
+    "новое сообщение": 10,
+    "комната создана": 11,
+    "presence snapshot": 12,
+    "presence delta": 13,
+    "presence deltas": 14,
+    "новые сообщения": 15,
+    "signup": 32,
+    "signin": 33,
+    "get one user": 34,
+    "online list": 35,
+    "change nickname": 36,
+    "change password": 37,
+    "relocate": 38,
+    "create room": 39,
+    "send public": 40,
+    "update permission": 41,
+    "presence subscribe": 42,
+    "presence unsubscribe": 43,
+    "presence resync": 44,
+    "resume": 45,
+}
+EVENT_NAMES: Dict[int, str] = {code: name for name, code in EVENT_CODES.items()}
+
+class KeyMap(dict):
+    # неизвестные ключи передаются как есть, нестроковые - строкой, как в json
+    def __missing__(self, key: Any) -> str:
+        return key if type(key) is str else next(iter(to_jsonable_python({key: None})))
+
+
+# короткие ключи полей для бинарного протокола
+SHORT_KEYS: Dict[str, str] = KeyMap({
+    AccountAliases.ID: "u",
+    AccountAliases.nickname: "n",
+    AccountAliases.password: "p",
+    AccountAliases.created_at: "d",
+    AccountAliases.location: "l",
+    AccountAliases.status: "s",
+    PublicAliases.ID: "m",
+    PublicAliases.creator: "c",
+    PublicAliases.text: "t",
+    RoomAliases.ID: "r",
+    RoomAliases.title: "ti",
+    RoomAliases.owner_id: "o",
+    RoomAliases.version: "v",
+    LocalRankAliases.rank: "lr",
+    PaginatorAliases.SKIP: "sk",
+    PaginatorAliases.LIMIT: "li",
+    "members": "ms",
+    "member": "mb",
+    "deltas": "ds",
+    "op": "op",
+    "token": "k",
+})
+LONG_KEYS: Dict[str, str] = {short: key for key, short in SHORT_KEYS.items()}
+
+
+def dumps(data: dict) -> str:
+    # модели сериализует их собственный скомпилированный сериализатор pydantic-core - без промежуточного
+    # model_dump; готовые словари и списки быстрее кодирует orjson
+    if orjson is None or isinstance(data.get("#"), BaseModel):
+        return to_json(data).decode()
+    return orjson.dumps(data, default=to_jsonable_python, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+NESTED = (dict, list)
+
+
+def shorten(value: Union[dict, list]) -> Union[dict, list]:
+    # один проход только по словарям и спискам кадра: строки, числа и None msgpack пакует сам,
+    # а остальное (модели, даты, enum) - через jsonable, без полного to_jsonable_python на каждый кадр
+    if type(value) is dict:
+        return {SHORT_KEYS[k]: shorten(v) if type(v) in NESTED else v for k, v in value.items()}
+    return [shorten(v) if type(v) in NESTED else v for v in value]
+
+
+def jsonable(value: Any) -> Any:
+    value = to_jsonable_python(value)
+    return shorten(value) if type(value) in NESTED else value
+
+
+class Codec:
+    # подпротокол websocket, по которому клиент выбирает формат кадров
+    name: str = ""
+
+    def encode(self, data: dict) -> WIRE:
+        raise NotImplementedError
+
+    def decode(self, message: WIRE) -> Union[WIRE, dict]:
+        raise NotImplementedError
+
+
+class JsonCodec(Codec):
+    name = "demochat.json"
+
+    def encode(self, data: dict) -> WIRE:
+        return dumps(data)
+
+    def decode(self, message: WIRE) -> Union[WIRE, dict]:
+        # json разбирает сам диспетчер вместе с валидацией
+        return message
+
+
+class MsgpackCodec(Codec):
+    name = "demochat.msgpack"
+
+    def __init__(self):
+        # один упаковщик на процесс: msgpack.packb заводит новый на каждый вызов
+        self.packer = msgpack.Packer(default=jsonable)
+
+    def encode(self, data: dict) -> WIRE:
+        # ключи конверта уже короткие, переименовывается только полезная нагрузка; data общий с другими кодеками
+        data = {**data}
+        event = data.get("@")
+        if event in EVENT_CODES:
+            data["@"] = EVENT_CODES[event]
+        payload = data.get("#")
+        if type(payload) in NESTED:
+            data["#"] = shorten(payload)
+        return self.packer.pack(data)
+
+    def decode(self, message: WIRE) -> Union[WIRE, dict]:
+        if not isinstance(message, bytes):
+            raise ValueError("ожидается бинарный кадр")
+        try:
+            data = msgpack.unpackb(message)
+        except Exception as e:
+            raise ValueError("невалидный msgpack") from e
+        if not isinstance(data, dict):
+            raise ValueError("ожидается словарь")
+        # команды плоские: короткие ключи есть только на верхнем уровне полезной нагрузки
+        payload = data.get("#")
+        if type(payload) is dict:
+            data["#"] = {LONG_KEYS.get(k, k): v for k, v in payload.items()}
+        event = data.get("@")
+        if isinstance(event, int) and event in EVENT_NAMES:
+            data["@"] = EVENT_NAMES[event]
+        return data
+
+
+json_codec = JsonCodec()
+codecs: Dict[str, Codec] = {json_codec.name: json_codec}
+if msgpack is not None:
+    codecs[MsgpackCodec.name] = MsgpackCodec()
+
+
+def select_subprotocol(connection, subprotocols: Iterable[str]) -> Optional[str]:
+    # первый предложенный клиентом формат, который мы знаем; без подпротокола - json
+    for subprotocol in subprotocols:
+        if subprotocol in codecs:
+            return subprotocol
+    return None
+
+
+def codec_for(subprotocol: Optional[str]) -> Codec:
+    return codecs.get(subprotocol, json_codec)
+
+
+class Frame:
+    # исходящий кадр: кодируется лениво и не больше одного раза для каждого формата,
+    # поэтому рассылка на комнату стоит по одному кодированию на формат, а не на получателя
+    __slots__ = ["data", "encoded"]
+
+    def __init__(self, data: dict, encoded: Optional[Dict[str, WIRE]] = None):
+        self.data = data
+        self.encoded: Dict[str, WIRE] = {} if encoded is None else encoded
+
+    def freeze(self) -> "Frame":
+        # постоянный кадр: кодируется сразу во все форматы, дальше отправляются готовые байты
+        for codec in codecs.values():
+            self.encode(codec)
+        return self
+
+    def reply(self, request_id: Optional[Union[int, str]]) -> "Frame":
+        # тот же кадр с ID запроса: готовый json дополняется полем "&", а не кодируется заново
+        if request_id is None:
+            return self
+        encoded = {}
+        wire = self.encoded.get(json_codec.name)
+        if wire is not None:
+            value = str(request_id) if type(request_id) is int else to_json(request_id).decode()
+            encoded[json_codec.name] = "".join([wire[:-1], ',"&":', value, "}"])
+        return Frame({**self.data, "&": request_id}, encoded)
+
+    def encode(self, codec: Codec) -> WIRE:
+        wire = self.encoded.get(codec.name)
+        if wire is None:
+            start = time.perf_counter()
+            wire = self.encoded[codec.name] = codec.encode(self.data)
+            Metrics.observe_stage("serialization", time.perf_counter() - start)
+        return wire
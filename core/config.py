@@ -1,4 +1,5 @@
 import os
+import socket
 from datetime import timedelta
 
 from dotenv import load_dotenv
@@ -11,3 +12,67 @@ PG_URL = os.getenv("PG_URL")
 
 TOKEN_KEY = os.getenv("TOKEN_KEY")
 TOKEN_EXPIRE = timedelta(minutes=15)
+# jwt - подписанный токен с ID пользователя и сроком, проверяется на любом узле; opaque - случайная строка,
+# известная только выдавшему ее узлу. Без TOKEN_KEY подписывать нечем - по умолчанию opaque
+TOKEN_TYPE = os.getenv("TOKEN_TYPE", "jwt" if TOKEN_KEY else "opaque")
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+
+PUBLIC_WRITE_BEHIND = os.getenv("PUBLIC_WRITE_BEHIND", "0") == "1"
+PUBLIC_QUEUE_SIZE = int(os.getenv("PUBLIC_QUEUE_SIZE", 10000))
+PUBLIC_BATCH_SIZE = int(os.getenv("PUBLIC_BATCH_SIZE", 500))
+PUBLIC_FLUSH_INTERVAL = float(os.getenv("PUBLIC_FLUSH_INTERVAL", 0.2))
+
+PASSWORD_POOL_SIZE = int(os.getenv("PASSWORD_POOL_SIZE", 2))
+PASSWORD_MAX_CONCURRENCY = int(os.getenv("PASSWORD_MAX_CONCURRENCY", 8))
+
+OUTBOX_SIZE = int(os.getenv("OUTBOX_SIZE", 256))
+OUTBOX_POLICY = os.getenv("OUTBOX_POLICY", "drop_oldest")
+
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT", 8))
+
+PING_INTERVAL = float(os.getenv("PING_INTERVAL", 20))
+PING_TIMEOUT = float(os.getenv("PING_TIMEOUT", 20))
+IDLE_TIMEOUT = float(os.getenv("IDLE_TIMEOUT", 1800))
+AUTH_TIMEOUT = float(os.getenv("AUTH_TIMEOUT", 60))
+REAP_INTERVAL = float(os.getenv("REAP_INTERVAL", 5))
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+ADMIN_IDS = {int(i) for i in os.getenv("ADMIN_IDS", "").split(",") if i.strip()}
+
+SQL_ECHO = os.getenv("SQL_ECHO", "0") == "1"
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 20))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+
+# реплики только для чтения через запятую; пусто - все запросы в PG_URL
+PG_REPLICA_URLS = [url for url in os.getenv("PG_REPLICA_URLS", "").split(",") if url]
+# сколько секунд после своей записи соединение читает с основной базы: верхняя граница отставания реплик
+READ_YOUR_WRITES = float(os.getenv("READ_YOUR_WRITES", 5))
+
+PRESENCE_LOG_SIZE = int(os.getenv("PRESENCE_LOG_SIZE", 256))
+
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", 10000))
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", 60))
+ROOM_CACHE_SIZE = int(os.getenv("ROOM_CACHE_SIZE", 10000))
+RANK_CACHE_SIZE = int(os.getenv("RANK_CACHE_SIZE", 100000))
+RANK_CACHE_TTL = float(os.getenv("RANK_CACHE_TTL", 3600))
+
+RATE_LIMIT = os.getenv("RATE_LIMIT", "1") == "1"
+
+# 0 - пакетная доставка выключена; иначе порог сообщений в секунду, с которого комната считается горячей
+ROOM_BATCH_RATE = float(os.getenv("ROOM_BATCH_RATE", 0))
+ROOM_BATCH_WINDOW = float(os.getenv("ROOM_BATCH_WINDOW", 0.025))
+ROOM_RATE_INTERVAL = float(os.getenv("ROOM_RATE_INTERVAL", 1.0))
+
+# 1 - один процесс, как раньше; больше - супервизор и воркеры на общем порту (SO_REUSEPORT)
+WORKERS = int(os.getenv("WORKERS", 1))
+BUS_PATH = os.getenv("BUS_PATH", "/tmp/demochat-bus.sock")
+
+# шина между узлами: "" - нет (один процесс), unix - воркеры одного хоста, postgres - LISTEN/NOTIFY
+# между хостами, memory - кластер из одного узла внутри процесса
+BACKPLANE = os.getenv("BACKPLANE", "unix" if WORKERS > 1 else "")
+BACKPLANE_URL = os.getenv("BACKPLANE_URL", (PG_URL or "").replace("+asyncpg", ""))
+NODE_ID = os.getenv("NODE_ID", socket.gethostname())
+HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", 2))
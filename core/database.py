@@ -1,18 +1,147 @@
-from sqlalchemy.dialects.postgresql import insert
-from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+import itertools
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Optional, AsyncIterator, Dict, List
 
-from core.config import SQLITE_URL, PG_URL
-from core.schemas import metadata, rooms
-from services.rooms.aliases import RoomAliases
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncConnection, create_async_engine
 
-engine: AsyncEngine = create_async_engine(PG_URL, echo=True)
+from core.config import SQLITE_URL, PG_URL, SQL_ECHO, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, \
+    DB_POOL_RECYCLE, PG_REPLICA_URLS, READ_YOUR_WRITES
+from core.io import request_context
+from core.metrics import Metrics
+from core.migrations import migrate
+from core.user_cash import Cash
+
+
+def _create_engine(url: str) -> AsyncEngine:
+    return create_async_engine(
+        url,
+        echo=SQL_ECHO,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+    )
+
+
+# основная база принимает все записи; реплики - только чтение из unit_of_work(read_only=True)
+engine: AsyncEngine = _create_engine(PG_URL)
+replicas: List[AsyncEngine] = [_create_engine(url) for url in PG_REPLICA_URLS]
+_next_replica = itertools.cycle(replicas)
+
+current_connection: ContextVar[Optional[AsyncConnection]] = ContextVar("current_connection", default=None)
+
+
+class ReadRouting:
+    # ID пользователя -> до какого момента (time.monotonic) его чтения идут в основную базу: после своей
+    # записи пользователь видит ее из любого своего соединения на этом узле.
+    # срок у всех одинаковый, поэтому записи упорядочены по нему и устаревшие снимаются с начала
+    recent_writes: Dict[int, float] = OrderedDict()
+
+    primary_reads: int = 0
+    replica_reads: int = 0
+    read_your_writes: int = 0
+
+    @staticmethod
+    def actor() -> Optional[int]:
+        # пользователь команды, которая выполняется в текущей задаче
+        context = request_context.get()
+        if context is None:
+            return None
+        user = Cash.online.get(context[0])
+        return user.ID if user is not None else None
+
+    @classmethod
+    def wrote(cls):
+        if not replicas:
+            return
+        user_id = cls.actor()
+        if user_id is None:
+            return
+        cls.recent_writes.pop(user_id, None)
+        cls.recent_writes[user_id] = time.monotonic() + READ_YOUR_WRITES
+
+    @classmethod
+    def engine(cls) -> AsyncEngine:
+        if not replicas:
+            cls.primary_reads += 1
+            return engine
+        now = time.monotonic()
+        while cls.recent_writes:
+            user_id, deadline = next(iter(cls.recent_writes.items()))
+            if deadline > now:
+                break
+            del cls.recent_writes[user_id]
+        user_id = cls.actor()
+        if user_id is not None and user_id in cls.recent_writes:
+            # реплика может еще не получить собственную запись пользователя
+            cls.read_your_writes += 1
+            cls.primary_reads += 1
+            return engine
+        cls.replica_reads += 1
+        return next(_next_replica)
+
+    @classmethod
+    def snapshot(cls) -> dict:
+        return {
+            "replicas": len(replicas),
+            "primary_reads": cls.primary_reads,
+            "replica_reads": cls.replica_reads,
+            "read_your_writes": cls.read_your_writes,
+            "recent_writers": len(cls.recent_writes),
+        }
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    context.started_at = time.perf_counter()
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    Metrics.observe_stage("db", time.perf_counter() - context.started_at)
+    if context.isinsert or context.isupdate or context.isdelete:
+        conn.info["wrote"] = True
+
+
+for _engine in [engine, *replicas]:
+    event.listen(_engine.sync_engine, "before_cursor_execute", _before_execute)
+    event.listen(_engine.sync_engine, "after_cursor_execute", _after_execute)
+
+
+@asynccontextmanager
+async def unit_of_work(read_only: bool = False) -> AsyncIterator[AsyncConnection]:
+    # одно соединение и одна транзакция на команду; вложенные вызовы используют то же соединение.
+    # read_only - запрос можно отдать реплике, внутри такого блока ничего не пишется
+    db = current_connection.get()
+    if db is not None:
+        yield db
+        return
+    start = time.perf_counter()
+    async with (ReadRouting.engine() if read_only else engine).connect() as db:
+        Metrics.observe_stage("db_checkout", time.perf_counter() - start)
+        # info живет вместе с DBAPI-соединением в пуле: флаг записи мог остаться от отмененной транзакции
+        db.info.pop("wrote", None)
+        token = current_connection.set(db)
+        try:
+            yield db
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+        finally:
+            current_connection.reset(token)
+        if db.info.pop("wrote", False):
+            ReadRouting.wrote()
 
 
 async def init():
+    # данные не пересоздаются: применяются только недостающие миграции
     async with engine.connect() as connection:
-        await connection.run_sync(metadata.drop_all)
-        await connection.run_sync(metadata.create_all)
-        await connection.execute(
-            insert(rooms).values({RoomAliases.title: "главная"})
-        )
-        await connection.commit()
+        await migrate(connection)
+
+
+async def dispose():
+    for _engine in [engine, *replicas]:
+        await _engine.dispose()
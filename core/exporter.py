@@ -0,0 +1,144 @@
+import asyncio
+import logging
+from typing import Optional, List
+
+from core.batching import RoomBatcher
+from core.broadcast import BroadcastStats
+from core.bus import Bus
+from core.cluster import Cluster
+from core.database import ReadRouting
+from core.cache import profiles
+from core.config import METRICS_HOST, METRICS_PORT
+from core.lifecycle import ConnectionManager
+from core.managers import PasswordService, Token
+from core.metrics import Metrics, Histogram
+from core.outbox import Outbox
+from core.ratelimit import RateLimiter
+from core.sessions import SessionStore
+from core.user_cash import Cash
+from core.writer import PublicWriter
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "demochat"
+
+
+def outbox_snapshot() -> dict:
+    depth = 0
+    max_depth = 0
+    for user in Cash.online.values():
+        depth += user.outbox.depth
+        max_depth = max(max_depth, user.outbox.depth)
+    return {
+        "depth": depth,
+        "max_depth": max_depth,
+        "dropped": Outbox.dropped_total,
+        "coalesced": Outbox.coalesced_total,
+        "evicted": Outbox.evicted_total,
+    }
+
+
+def collect() -> dict:
+    return {
+        **Metrics.snapshot(),
+        "broadcast": BroadcastStats.snapshot(),
+        "outbox": outbox_snapshot(),
+        "connections": ConnectionManager.snapshot(),
+        "password": PasswordService.snapshot(),
+        "tokens": Token.snapshot(),
+        "public_writer": PublicWriter.snapshot(),
+        "room_batcher": RoomBatcher.snapshot(),
+        "rate_limit": RateLimiter.snapshot(),
+        "profile_cache": profiles.snapshot(),
+        "sessions": SessionStore.snapshot(),
+        "bus": Bus.snapshot(),
+        "cluster": Cluster.snapshot(),
+        "db_routing": ReadRouting.snapshot(),
+    }
+
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _histogram(lines: List[str], name: str, label: str, value: str, histogram: Histogram):
+    for bound, count in histogram.cumulative():
+        lines.append(f'{name}_bucket{{{label}="{_label(value)}",le="{bound}"}} {count}')
+    lines.append(f'{name}_sum{{{label}="{_label(value)}"}} {histogram.sum}')
+    lines.append(f'{name}_count{{{label}="{_label(value)}"}} {histogram.count}')
+
+
+def _flat(lines: List[str], group: str, data: dict):
+    for key, value in data.items():
+        lines.append(f"{PREFIX}_{group}_{key} {value}")
+
+
+def render_prometheus() -> str:
+    lines: List[str] = [
+        f"# TYPE {PREFIX}_command_total counter",
+        f"# TYPE {PREFIX}_command_errors_total counter",
+        f"# TYPE {PREFIX}_command_seconds histogram",
+    ]
+    for command, count in Metrics.commands.items():
+        lines.append(f'{PREFIX}_command_total{{command="{_label(command)}"}} {count}')
+        lines.append(f'{PREFIX}_command_errors_total{{command="{_label(command)}"}} {Metrics.errors[command]}')
+    for command, histogram in Metrics.latency.items():
+        _histogram(lines, f"{PREFIX}_command_seconds", "command", command, histogram)
+    lines.append(f"# TYPE {PREFIX}_stage_seconds histogram")
+    for stage, histogram in Metrics.stages.items():
+        _histogram(lines, f"{PREFIX}_stage_seconds", "stage", stage, histogram)
+    _flat(lines, "broadcast", BroadcastStats.snapshot())
+    _flat(lines, "outbox", outbox_snapshot())
+    _flat(lines, "connections", ConnectionManager.snapshot())
+    _flat(lines, "password", PasswordService.snapshot())
+    _flat(lines, "tokens", Token.snapshot())
+    _flat(lines, "public_writer", PublicWriter.snapshot())
+    _flat(lines, "room_batcher", RoomBatcher.snapshot())
+    _flat(lines, "rate_limit", RateLimiter.snapshot())
+    _flat(lines, "profile_cache", profiles.snapshot())
+    _flat(lines, "sessions", SessionStore.snapshot())
+    _flat(lines, "bus", Bus.snapshot())
+    _flat(lines, "cluster", Cluster.snapshot())
+    _flat(lines, "db_routing", ReadRouting.snapshot())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    server: Optional[asyncio.AbstractServer] = None
+
+    @classmethod
+    async def start(cls, port: int = METRICS_PORT):
+        if cls.server is None and port:
+            cls.server = await asyncio.start_server(cls.__handle, METRICS_HOST, port)
+
+    @classmethod
+    async def stop(cls):
+        if cls.server is not None:
+            cls.server.close()
+            await cls.server.wait_closed()
+            cls.server = None
+
+    @classmethod
+    async def __handle(cls, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.split()
+            if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?")[0] == b"/metrics":
+                status, body = "200 OK", render_prometheus().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception:
+            logger.exception("ошибка отдачи метрик")
+        finally:
+            writer.close()
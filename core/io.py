@@ -1,34 +1,48 @@
 from __future__ import annotations
 
-from typing import Union, Optional
+from contextvars import ContextVar
+from typing import Union, Optional, Tuple
 
 from pydantic import BaseModel, Field
+from websockets import WebSocketServerProtocol
+
+from core.codecs import Frame
 
 IO_TYPE = Union[str, dict, list]
+REQUEST_ID = Union[int, str]
+
+# (handle сокета, ID запроса) команды, которая выполняется в текущей задаче
+request_context: ContextVar[Optional[Tuple[int, REQUEST_ID]]] = ContextVar("request_context", default=None)
+
+
+def request_id_for(socket: WebSocketServerProtocol) -> Optional[REQUEST_ID]:
+    context = request_context.get()
+    if context is not None and context[0] == id(socket):
+        return context[1]
+    return None
 
 
 class InputModel(BaseModel):
     event: str = Field(alias="@")
     payload: IO_TYPE = Field(alias="#")
     token: Optional[str] = Field(None, alias="$")
+    request_id: Optional[REQUEST_ID] = Field(None, alias="&")
 
 
 class OutputModel(InputModel):
     event: str = Field(serialization_alias="@")
     payload: Optional[IO_TYPE] = Field(serialization_alias="#")
-    # request_command: Optional[str] = Field(None, serialization_alias="$")
+    request_id: Optional[REQUEST_ID] = Field(None, serialization_alias="&")
 
 
-def output(event: str, payload: Optional[IO_TYPE] = None):
-    return OutputModel(
-        event=event,
-        payload=payload
-    ).model_dump_json(by_alias=True)
+def output(event: str, payload: Optional[IO_TYPE] = None, request_id: Optional[REQUEST_ID] = None) -> Frame:
+    data = {"@": event, "#": payload, "$": None}
+    if request_id is not None:
+        data["&"] = request_id
+    return Frame(data)
 
 
 class Error(BaseModel):
     error: str = Field(serialization_alias="!")
     payload: Optional[IO_TYPE] = Field(serialization_alias="#")
-
-
-
+    request_id: Optional[REQUEST_ID] = Field(None, serialization_alias="&")
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from websockets import WebSocketServerProtocol
+from websockets.protocol import State
+
+from core.cluster import Cluster
+from core.codecs import codec_for
+from core.config import IDLE_TIMEOUT, AUTH_TIMEOUT, REAP_INTERVAL
+from core.presence import PresenceIndex, PresenceFeed
+from core.ratelimit import RateLimiter, LimitScope
+from core.sessions import SessionStore
+from services.accounts.aliases import AccountAliases
+from core.user_cash import User, Cash, handle_of
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionManager:
+    reaper: Optional[asyncio.Task] = None
+
+    opened: int = 0
+    closed: int = 0
+    reaped_idle: int = 0
+    reaped_unauthorized: int = 0
+
+    @classmethod
+    def register(cls, socket: WebSocketServerProtocol) -> User:
+        user = User(socket=socket, codec=codec_for(socket.subprotocol))
+        Cash.online[user.handle] = user
+        cls.opened += 1
+        return user
+
+    @classmethod
+    def touch(cls, user: User):
+        user.last_seen = time.monotonic()
+
+    @classmethod
+    def unregister(cls, socket: WebSocketServerProtocol) -> bool:
+        # повторный вызов ничего не делает: соединение уже удалено из реестра
+        user = Cash.online.pop(handle_of(socket), None)
+        if user is None:
+            return False
+        SessionStore.park(user)
+        room = Cash.location.get(user.location_id)
+        if room is not None:
+            room.discard(user.handle)
+            if not room:
+                del Cash.location[user.location_id]
+                RateLimiter.forget(LimitScope.ROOM, user.location_id)
+                Cluster.leave(user.location_id)
+        if user.ID is not None:
+            Cash.detach(user)
+            # другая сессия того же пользователя могла остаться в комнате
+            if user.location_id is not None and not Cash.in_room(user.ID, user.location_id):
+                PresenceFeed.publish(user.location_id, PresenceFeed.LEAVE, {AccountAliases.ID: user.ID},
+                                     local=not Cash.in_room_elsewhere(user.ID, user.location_id))
+        if user.subscribed:
+            PresenceFeed.unsubscribe(user.location_id, user.handle)
+        RateLimiter.forget(LimitScope.SOCKET, user.handle)
+        user.pipeline.close()
+        user.outbox.close()
+        cls.closed += 1
+        return True
+
+    @classmethod
+    def start(cls):
+        if cls.reaper is None:
+            cls.reaper = asyncio.create_task(cls.__reap())
+
+    @classmethod
+    async def stop(cls):
+        if cls.reaper is not None:
+            cls.reaper.cancel()
+            try:
+                await cls.reaper
+            except asyncio.CancelledError:
+                pass
+            cls.reaper = None
+
+    @classmethod
+    def snapshot(cls) -> dict:
+        return {
+            "online": len(Cash.online),
+            "authorized": len(Cash.sessions),
+            "presence": len(PresenceIndex.users),
+            "rooms": len(Cash.location),
+            "opened": cls.opened,
+            "closed": cls.closed,
+            "reaped_idle": cls.reaped_idle,
+            "reaped_unauthorized": cls.reaped_unauthorized,
+        }
+
+    @classmethod
+    async def __reap(cls):
+        while True:
+            await asyncio.sleep(REAP_INTERVAL)
+            SessionStore.purge()
+            now = time.monotonic()
+            for user in list(Cash.online.values()):
+                # закрытие уже идет: обработчик сам уберет соединение из реестра
+                if user.socket.state is not State.OPEN:
+                    continue
+                if user.ID is None and now - user.connected_at > AUTH_TIMEOUT:
+                    cls.reaped_unauthorized += 1
+                    asyncio.create_task(user.socket.close(code=1008, reason="не авторизован"))
+                elif now - user.last_seen > IDLE_TIMEOUT:
+                    cls.reaped_idle += 1
+                    asyncio.create_task(user.socket.close(code=1001, reason="неактивен"))
+                # из реестра соединение убирает finally обработчика: уже прочитанные кадры
+                # еще дойдут до команд, и запись пользователя должна быть на месте
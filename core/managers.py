@@ -1,7 +1,18 @@
+import asyncio
 import hashlib
+import multiprocessing
 import os
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
 
 import passlib.context
+from jose import jwt, JWTError
+
+from core.cache import LRUCache
+from core.config import PASSWORD_POOL_SIZE, PASSWORD_MAX_CONCURRENCY, TOKEN_KEY, TOKEN_EXPIRE, TOKEN_TYPE, \
+    TOKEN_CACHE_SIZE
 
 
 class PasswordManager:
@@ -16,7 +27,138 @@ class PasswordManager:
         return cls.context.verify(plain, hashed)
 
 
+def _ignore_interrupt():
+    # остановкой пула управляет родительский процесс
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _timed_hash(string: str):
+    start = time.perf_counter()
+    return PasswordManager.get_hash(string), time.perf_counter() - start
+
+
+def _timed_verify(plain: str, hashed: str):
+    start = time.perf_counter()
+    return PasswordManager.verify_hash(plain, hashed), time.perf_counter() - start
+
+
+class PasswordService:
+    executor: Optional[ProcessPoolExecutor] = None
+    semaphore: Optional[asyncio.Semaphore] = None
+
+    calls: int = 0
+    waiting: int = 0
+    queue_wait_total: float = 0.0
+    queue_wait_max: float = 0.0
+    hash_time_total: float = 0.0
+    hash_time_max: float = 0.0
+
+    @classmethod
+    def start(cls):
+        if cls.executor is None:
+            # spawn: дочерние процессы не наследуют слушающий сокет сервера
+            cls.executor = ProcessPoolExecutor(max_workers=PASSWORD_POOL_SIZE,
+                                               mp_context=multiprocessing.get_context("spawn"),
+                                               initializer=_ignore_interrupt)
+            cls.semaphore = asyncio.Semaphore(PASSWORD_MAX_CONCURRENCY)
+
+    @classmethod
+    def stop(cls):
+        if cls.executor is not None:
+            cls.executor.shutdown(wait=True, cancel_futures=True)
+            cls.executor = None
+            cls.semaphore = None
+
+    @classmethod
+    async def get_hash(cls, string: str) -> str:
+        return await cls.__run(_timed_hash, string)
+
+    @classmethod
+    async def verify_hash(cls, plain: str, hashed: str) -> bool:
+        return await cls.__run(_timed_verify, plain, hashed)
+
+    @classmethod
+    def snapshot(cls) -> dict:
+        return {
+            "calls": cls.calls,
+            "waiting": cls.waiting,
+            "queue_wait_total": cls.queue_wait_total,
+            "queue_wait_max": cls.queue_wait_max,
+            "hash_time_total": cls.hash_time_total,
+            "hash_time_max": cls.hash_time_max,
+        }
+
+    @classmethod
+    async def __run(cls, func, *args):
+        cls.start()
+        enqueued = time.perf_counter()
+        cls.waiting += 1
+        try:
+            await cls.semaphore.acquire()
+        finally:
+            cls.waiting -= 1
+        try:
+            queue_wait = time.perf_counter() - enqueued
+            result, hash_time = await asyncio.get_running_loop().run_in_executor(cls.executor, func, *args)
+        finally:
+            cls.semaphore.release()
+        cls.calls += 1
+        cls.queue_wait_total += queue_wait
+        cls.hash_time_total += hash_time
+        cls.queue_wait_max = max(cls.queue_wait_max, queue_wait)
+        cls.hash_time_max = max(cls.hash_time_max, hash_time)
+        return result
+
+
 class Token:
+    # opaque - сверяется с токеном соединения; jwt - подпись HS256 над ID пользователя и сроком.
+    # подпись проверяется один раз на токен, дальше результат берется из кэша процесса
+    OPAQUE = "opaque"
+    JWT = "jwt"
+    ALGORITHM = "HS256"
+
+    kind: str = TOKEN_TYPE
+    key: Optional[str] = TOKEN_KEY
+    verified = LRUCache(TOKEN_CACHE_SIZE, TOKEN_EXPIRE.total_seconds())
+
+    checks: int = 0
+    rejected: int = 0
+
+    @classmethod
+    def generate(cls, user_id: Optional[int] = None) -> str:
+        if cls.kind == cls.OPAQUE:
+            return hashlib.md5(os.urandom(32)).hexdigest()
+        # jti: у каждого соединения свой токен, даже выданный в ту же секунду
+        claims = {
+            "sub": str(user_id),
+            "exp": int(time.time() + TOKEN_EXPIRE.total_seconds()),
+            "jti": os.urandom(8).hex(),
+        }
+        return jwt.encode(claims, cls.key, algorithm=cls.ALGORITHM)
+
+    @classmethod
+    def verify(cls, token: str) -> Optional[Tuple[int, int]]:
+        # (ID пользователя, срок в секундах unix) для действующего jwt, иначе None
+        claims = cls.verified.get(token)
+        if claims is None:
+            cls.checks += 1
+            try:
+                payload = jwt.decode(token, cls.key, algorithms=[cls.ALGORITHM])
+                claims = (int(payload["sub"]), int(payload["exp"]))
+            except (JWTError, KeyError, ValueError):
+                cls.rejected += 1
+                return None
+            cls.verified.put(token, claims)
+        elif claims[1] <= time.time():
+            cls.verified.invalidate(token)
+            cls.rejected += 1
+            return None
+        return claims
+
     @classmethod
-    def generate(cls):
-        return hashlib.md5(os.urandom(32)).hexdigest()
+    def snapshot(cls) -> dict:
+        return {
+            "checks": cls.checks,
+            "rejected": cls.rejected,
+            **cls.verified.snapshot(),
+        }
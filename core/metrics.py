@@ -0,0 +1,93 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Tuple, List
+
+BUCKETS: Tuple[float, ...] = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    __slots__ = ["counts", "sum", "count"]
+
+    def __init__(self):
+        self.counts: List[int] = [0] * (len(BUCKETS) + 1)
+        self.sum: float = 0.0
+        self.count: int = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        result = []
+        total = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            total += count
+            result.append((repr(bound), total))
+        result.append(("+Inf", self.count))
+        return result
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "avg": self.sum / self.count if self.count else 0.0,
+            "buckets": dict(self.cumulative()),
+        }
+
+
+class Metrics:
+    commands: Dict[str, int] = {}
+    errors: Dict[str, int] = {}
+    latency: Dict[str, Histogram] = {}
+    # db - время запросов, db_checkout - ожидание соединения из пула,
+    # broadcast_enqueue - постановка кадра в очереди всех получателей рассылки,
+    # delivery - от постановки кадра в очередь получателя до завершения отправки в его сокет,
+    # serialization - кодирование исходящих кадров
+    stages: Dict[str, Histogram] = {
+        "db": Histogram(),
+        "db_checkout": Histogram(),
+        "broadcast_enqueue": Histogram(),
+        "delivery": Histogram(),
+        "serialization": Histogram(),
+    }
+
+    @classmethod
+    def observe_command(cls, command: str, elapsed: float, failed: bool):
+        histogram = cls.latency.get(command)
+        if histogram is None:
+            histogram = cls.latency[command] = Histogram()
+            cls.commands[command] = 0
+            cls.errors[command] = 0
+        histogram.observe(elapsed)
+        cls.commands[command] += 1
+        if failed:
+            cls.errors[command] += 1
+
+    @classmethod
+    def observe_stage(cls, stage: str, elapsed: float):
+        cls.stages[stage].observe(elapsed)
+
+    @classmethod
+    @contextmanager
+    def measure(cls, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            cls.stages[stage].observe(time.perf_counter() - start)
+
+    @classmethod
+    def snapshot(cls) -> dict:
+        return {
+            "commands": {
+                command: {
+                    "count": cls.commands[command],
+                    "errors": cls.errors[command],
+                    "latency": histogram.snapshot(),
+                }
+                for command, histogram in cls.latency.items()
+            },
+            "stages": {stage: histogram.snapshot() for stage, histogram in cls.stages.items()},
+        }
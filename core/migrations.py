@@ -0,0 +1,243 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, NamedTuple
+
+from sqlalchemy import select, func, insert, inspect, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from core.schemas import schema_version
+
+logger = logging.getLogger(__name__)
+
+# один ключ на все процессы: миграции применяет только один из одновременно стартующих
+ADVISORY_LOCK = 0x64656d6f
+LOCK_RETRY = 0.2
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable[[AsyncConnection], Awaitable[None]]
+    # False - шаг выполняется вне транзакции (в Postgres CREATE INDEX CONCURRENTLY иначе не работает)
+    transaction: bool = True
+
+
+# DDL шагов записан явно, а не взят из core.schemas: примененная миграция не должна меняться
+# вместе с моделью. Новые таблицы и колонки - только новыми шагами в конце MIGRATIONS
+DIALECT_TYPES: Dict[str, Dict[str, str]] = {
+    "postgresql": {
+        "serial": "SERIAL", "timestamp": "TIMESTAMP WITHOUT TIME ZONE", "rank": "localranks",
+        "concurrently": "CONCURRENTLY",
+    },
+    "sqlite": {"serial": "INTEGER", "timestamp": "DATETIME", "rank": "VARCHAR(9)", "concurrently": ""},
+}
+
+# в Postgres Enum(LocalRanks) - собственный тип; CREATE TYPE не поддерживает IF NOT EXISTS
+RANK_TYPE = """
+DO $$ BEGIN
+    CREATE TYPE localranks AS ENUM ('OWNER', 'MODERATOR', 'USER', 'BANNED');
+EXCEPTION WHEN duplicate_object THEN NULL;
+END $$
+"""
+
+SCHEMA_VERSION = """
+CREATE TABLE IF NOT EXISTS schema_version (
+    version INTEGER NOT NULL,
+    description VARCHAR(128) NOT NULL,
+    applied_at {timestamp} NOT NULL,
+    PRIMARY KEY (version)
+)
+"""
+
+BASE_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS accounts (
+        user_id {serial} NOT NULL,
+        nickname VARCHAR(16) NOT NULL,
+        password VARCHAR(100) NOT NULL,
+        created_at DATE NOT NULL,
+        PRIMARY KEY (user_id),
+        UNIQUE (nickname)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS rooms (
+        room_id {serial} NOT NULL,
+        title VARCHAR(24) NOT NULL,
+        created_at DATE NOT NULL,
+        PRIMARY KEY (room_id),
+        UNIQUE (title)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS locations (
+        user_id INTEGER NOT NULL,
+        room_id INTEGER,
+        FOREIGN KEY(user_id) REFERENCES accounts (user_id) ON DELETE CASCADE ON UPDATE CASCADE,
+        FOREIGN KEY(room_id) REFERENCES rooms (room_id) ON DELETE CASCADE ON UPDATE CASCADE
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS local_ranks (
+        user_id INTEGER NOT NULL,
+        room_id INTEGER NOT NULL,
+        local_rank {rank},
+        FOREIGN KEY(user_id) REFERENCES accounts (user_id) ON DELETE CASCADE ON UPDATE CASCADE,
+        FOREIGN KEY(room_id) REFERENCES rooms (room_id) ON DELETE CASCADE ON UPDATE CASCADE
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS public (
+        message_id {serial} NOT NULL,
+        creator INTEGER NOT NULL,
+        room_id INTEGER NOT NULL,
+        text VARCHAR(128) NOT NULL,
+        created_at {timestamp} NOT NULL,
+        PRIMARY KEY (message_id),
+        FOREIGN KEY(creator) REFERENCES accounts (user_id) ON DELETE NO ACTION ON UPDATE CASCADE,
+        FOREIGN KEY(room_id) REFERENCES rooms (room_id) ON DELETE NO ACTION ON UPDATE CASCADE
+    )
+    """,
+    # главная комната нужна с первого запуска: в нее попадают новые пользователи
+    """
+    INSERT INTO rooms (title, created_at)
+    SELECT 'главная', CURRENT_DATE
+    WHERE NOT EXISTS (SELECT 1 FROM rooms WHERE title = 'главная')
+    """,
+)
+
+# индексы строятся на живых таблицах: в Postgres - CONCURRENTLY, без блокировки записи на время сборки
+LOOKUP_INDEXES: Dict[str, str] = {
+    "ix_locations_user": "CREATE INDEX {concurrently} IF NOT EXISTS {name} ON locations (user_id)",
+    "ux_local_ranks_user_room":
+        "CREATE UNIQUE INDEX {concurrently} IF NOT EXISTS {name} ON local_ranks (user_id, room_id)",
+    "ix_public_room_created":
+        "CREATE INDEX {concurrently} IF NOT EXISTS {name} ON public (room_id, created_at, message_id)",
+}
+
+# прерванная сборка CONCURRENTLY оставляет невалидный индекс, а IF NOT EXISTS его бы пропустил
+INVALID_INDEXES = """
+SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+WHERE NOT i.indisvalid AND c.relname = ANY(:names)
+"""
+
+LOCAL_RANK_DUPLICATES = """
+SELECT user_id, room_id, count(*) FROM local_ranks
+GROUP BY user_id, room_id HAVING count(*) > 1
+ORDER BY user_id, room_id LIMIT 10
+"""
+
+
+def _types(db: AsyncConnection) -> Dict[str, str]:
+    types = DIALECT_TYPES.get(db.dialect.name)
+    if types is None:
+        raise RuntimeError(f"миграции не описаны для {db.dialect.name}")
+    return types
+
+
+def _execute(*statements: str) -> Callable[[AsyncConnection], Awaitable[None]]:
+    async def apply(db: AsyncConnection):
+        types = _types(db)
+        for statement in statements:
+            await db.execute(text(statement.format(**types)))
+    return apply
+
+
+def _duplicate_ranks(duplicates) -> RuntimeError:
+    pairs = ", ".join(f"({user_id}, {room_id}) x{count}" for user_id, room_id, count in duplicates)
+    return RuntimeError(
+        "в local_ranks повторяются пары (user_id, room_id): "
+        f"{pairs or 'добавлены во время сборки'}. Уникальный индекс ux_local_ranks_user_room не создан - "
+        "оставьте по одной строке на пару и перезапустите миграцию"
+    )
+
+
+async def _lookup_indexes(db: AsyncConnection):
+    types = _types(db)
+    if db.dialect.name == "postgresql":
+        cursor = await db.execute(text(INVALID_INDEXES), {"names": list(LOOKUP_INDEXES)})
+        for name in cursor.scalars().all():
+            logger.warning("индекс %s остался невалидным после прерванной сборки, пересоздается", name)
+            await db.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+    duplicates = (await db.execute(text(LOCAL_RANK_DUPLICATES))).all()
+    if duplicates:
+        raise _duplicate_ranks(duplicates)
+    for name, statement in LOOKUP_INDEXES.items():
+        try:
+            await db.execute(text(statement.format(name=name, **types)))
+        except IntegrityError as e:
+            # дубли могли появиться уже после проверки
+            raise _duplicate_ranks((await db.execute(text(LOCAL_RANK_DUPLICATES))).all()) from e
+
+
+async def _base_schema(db: AsyncConnection):
+    # таблицы могли остаться от прежнего запуска с create_all - создаем только недостающие
+    if db.dialect.name == "postgresql":
+        await db.execute(text(RANK_TYPE))
+    await _execute(*BASE_SCHEMA)(db)
+
+
+# только дописывать в конец: примененные шаги не меняются
+MIGRATIONS: List[Migration] = [
+    Migration(1, "base schema", _base_schema),
+    Migration(2, "lookup indexes", _lookup_indexes, transaction=False),
+]
+
+
+async def current_version(db: AsyncConnection) -> int:
+    has_table = await db.run_sync(lambda sync: inspect(sync).has_table(schema_version.name))
+    if not has_table:
+        return 0
+    cursor = await db.execute(select(func.max(schema_version.c.version)))
+    return cursor.scalar() or 0
+
+
+async def migrate(db: AsyncConnection):
+    # быстрый путь при старте: одна проверка каталога и max(version), без чтения самих таблиц
+    start = time.perf_counter()
+    version = await current_version(db)
+    await db.commit()
+    if version >= MIGRATIONS[-1].version:
+        logger.info("схема актуальна (версия %d), проверка %.1f мс", version, (time.perf_counter() - start) * 1000)
+        return
+    postgres = db.dialect.name == "postgresql"
+    if postgres:
+        # блокировка ждется вне транзакции, а не в pg_advisory_lock: CREATE INDEX CONCURRENTLY ждет все
+        # транзакции со снимками старше своего, и с ожидающим процессом получилась бы взаимоблокировка
+        while not (await db.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": ADVISORY_LOCK})).scalar():
+            await db.commit()
+            await asyncio.sleep(LOCK_RETRY)
+    try:
+        await db.execute(text(SCHEMA_VERSION.format(**_types(db))))
+        await db.commit()
+        version = await current_version(db)  # другой процесс мог применить шаги, пока мы ждали блокировку
+        await db.commit()
+        for migration in MIGRATIONS:
+            if migration.version <= version:
+                continue
+            # каждый шаг вместе с записью о нем - в своей транзакции; шаг без транзакции после сбоя
+            # применяется заново целиком, поэтому он обязан быть повторяемым
+            autocommit = postgres and not migration.transaction
+            if autocommit:
+                await db.execution_options(isolation_level="AUTOCOMMIT")
+            try:
+                await migration.apply(db)
+            finally:
+                if autocommit:
+                    # в базе откатывать нечего - закрывается только транзакция SQLAlchemy, иначе уровень не сменить
+                    await db.rollback()
+                    await db.execution_options(isolation_level=db.default_isolation_level)
+            await db.execute(
+                insert(schema_version).values(version=migration.version, description=migration.description)
+            )
+            await db.commit()
+            logger.info("применена миграция %d: %s", migration.version, migration.description)
+    except BaseException:
+        await db.rollback()
+        raise
+    finally:
+        if postgres:
+            await db.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": ADVISORY_LOCK})
+            await db.commit()
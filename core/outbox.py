@@ -0,0 +1,127 @@
+import asyncio
+import time
+from collections import deque
+from enum import Enum
+from typing import Optional, Deque, Tuple, Hashable
+
+from websockets import WebSocketServerProtocol
+
+from core.codecs import Codec, Frame, json_codec
+from core.config import OUTBOX_SIZE, OUTBOX_POLICY
+from core.metrics import Metrics
+
+
+class OverflowPolicy(str, Enum):
+    DROP_OLDEST = "drop_oldest"
+    COALESCE = "coalesce"
+    DISCONNECT = "disconnect"
+
+
+class Outbox:
+    __slots__ = [
+        "socket",
+        "codec",
+        "size",
+        "policy",
+        "queue",
+        "task",
+        "closed",
+        "sent",
+        "dropped",
+        "coalesced",
+        "max_depth",
+    ]
+
+    dropped_total: int = 0
+    coalesced_total: int = 0
+    evicted_total: int = 0
+
+    def __init__(self,
+                 socket: WebSocketServerProtocol,
+                 codec: Codec = json_codec,
+                 size: int = OUTBOX_SIZE,
+                 policy: OverflowPolicy = OverflowPolicy(OUTBOX_POLICY)):
+        self.socket = socket
+        self.codec = codec
+        self.size = size
+        self.policy = policy
+        # очередь создается на первый кадр и отпускается, когда опустеет: простаивающее соединение ее не держит.
+        # элемент - (ключ слияния, кадр, время постановки для метрики доставки)
+        self.queue: Optional[Deque[Tuple[Optional[Hashable], Frame, float]]] = None
+        self.task: Optional[asyncio.Task] = None
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+
+    @property
+    def depth(self) -> int:
+        return len(self.queue) if self.queue is not None else 0
+
+    def put(self, frame: Frame, key: Optional[Hashable] = None) -> bool:
+        if self.closed:
+            return False
+        if self.queue is None:
+            self.queue = deque()
+        if len(self.queue) >= self.size:
+            if self.policy is OverflowPolicy.DISCONNECT:
+                self.__evict()
+                return False
+            if self.policy is OverflowPolicy.COALESCE and key is not None and self.__coalesce(frame, key):
+                return True
+            self.queue.popleft()
+            self.dropped += 1
+            Outbox.dropped_total += 1
+        self.queue.append((key, frame, time.perf_counter()))
+        if len(self.queue) > self.max_depth:
+            self.max_depth = len(self.queue)
+        if self.task is None:
+            # писатель живет только пока есть что отправлять
+            self.task = asyncio.create_task(self.__drain())
+        return True
+
+    def close(self):
+        self.closed = True
+        self.queue = None
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def snapshot(self) -> dict:
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+        }
+
+    def __evict(self):
+        self.close()
+        Outbox.evicted_total += 1
+        asyncio.create_task(self.socket.close(code=1013, reason="slow consumer"))
+
+    def __coalesce(self, frame: Frame, key: Hashable) -> bool:
+        # заменяем еще не отправленный кадр с тем же ключом на свежий
+        for i, (queued_key, _, enqueued_at) in enumerate(self.queue):
+            if queued_key == key:
+                self.queue[i] = (key, frame, enqueued_at)
+                self.coalesced += 1
+                Outbox.coalesced_total += 1
+                return True
+        return False
+
+    async def __drain(self):
+        try:
+            while self.queue:
+                _, frame, enqueued_at = self.queue.popleft()
+                await self.socket.send(frame.encode(self.codec))
+                self.sent += 1
+                Metrics.observe_stage("delivery", time.perf_counter() - enqueued_at)
+        except Exception:
+            # соединение закрыто - очередь больше не нужна, чистка при отключении
+            self.closed = True
+        finally:
+            self.task = None
+            self.queue = None
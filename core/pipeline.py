@@ -0,0 +1,76 @@
+import asyncio
+from typing import Callable, Awaitable, Optional, Set
+
+from core.config import MAX_IN_FLIGHT
+
+
+class Pipeline:
+    # на каждое соединение, поэтому без Semaphore и постоянного множества задач:
+    # счетчик, один ожидающий future и множество, которое живет только пока есть команды
+    __slots__ = ["limit", "in_flight", "waiter", "tail", "tasks", "closed"]
+
+    def __init__(self, limit: int = MAX_IN_FLIGHT):
+        self.limit = limit
+        self.in_flight = 0
+        self.waiter: Optional[asyncio.Future] = None
+        self.tail: Optional[asyncio.Future] = None
+        self.tasks: Optional[Set[asyncio.Task]] = None
+        self.closed = False
+
+    async def submit(self, func: Callable[[], Awaitable], ordered: bool = False):
+        # при исчерпании лимита перестаем читать сокет - клиент упирается в TCP-окно.
+        # submit вызывает только читающий цикл сокета, поэтому ожидающий всегда один
+        while self.in_flight >= self.limit and not self.closed:
+            self.waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+        if self.closed:
+            # соединение закрыто, пока читающий цикл ждал: команду не запускаем
+            return
+        self.in_flight += 1
+        previous = done = None
+        if ordered:
+            # упорядоченные команды одного сокета выполняются строго друг за другом
+            previous = self.tail
+            done = self.tail = asyncio.get_running_loop().create_future()
+        task = asyncio.create_task(self.__run(func, previous, done))
+        if self.tasks is None:
+            self.tasks = set()
+        self.tasks.add(task)
+        task.add_done_callback(self.__discard)
+
+    def close(self):
+        self.closed = True
+        if self.tasks is not None:
+            for task in self.tasks:
+                task.cancel()
+            self.tasks = None
+        # ожидающего будим, а не отменяем: CancelledError вылетел бы из читающего цикла обработчика
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+        self.tail = None
+
+    def __discard(self, task: asyncio.Task):
+        if self.tasks is not None:
+            self.tasks.discard(task)
+            if not self.tasks:
+                self.tasks = None
+
+    async def __run(self, func: Callable[[], Awaitable],
+                    previous: Optional[asyncio.Future],
+                    done: Optional[asyncio.Future]):
+        try:
+            if previous is not None:
+                await previous
+            await func()
+        finally:
+            self.in_flight -= 1
+            if self.waiter is not None and not self.waiter.done():
+                self.waiter.set_result(None)
+            if done is not None:
+                if not done.done():
+                    done.set_result(None)
+                if self.tail is done:
+                    self.tail = None
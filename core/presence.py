@@ -0,0 +1,179 @@
+import os
+import uuid
+from bisect import bisect_left, insort
+from collections import deque
+from typing import Dict, List, Tuple, Optional, Deque
+
+from core.bus import Bus
+from core.config import PRESENCE_LOG_SIZE
+from core.io import output, REQUEST_ID
+from core.outbox import Outbox
+
+USER_ID = int
+ROOM_ID = int
+HANDLE = int
+ENTRY = Tuple[str, USER_ID]
+
+_MAX_CHAR = chr(0x10FFFF)
+
+
+class PresenceIndex:
+    # авторизованные пользователи онлайн, отсортированные по нику: общий список и по комнатам
+    everyone: List[ENTRY] = []
+    rooms: Dict[ROOM_ID, List[ENTRY]] = {}
+    users: Dict[USER_ID, Tuple[str, str, Optional[ROOM_ID]]] = {}
+
+    @staticmethod
+    def key(nickname: str) -> str:
+        # ники обычно уже в нижнем регистре - тогда ключ и ник одна строка, а не две
+        key = nickname.casefold()
+        return nickname if key == nickname else key
+
+    @classmethod
+    def update(cls, user_id: USER_ID, nickname: str, room_id: Optional[ROOM_ID]) -> bool:
+        current = cls.users.get(user_id)
+        if current is not None and current[1] == nickname and current[2] == room_id:
+            return False
+        cls.remove(user_id)
+        entry = (cls.key(nickname), user_id)
+        insort(cls.everyone, entry)
+        if room_id is not None:
+            insort(cls.rooms.setdefault(room_id, []), entry)
+        cls.users[user_id] = (entry[0], nickname, room_id)
+        return True
+
+    @classmethod
+    def remove(cls, user_id: USER_ID):
+        current = cls.users.pop(user_id, None)
+        if current is None:
+            return
+        entry = (current[0], user_id)
+        cls.__discard(cls.everyone, entry)
+        room_id = current[2]
+        if room_id is not None:
+            room = cls.rooms[room_id]
+            cls.__discard(room, entry)
+            if not room:
+                del cls.rooms[room_id]
+
+    @classmethod
+    def page(cls,
+             room_id: Optional[ROOM_ID] = None,
+             prefix: Optional[str] = None,
+             skip: int = 0,
+             limit: int = 50) -> List[Tuple[USER_ID, str, Optional[ROOM_ID]]]:
+        entries = cls.everyone if room_id is None else cls.rooms.get(room_id, [])
+        if prefix:
+            prefix = cls.key(prefix)
+            lo = bisect_left(entries, (prefix,))
+            hi = bisect_left(entries, (prefix + _MAX_CHAR,))
+        else:
+            lo, hi = 0, len(entries)
+        start = lo + skip
+        end = min(start + limit, hi)
+        result = []
+        for _, user_id in entries[start:end] if start < end else ():
+            _, nickname, location = cls.users[user_id]
+            result.append((user_id, nickname, location))
+        return result
+
+    @staticmethod
+    def __discard(entries: List[ENTRY], entry: ENTRY):
+        i = bisect_left(entries, entry)
+        if i < len(entries) and entries[i] == entry:
+            del entries[i]
+
+
+class PresenceFeed:
+    # версионированная лента изменений состава комнат: снимок при подписке, дальше только дельты
+    # версии считает каждый воркер сам: после переподключения к другому воркеру или узлу номер версии
+    # клиента ничего не значит. Эпоха отличает ленты процессов, клиенту чужой эпохи - только снимок
+    epoch: str = uuid.uuid4().hex
+    versions: Dict[ROOM_ID, int] = {}
+    logs: Dict[ROOM_ID, Deque[dict]] = {}
+    subscribers: Dict[ROOM_ID, Dict[HANDLE, Outbox]] = {}
+
+    JOIN = "join"
+    LEAVE = "leave"
+    RANK = "rank"
+
+    @classmethod
+    def publish(cls, room_id: ROOM_ID, op: str, member: dict, local: bool = True):
+        # local=False - для клиентов этого узла состав не изменился: пользователь в комнате через другой узел
+        if local:
+            cls.apply(room_id, op, member)
+        # у каждого воркера своя лента и свои версии: дельта применяется к ним, а не пересылается готовой
+        Bus.publish("presence delta", room=room_id, change=op, member=member)
+
+    @classmethod
+    def apply(cls, room_id: ROOM_ID, op: str, member: dict):
+        version = cls.versions.get(room_id, 0) + 1
+        cls.versions[room_id] = version
+        delta = {"room_id": room_id, "epoch": cls.epoch, "version": version, "op": op, "member": member}
+        log = cls.logs.get(room_id)
+        if log is None:
+            log = cls.logs[room_id] = deque(maxlen=PRESENCE_LOG_SIZE)
+        log.append(delta)
+        subscribers = cls.subscribers.get(room_id)
+        if subscribers:
+            frame = output("presence delta", delta)
+            for outbox in subscribers.values():
+                outbox.put(frame)
+
+    @classmethod
+    def subscribe(cls, room_id: ROOM_ID, handle: HANDLE, outbox: Outbox, members: List[dict],
+                  request_id: Optional[REQUEST_ID] = None):
+        cls.subscribers.setdefault(room_id, {})[handle] = outbox
+        cls.__snapshot(room_id, outbox, members, request_id)
+
+    @classmethod
+    def unsubscribe(cls, room_id: ROOM_ID, handle: HANDLE):
+        subscribers = cls.subscribers.get(room_id)
+        if subscribers is not None:
+            subscribers.pop(handle, None)
+            if not subscribers:
+                del cls.subscribers[room_id]
+
+    @classmethod
+    def resync(cls, room_id: ROOM_ID, outbox: Outbox, epoch: Optional[str], version: int, members: List[dict],
+               request_id: Optional[REQUEST_ID] = None):
+        current = cls.versions.get(room_id, 0)
+        log = cls.logs.get(room_id, ())
+        if epoch != cls.epoch:
+            deltas = None
+        elif version == current:
+            deltas = []
+        elif 0 <= version < current and log and log[0]["version"] <= version + 1:
+            deltas = [delta for delta in log if delta["version"] > version]
+        else:
+            deltas = None
+        if deltas is None:
+            # версия из другой эпохи или клиент отстал сильнее, чем хранится в журнале - отдаем снимок
+            cls.__snapshot(room_id, outbox, members, request_id)
+            return
+        outbox.put(output("presence deltas", {
+            "room_id": room_id,
+            "epoch": cls.epoch,
+            "version": current,
+            "deltas": deltas
+        }, request_id))
+
+    @classmethod
+    def __snapshot(cls, room_id: ROOM_ID, outbox: Outbox, members: List[dict], request_id: Optional[REQUEST_ID]):
+        outbox.put(
+            output("presence snapshot", {
+                "room_id": room_id,
+                "epoch": cls.epoch,
+                "version": cls.versions.get(room_id, 0),
+                "members": members
+            }, request_id),
+            key=("presence snapshot", room_id)
+        )
+
+
+def _new_epoch():
+    PresenceFeed.epoch = uuid.uuid4().hex
+
+
+# воркеры - форки супервизора: эпоха, выбранная при импорте, была бы у всех одна
+os.register_at_fork(after_in_child=_new_epoch)
@@ -0,0 +1,112 @@
+import time
+from enum import Enum
+from typing import Dict, Hashable, NamedTuple, Optional, Tuple
+
+
+class LimitScope(str, Enum):
+    SOCKET = "socket"
+    USER = "user"
+    ROOM = "room"
+
+
+class Limit(NamedTuple):
+    scope: LimitScope
+    rate: float  # пополнение, токенов в секунду
+    burst: float  # емкость ведра
+
+
+class TokenBucket:
+    __slots__ = ["tokens", "updated"]
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated = now
+
+    def refill(self, rate: float, burst: float, now: float) -> bool:
+        # только пополнение: есть ли токен, без списания
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        return self.tokens >= 1
+
+
+class RateLimiter:
+    # ведра живут, пока жив их владелец: сокет, пользователь онлайн или непустая комната
+    FRAME = "*"  # ведро сокета для сырых кадров: проверяется до разбора
+
+    limits: Dict[str, Tuple[Limit, ...]] = {}
+    default: Tuple[Limit, ...] = ()
+    frame: Optional[Limit] = None
+    buckets: Dict[LimitScope, Dict[Hashable, Dict[str, TokenBucket]]] = {scope: {} for scope in LimitScope}
+
+    allowed: int = 0
+    rejected: Dict[str, int] = {}
+
+    @classmethod
+    def configure(cls,
+                  limits: Dict[str, Tuple[Limit, ...]],
+                  default: Tuple[Limit, ...] = (),
+                  frame: Optional[Limit] = None):
+        cls.limits = limits
+        cls.default = default
+        cls.frame = frame
+
+    @classmethod
+    def allow_frame(cls, handle: Hashable) -> bool:
+        # флуд отсекается до декодирования и валидации: имя команды здесь еще неизвестно
+        if cls.frame is None:
+            return True
+        now = time.monotonic()
+        bucket = cls.__bucket(LimitScope.SOCKET, handle, cls.FRAME, cls.frame, now)
+        if not bucket.refill(cls.frame.rate, cls.frame.burst, now):
+            cls.rejected[cls.FRAME] = cls.rejected.get(cls.FRAME, 0) + 1
+            return False
+        bucket.tokens -= 1
+        return True
+
+    @classmethod
+    def allow(cls, command: str, handle: Hashable, user_id: Optional[int], room_id: Optional[int]) -> bool:
+        now = time.monotonic()
+        # токены списываются, только если есть во всех ведрах: отказ по комнате не тратит лимит сокета
+        buckets = []
+        for limit in cls.limits.get(command, cls.default):
+            if limit.scope is LimitScope.SOCKET:
+                key = handle
+            elif limit.scope is LimitScope.USER:
+                key = user_id
+            else:
+                key = room_id
+            if key is None:
+                continue
+            bucket = cls.__bucket(limit.scope, key, command, limit, now)
+            if not bucket.refill(limit.rate, limit.burst, now):
+                cls.rejected[command] = cls.rejected.get(command, 0) + 1
+                return False
+            buckets.append(bucket)
+        for bucket in buckets:
+            bucket.tokens -= 1
+        cls.allowed += 1
+        return True
+
+    @classmethod
+    def __bucket(cls, scope: LimitScope, key: Hashable, name: str, limit: Limit, now: float) -> TokenBucket:
+        owner = cls.buckets[scope].get(key)
+        if owner is None:
+            owner = cls.buckets[scope][key] = {}
+        bucket = owner.get(name)
+        if bucket is None:
+            bucket = owner[name] = TokenBucket(limit.burst, now)
+        return bucket
+
+    @classmethod
+    def forget(cls, scope: LimitScope, key: Hashable):
+        cls.buckets[scope].pop(key, None)
+
+    @classmethod
+    def snapshot(cls) -> dict:
+        return {
+            "allowed": cls.allowed,
+            "rejected": sum(cls.rejected.values()),
+            "sockets": len(cls.buckets[LimitScope.SOCKET]),
+            "users": len(cls.buckets[LimitScope.USER]),
+            "rooms": len(cls.buckets[LimitScope.ROOM]),
+        }
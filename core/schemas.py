@@ -2,7 +2,7 @@ from __future__ import annotations
 
 import datetime
 
-from sqlalchemy import Table, MetaData, Column, String, Integer, Date, ForeignKey, Enum, DateTime
+from sqlalchemy import Table, MetaData, Column, String, Integer, Date, ForeignKey, Enum, DateTime, Index
 
 from services.accounts.aliases import AccountAliases
 from services.messages.aliases import PublicAliases
@@ -15,7 +15,7 @@ accounts = Table(
     Column(AccountAliases.ID, Integer, primary_key=True, autoincrement=True),
     Column(AccountAliases.nickname, String(16), unique=True, nullable=False),
     Column(AccountAliases.password, String(100), nullable=False),
-    Column(AccountAliases.created_at, Date, nullable=False, default=datetime.date.today())
+    Column(AccountAliases.created_at, Date, nullable=False, default=datetime.date.today)
 )
 
 rooms = Table(
@@ -23,7 +23,7 @@ rooms = Table(
     metadata,
     Column(RoomAliases.ID, Integer, primary_key=True, autoincrement=True),
     Column(RoomAliases.title, String(24), unique=True, nullable=False),
-    Column(RoomAliases.created_at, Date, nullable=False, default=datetime.date.today())
+    Column(RoomAliases.created_at, Date, nullable=False, default=datetime.date.today)
 )
 
 locations = Table(
@@ -48,5 +48,23 @@ public = Table(
     Column(PublicAliases.creator, ForeignKey(accounts.c[AccountAliases.ID], onupdate="CASCADE", ondelete="NO ACTION"), nullable=False),
     Column(PublicAliases.room, ForeignKey(rooms.c[RoomAliases.ID], onupdate="CASCADE", ondelete="NO ACTION"), nullable=False),
     Column(PublicAliases.text, String(128), nullable=False),
-    Column(PublicAliases.created_at, DateTime, nullable=False, default=datetime.datetime.now())
+    Column(PublicAliases.created_at, DateTime, nullable=False, default=datetime.datetime.now)
+)
+
+schema_version = Table(
+    "schema_version",
+    metadata,
+    Column("version", Integer, primary_key=True, autoincrement=False),
+    Column("description", String(128), nullable=False),
+    Column("applied_at", DateTime, nullable=False, default=datetime.datetime.now)
+)
+
+Index("ix_locations_user", locations.c[AccountAliases.ID])
+Index("ux_local_ranks_user_room", local_ranks.c[AccountAliases.ID], local_ranks.c[RoomAliases.ID], unique=True)
+# покрывает и выборку (room_id, created_at), и keyset-пагинацию истории по (created_at, message_id)
+Index(
+    "ix_public_room_created",
+    public.c[PublicAliases.room],
+    public.c[PublicAliases.created_at],
+    public.c[PublicAliases.ID]
 )
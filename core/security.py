@@ -1,17 +1,55 @@
 import functools
+import time
 from typing import Callable
 
 from pydantic import BaseModel
 from websockets import WebSocketServerProtocol
 
+from core.broadcast import send
+from core.config import TOKEN_EXPIRE
+from core.managers import Token
+from core.sessions import SessionStore
 from events.exc import NonAuthorized
-from core.user_cash import Cash
+from events.outputs import NewToken
+from core.user_cash import Cash, User
+from services.accounts.models import AuthModelOut
+
+
+def authorized(user: User, token: str) -> bool:
+    # только проверка, без побочных эффектов: ротация - в renew после команды
+    if token == user.token:
+        current = True
+    elif token is not None and token == user.previous_token:
+        current = False
+    else:
+        # токен привязан к соединению: отданный при ротации, забранный Resume или чужой не принимается
+        return False
+    if Token.kind == Token.OPAQUE:
+        return True
+    claims = Token.verify(token)
+    if claims is None or claims[0] != user.ID:
+        return False
+    if current:
+        # клиент перешел на новый токен - старый больше не нужен
+        user.previous_token = None
+    return True
+
+
+def renew(user: User):
+    # у jwt есть срок: активному соединению выдаем новый токен, пока текущий еще действует
+    if Token.kind == Token.OPAQUE or user.token is None or user.ID is None:
+        return
+    claims = Token.verify(user.token)
+    if claims is not None and claims[1] - time.time() >= TOKEN_EXPIRE.total_seconds() / 2:
+        return
+    SessionStore.rotate(user, Token.generate(user.ID))
+    send(user.socket, NewToken().frame(AuthModelOut(token=user.token)))
 
 
 def protected(func: Callable):
     @functools.wraps(func)
     def wrapper(_, socket: WebSocketServerProtocol, model: BaseModel, token: str):
-        if not token or not isinstance(token, str) or Cash.online[socket.id].token != token:
+        if not token or not isinstance(token, str) or not authorized(Cash.user(socket), token):
             raise NonAuthorized()
         result = func(_, socket, model, token)
         return result
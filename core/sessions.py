@@ -0,0 +1,169 @@
+import asyncio
+import time
+from typing import Dict, Optional
+
+from core.bus import Bus
+from core.cluster import Cluster, NODE
+from core.config import TOKEN_EXPIRE
+from core.user_cash import Cash, User, USER_ID
+from services.rooms.aliases import LocalRanks
+
+
+class Session:
+    __slots__ = ["user_id", "nickname", "location_id", "local_rank", "expires_at", "node"]
+
+    def __init__(self, user: Optional[User] = None, node: Optional[NODE] = None):
+        self.user_id: Optional[USER_ID] = None
+        self.nickname: Optional[str] = None
+        self.location_id: Optional[int] = None
+        self.local_rank: Optional[LocalRanks] = None
+        self.expires_at: float = 0.0
+        # узел, выдавший сессию: только он знает, живо ли ее соединение, и только он ее вычищает,
+        # пока остается в кластере
+        self.node: NODE = Bus.node if node is None else node
+        if user is not None:
+            self.update(user)
+
+    def update(self, user: User):
+        self.user_id = user.ID
+        self.nickname = user.nickname
+        self.location_id = user.location_id
+        self.local_rank = user.local_rank
+        self.expires_at = time.monotonic() + TOKEN_EXPIRE.total_seconds()
+
+    @property
+    def local(self) -> bool:
+        return self.node == Bus.node
+
+    def state(self, token: str) -> dict:
+        # часы time.monotonic у хостов разные: передается остаток срока, приемник отсчитывает его по своим
+        return dict(token=token, user=self.user_id, nickname=self.nickname,
+                    room=self.location_id, rank=self.local_rank, ttl=self.expires_at - time.monotonic())
+
+    def share(self, token: str):
+        # копия для остальных воркеров: переподключение может попасть на любой из них
+        Bus.publish("session", **self.state(token))
+
+
+class SessionStore:
+    # токен сессии -> состояние пользователя; переподключение по токену без проверки пароля.
+    # у каждого соединения пользователя свой токен, он меняется при каждом входе и восстановлении
+    sessions: Dict[str, Session] = {}
+
+    resumed: int = 0
+    rejected: int = 0
+    expired: int = 0
+
+    @classmethod
+    def issue(cls, user: User):
+        session = cls.sessions[user.token] = Session(user)
+        session.share(user.token)
+
+    @classmethod
+    def park(cls, user: User):
+        # соединение закрылось: запоминаем последнее состояние, срок отсчитывается заново
+        session = cls.sessions.get(user.token) if user.token is not None else None
+        if session is not None:
+            session.update(user)
+            session.share(user.token)
+
+    @classmethod
+    def rotate(cls, user: User, token: str):
+        # новый токен живого соединения: сессия переезжает на него, старый ключ удаляется везде
+        if cls.sessions.pop(user.token, None) is not None:
+            Bus.publish("session drop", token=user.token)
+        user.previous_token = user.token
+        user.token = token
+        cls.issue(user)
+
+    @classmethod
+    def take(cls, token: str) -> Optional[Session]:
+        session = cls.sessions.pop(token, None)
+        if session is None:
+            cls.rejected += 1
+            return None
+        # старое соединение может быть еще не закрыто, в том числе на другом узле
+        Bus.publish("session taken", token=token, user=session.user_id)
+        live = cls.__live(session.user_id, token)
+        if live is not None:
+            # его состояние актуальнее сохраненного; само соединение закрываем
+            session.update(live)
+            cls.revoke(live)
+        elif session.expires_at < time.monotonic():
+            cls.expired += 1
+            return None
+        cls.resumed += 1
+        return session
+
+    @classmethod
+    def purge(cls):
+        now = time.monotonic()
+        # срок действует только после отключения: сессии живых соединений не трогаем. Сессии ушедших узлов
+        # вычищает каждый узел сам - их соединений уже нет, а выдавший узел об этом не сообщит
+        for token in [token for token, session in cls.sessions.items()
+                      if (session.local or session.node not in Cluster.nodes)
+                      and session.expires_at < now and cls.__live(session.user_id, token) is None]:
+            session = cls.sessions.pop(token)
+            if session.local:
+                Bus.publish("session drop", token=token)
+            cls.expired += 1
+
+    @staticmethod
+    def revoke(user: User):
+        # сессию забрало другое соединение: у этого токен отнимается сразу, чтобы уже прочитанные
+        # кадры не прошли protected, а из реестра его уберет обработчик после закрытия
+        user.token = None
+        user.previous_token = None
+        asyncio.create_task(user.socket.close(code=1000, reason="сессия восстановлена в другом соединении"))
+
+    @staticmethod
+    def __live(user_id: USER_ID, token: str) -> Optional[User]:
+        for user in Cash.users(user_id):
+            if user.token == token:
+                return user
+        return None
+
+    @classmethod
+    def snapshot(cls) -> dict:
+        return {
+            "sessions": len(cls.sessions),
+            "resumed": cls.resumed,
+            "rejected": cls.rejected,
+            "expired": cls.expired,
+        }
+
+
+def _on_session(message: dict):
+    session = Session(node=message["node"])
+    session.user_id = message["user"]
+    session.nickname = message["nickname"]
+    session.location_id = message["room"]
+    session.local_rank = LocalRanks(message["rank"]) if message["rank"] is not None else None
+    session.expires_at = time.monotonic() + message["ttl"]
+    SessionStore.sessions[message["token"]] = session
+
+
+def _on_session_taken(message: dict):
+    SessionStore.sessions.pop(message["token"], None)
+    for user in Cash.users(message["user"]):
+        if user.token == message["token"]:
+            SessionStore.revoke(user)
+
+
+def _on_session_sync(message: dict):
+    for state in message["sessions"]:
+        _on_session({**state, "node": message["node"]})
+
+
+def _sync(node: NODE):
+    # новичку - сессии этого узла: переподключение после его входа может попасть к нему
+    Bus.send(node, "session sync",
+             sessions=[session.state(token) for token, session in SessionStore.sessions.items() if session.local])
+
+
+Bus.subscribe("session", _on_session)
+Bus.subscribe("session sync", _on_session_sync)
+Bus.subscribe("session drop", lambda message: SessionStore.sessions.pop(message["token"], None))
+Bus.subscribe("session taken", _on_session_taken)
+# сессии ушедшего узла остаются до своего срока: по ним его клиенты переподключаются к другим узлам
+Cluster.watch(_sync, lambda node: None)
@@ -0,0 +1,105 @@
+import asyncio
+import contextlib
+import logging
+import os
+import signal
+import socket
+import time
+from typing import Callable, Dict, Optional
+
+import core.database
+from core.backplane import Hub
+
+logger = logging.getLogger(__name__)
+
+STOP_TIMEOUT = 10.0
+
+
+class Supervisor:
+    # сам клиентов не обслуживает: применяет миграции, запускает воркеров и держит концентратор шины
+    # (только для BACKPLANE=unix; с шиной postgres воркеры общаются через базу).
+    # воркеры слушают один порт через SO_REUSEPORT, соединения между ними распределяет ядро
+    workers: Dict[int, int] = {}  # pid -> номер воркера
+
+    @classmethod
+    def run(cls, count: int, worker: Callable[[int], None], path: Optional[str]):
+        # миграции один раз до запуска воркеров; пул соединений не должен перейти в дочерние процессы
+        asyncio.run(cls.__migrate())
+        sock = None
+        if path is not None:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+            # сокет шины слушает еще до fork: воркер может подключиться раньше, чем запустится концентратор
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(path)
+            sock.listen(count)
+        try:
+            for index in range(count):
+                pid = os.fork()
+                if pid == 0:
+                    if sock is not None:
+                        sock.close()
+                    cls.__child(worker, index)
+                cls.workers[pid] = index
+            asyncio.run(cls.__supervise(sock))
+        finally:
+            if path is not None:
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(path)
+
+    @staticmethod
+    async def __migrate():
+        await core.database.init()
+        await core.database.dispose()
+
+    @staticmethod
+    def __child(worker: Callable[[int], None], index: int):
+        code = 0
+        try:
+            worker(index)
+        except BaseException:
+            logger.exception("воркер %d упал", index)
+            code = 1
+        finally:
+            os._exit(code)
+
+    @classmethod
+    async def __supervise(cls, sock: Optional[socket.socket]):
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        if sock is not None:
+            await Hub.start(sock)
+        logger.info("запущено воркеров: %d", len(cls.workers))
+        # воркер без своего состава комнат и сессий не восстановить на лету: при падении любого
+        # останавливаем всех, перезапуск - забота systemd/docker
+        while not stop.is_set() and cls.__reap() == 0:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(stop.wait(), 0.5)
+        for pid in cls.workers:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + STOP_TIMEOUT
+        while cls.workers and time.monotonic() < deadline:
+            cls.__reap()
+            await asyncio.sleep(0.1)
+        for pid in cls.workers:
+            logger.error("воркер %d не завершился, SIGKILL", cls.workers[pid])
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGKILL)
+        await Hub.stop()
+
+    @classmethod
+    def __reap(cls) -> int:
+        exited = 0
+        while cls.workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            index = cls.workers.pop(pid, None)
+            if index is not None:
+                exited += 1
+                code = os.waitstatus_to_exitcode(status)
+                logger.log(logging.WARNING if code else logging.INFO, "воркер %d завершился с кодом %d", index, code)
+        return exited
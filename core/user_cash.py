@@ -1,35 +1,70 @@
-from typing import Optional, Dict, Set
-from uuid import UUID
+import sys
+import time
+from typing import Optional, Dict, Set, List, Tuple
 
 from websockets import WebSocketServerProtocol
 
-from services.rooms.aliases import LocalRanks
+from core.bus import Bus
+from core.cluster import Cluster, NODE
+from core.codecs import Codec, json_codec
+from core.outbox import Outbox
+from core.pipeline import Pipeline
+from core.presence import PresenceIndex, PresenceFeed
+from core.ratelimit import RateLimiter, LimitScope
+from services.accounts.aliases import AccountAliases
+from services.rooms.aliases import LocalRanks, LocalRankAliases
 
 USER_ID = int
 ROOM_ID = int
-SOCKET_ID = UUID
+HANDLE = int
+
+
+def handle_of(socket: WebSocketServerProtocol) -> HANDLE:
+    # целочисленный ключ соединения вместо UUID: не повторяется, пока соединение в реестре,
+    # потому что запись User держит ссылку на сокет
+    return id(socket)
 
 
 class User:
     __slots__ = [
+        "handle",
         "socket",
+        "outbox",
+        "pipeline",
+        "connected_at",
+        "last_seen",
+        "subscribed",
         "token",
+        "previous_token",
         "__ID",
-        "nickname",
+        "__nickname",
         "local_rank",
         "__location_id",
     ]
 
     def __init__(
             self,
-            socket: WebSocketServerProtocol
+            socket: WebSocketServerProtocol,
+            codec: Codec = json_codec
     ):
         self.__location_id: Optional[int] = None
         self.local_rank: Optional[LocalRanks] = None
-        self.nickname: Optional[str] = None
+        self.__nickname: Optional[str] = None
         self.__ID: Optional[int] = None
         self.token: Optional[str] = None
+        # токен до ротации: принимается, пока клиент не перешел на новый
+        self.previous_token: Optional[str] = None
+        self.handle: HANDLE = handle_of(socket)
         self.socket: WebSocketServerProtocol = socket
+        self.outbox: Outbox = Outbox(socket, codec)
+        self.pipeline: Pipeline = Pipeline()
+        self.connected_at: float = time.monotonic()
+        self.last_seen: float = self.connected_at
+        self.subscribed: bool = False
+
+    @property
+    def codec(self) -> Codec:
+        return self.outbox.codec
 
     @property
     def ID(self):
@@ -37,8 +72,23 @@ class User:
 
     @ID.setter
     def ID(self, value):
+        if self.__ID == value:
+            return
+        if self.__ID is not None:
+            Cash.detach(self)
         self.__ID = value
-        Cash.ids[value] = self.socket.id
+        Cash.sessions[value] = Cash.sessions.get(value, ()) + (self.handle,)
+        self.refresh_presence()
+
+    @property
+    def nickname(self):
+        return self.__nickname
+
+    @nickname.setter
+    def nickname(self, value):
+        # одинаковые ники из разных кадров и сессий хранятся одной строкой
+        self.__nickname = sys.intern(value) if value is not None else None
+        self.refresh_presence()
 
     @property
     def location_id(self):
@@ -46,20 +96,203 @@ class User:
 
     @location_id.setter
     def location_id(self, value):
+        previous = self.location_id
         if self.location_id is not None:
-            Cash.location[self.location_id].remove(self.socket.id)
+            Cash.location[self.location_id].remove(self.handle)
             if len(Cash.location[self.location_id]) == 0:
                 del Cash.location[self.location_id]
+                RateLimiter.forget(LimitScope.ROOM, self.location_id)
+                Cluster.leave(self.location_id)
         if value not in Cash.location:
             Cash.location[value] = set()
-        Cash.location[value].add(self.socket.id)
+            Cluster.join(value)
+        Cash.location[value].add(self.handle)
         self.__location_id = value
+        self.refresh_presence()
+        if self.__ID is not None and previous != value:
+            # состав комнаты - пользователи, а не соединения: другие сессии того же пользователя не в счет
+            if previous is not None and not Cash.in_room(self.__ID, previous):
+                PresenceFeed.publish(previous, PresenceFeed.LEAVE, {AccountAliases.ID: self.__ID},
+                                     local=not Cash.in_room_elsewhere(self.__ID, previous))
+            if value is not None and not Cash.in_room(self.__ID, value, exclude=self.handle):
+                PresenceFeed.publish(value, PresenceFeed.JOIN, self.member(),
+                                     local=not Cash.in_room_elsewhere(self.__ID, value))
+        if self.subscribed and previous != value:
+            # подписка переезжает вместе с пользователем: новый снимок для новой комнаты
+            PresenceFeed.unsubscribe(previous, self.handle)
+            PresenceFeed.subscribe(value, self.handle, self.outbox, room_members(value))
+
+    def member(self) -> dict:
+        return {
+            AccountAliases.ID: self.__ID,
+            AccountAliases.nickname: self.__nickname,
+            LocalRankAliases.rank: self.local_rank
+        }
+
+    def refresh_presence(self):
+        # в списке онлайн пользователя представляет его последняя сессия
+        if self.__ID is not None and self.__nickname is not None and Cash.sessions[self.__ID][-1] == self.handle:
+            PresenceIndex.update(self.__ID, self.__nickname, self.__location_id)
+            # объявляем свое состояние, а не изменение общего индекса: в нем мог быть тот же пользователь
+            # с другого узла, и тогда остальные не узнали бы, что он есть и здесь
+            state = (self.__nickname, self.__location_id)
+            if Cash.announced.get(self.__ID) != state:
+                Cash.announced[self.__ID] = state
+                Bus.publish("presence", user=self.__ID, nickname=self.__nickname, room=self.__location_id)
 
 
 class Cash:
-    online: Dict[SOCKET_ID, User] = {}
-    ids: Dict[USER_ID, SOCKET_ID] = {}
-    location: Dict[ROOM_ID, Set[SOCKET_ID]] = {}
+    online: Dict[HANDLE, User] = {}
+    # все соединения пользователя, последнее - самое новое; кортеж, а не список - почти всегда он из одного элемента
+    sessions: Dict[USER_ID, Tuple[HANDLE, ...]] = {}
+    location: Dict[ROOM_ID, Set[HANDLE]] = {}
+    # участники комнат, подключенные к другим узлам: собираются из дельт состава по шине.
+    # учитываются по узлам - пользователь может быть в комнате через сессии на нескольких
+    remote: Dict[ROOM_ID, Dict[USER_ID, Dict[NODE, dict]]] = {}
+    # (ник, комната), последними объявленные в шину для своих пользователей
+    announced: Dict[USER_ID, Tuple[str, Optional[ROOM_ID]]] = {}
+    # сессии пользователей на других узлах: узел -> (ник, комната), самая свежая - последней
+    elsewhere: Dict[USER_ID, Dict[NODE, Tuple[str, Optional[ROOM_ID]]]] = {}
+
+    @classmethod
+    def user(cls, socket: WebSocketServerProtocol) -> User:
+        return cls.online[handle_of(socket)]
+
+    @classmethod
+    def get(cls, socket: WebSocketServerProtocol) -> Optional[User]:
+        return cls.online.get(handle_of(socket))
+
+    @classmethod
+    def find(cls, user_id: USER_ID) -> Optional[User]:
+        handles = cls.sessions.get(user_id)
+        return cls.online[handles[-1]] if handles else None
+
+    @classmethod
+    def users(cls, user_id: USER_ID) -> List[User]:
+        return [cls.online[handle] for handle in cls.sessions.get(user_id, ())]
+
+    @classmethod
+    def in_room(cls, user_id: USER_ID, room_id: ROOM_ID, exclude: Optional[HANDLE] = None) -> bool:
+        return any(
+            handle != exclude and cls.online[handle].location_id == room_id
+            for handle in cls.sessions.get(user_id, ())
+        )
+
+    @classmethod
+    def in_room_elsewhere(cls, user_id: USER_ID, room_id: ROOM_ID) -> bool:
+        return user_id in cls.remote.get(room_id, ())
+
+    @classmethod
+    def detach(cls, user: User):
+        # соединение перестает быть сессией пользователя; последняя сессия уносит его из списка онлайн
+        handles = cls.sessions.get(user.ID)
+        if handles is None or user.handle not in handles:
+            return
+        handles = tuple(handle for handle in handles if handle != user.handle)
+        if handles:
+            cls.sessions[user.ID] = handles
+            cls.online[handles[-1]].refresh_presence()
+        else:
+            del cls.sessions[user.ID]
+            cls.announced.pop(user.ID, None)
+            Bus.publish("presence", user=user.ID, nickname=None, room=None)
+            cls.show_elsewhere(user.ID)
+            RateLimiter.forget(LimitScope.USER, user.ID)
+
+    @classmethod
+    def show_elsewhere(cls, user_id: USER_ID):
+        # у пользователя нет сессий на этом воркере: в списке онлайн его самая свежая сессия на другом узле
+        if cls.sessions.get(user_id):
+            return
+        nodes = cls.elsewhere.get(user_id)
+        if nodes:
+            PresenceIndex.update(user_id, *next(reversed(nodes.values())))
+        else:
+            PresenceIndex.remove(user_id)
+
+
+def room_members(room_id: ROOM_ID) -> List[dict]:
+    members = {user_id: next(reversed(nodes.values())) for user_id, nodes in Cash.remote.get(room_id, {}).items()}
+    for handle in Cash.location.get(room_id, ()):
+        user = Cash.online[handle]
+        members[user.ID] = user.member()
+    return list(members.values())
+
+
+def _on_presence(message: dict):
+    # присутствие учитывается по узлам: уход пользователя с одного узла не снимает его сессию на другом
+    user_id = message["user"]
+    nodes = Cash.elsewhere.setdefault(user_id, {})
+    nodes.pop(message["node"], None)
+    if message["nickname"] is not None:
+        nodes[message["node"]] = (message["nickname"], message["room"])
+    elif not nodes:
+        del Cash.elsewhere[user_id]
+    Cash.show_elsewhere(user_id)
+
+
+def _in_room(user_id: USER_ID, room_id: ROOM_ID) -> bool:
+    return Cash.in_room(user_id, room_id) or Cash.in_room_elsewhere(user_id, room_id)
+
+
+def _on_presence_delta(message: dict):
+    room_id, op, member, node = message["room"], message["change"], message["member"], message["node"]
+    user_id = member[AccountAliases.ID]
+    present = _in_room(user_id, room_id)
+    members = Cash.remote.setdefault(room_id, {})
+    nodes = members.setdefault(user_id, {})
+    if op == PresenceFeed.JOIN:
+        nodes[node] = member
+    elif op == PresenceFeed.LEAVE:
+        nodes.pop(node, None)
+    elif node in nodes:
+        nodes[node] = member
+    if not nodes:
+        del members[user_id]
+    if not members:
+        del Cash.remote[room_id]
+    # клиентам - только изменения состава: вход и выход через вторую сессию пользователя его не меняют
+    if op == PresenceFeed.RANK or present != _in_room(user_id, room_id):
+        PresenceFeed.apply(room_id, op, member)
+
+
+def _on_presence_sync(message: dict):
+    # состояние узла целиком для новичка: те же сообщения, что он получил бы по одному
+    node = message["node"]
+    for user_id, nickname, room_id in message["users"]:
+        _on_presence({"node": node, "user": user_id, "nickname": nickname, "room": room_id})
+    for room_id, member in message["members"]:
+        _on_presence_delta({"node": node, "room": room_id, "change": PresenceFeed.JOIN, "member": member})
+
+
+def _sync(node: NODE):
+    members = []
+    for room_id, handles in Cash.location.items():
+        seen = set()
+        for handle in handles:
+            user = Cash.online[handle]
+            if user.ID is not None and user.ID not in seen:
+                seen.add(user.ID)
+                members.append((room_id, user.member()))
+    Bus.send(node, "presence sync",
+             users=[(user_id, nickname, room_id) for user_id, (nickname, room_id) in Cash.announced.items()],
+             members=members)
+
+
+def _forget(node: NODE):
+    # узел ушел или пропал: его пользователи больше нигде не объявят, что ушли
+    for user_id in [user_id for user_id, nodes in Cash.elsewhere.items() if node in nodes]:
+        _on_presence({"node": node, "user": user_id, "nickname": None, "room": None})
+    for room_id, members in list(Cash.remote.items()):
+        for user_id in [user_id for user_id, nodes in members.items() if node in nodes]:
+            _on_presence_delta({"node": node, "room": room_id, "change": PresenceFeed.LEAVE,
+                                "member": {AccountAliases.ID: user_id}})
+
+
+Bus.subscribe("presence", _on_presence)
+Bus.subscribe("presence delta", _on_presence_delta)
+Bus.subscribe("presence sync", _on_presence_sync)
+Cluster.watch(_sync, _forget)
 
 
 # class Storage:
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+from typing import Optional, List
+
+from sqlalchemy import insert
+from sqlalchemy.exc import DBAPIError, OperationalError, InterfaceError
+
+from core.config import PUBLIC_QUEUE_SIZE, PUBLIC_BATCH_SIZE, PUBLIC_FLUSH_INTERVAL
+from core.database import unit_of_work
+from core.schemas import public
+
+logger = logging.getLogger(__name__)
+
+
+class PublicWriter:
+    queue: Optional[asyncio.Queue] = None
+    task: Optional[asyncio.Task] = None
+
+    enqueued: int = 0
+    written: int = 0
+    failed: int = 0
+    batches: int = 0
+    last_batch: int = 0
+    max_batch: int = 0
+
+    @classmethod
+    def start(cls):
+        if cls.task is not None:
+            return
+        cls.queue = asyncio.Queue(maxsize=PUBLIC_QUEUE_SIZE)
+        cls.task = asyncio.create_task(cls.__run())
+
+    @classmethod
+    async def stop(cls):
+        if cls.task is None:
+            return
+        await cls.queue.join()  # дописываем все, что осталось в очереди
+        cls.task.cancel()
+        try:
+            await cls.task
+        except asyncio.CancelledError:
+            pass
+        cls.task = None
+
+    @classmethod
+    async def put(cls, data: dict):
+        # очередь ограничена: при переполнении отправитель ждет, а не растит память
+        await cls.queue.put(data)
+        cls.enqueued += 1
+
+    @classmethod
+    def snapshot(cls) -> dict:
+        return {
+            "queue_depth": cls.queue.qsize() if cls.queue is not None else 0,
+            "enqueued": cls.enqueued,
+            "written": cls.written,
+            "failed": cls.failed,
+            "batches": cls.batches,
+            "last_batch": cls.last_batch,
+            "max_batch": cls.max_batch,
+        }
+
+    @classmethod
+    async def __collect(cls) -> List[dict]:
+        loop = asyncio.get_running_loop()
+        batch = [await cls.queue.get()]
+        deadline = loop.time() + PUBLIC_FLUSH_INTERVAL
+        while len(batch) < PUBLIC_BATCH_SIZE:
+            if not cls.queue.empty():
+                batch.append(cls.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(cls.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    @classmethod
+    async def __write(cls, batch: List[dict]):
+        try:
+            async with unit_of_work() as db:
+                await db.execute(insert(public), batch)
+            cls.written += len(batch)
+        except DBAPIError as e:
+            # ошибка в данных одной строки не должна стоить всей пачки: делим пополам, пока не найдем ее.
+            # недоступная база - не ошибка строк, там делить нечего
+            if len(batch) > 1 and not e.connection_invalidated and not isinstance(e, (OperationalError, InterfaceError)):
+                middle = len(batch) // 2
+                await cls.__write(batch[:middle])
+                await cls.__write(batch[middle:])
+                return
+            cls.failed += len(batch)
+            logger.exception("не удалось записать %d сообщений", len(batch))
+        except Exception:
+            cls.failed += len(batch)
+            logger.exception("не удалось записать %d сообщений", len(batch))
+
+    @classmethod
+    async def __flush(cls, batch: List[dict]):
+        await cls.__write(batch)
+        cls.batches += 1
+        cls.last_batch = len(batch)
+        if len(batch) > cls.max_batch:
+            cls.max_batch = len(batch)
+
+    @classmethod
+    async def __run(cls):
+        while True:
+            batch = await cls.__collect()
+            try:
+                await cls.__flush(batch)
+            finally:
+                for _ in batch:
+                    cls.queue.task_done()
@@ -0,0 +1,52 @@
+import inspect
+from typing import Dict, Type, Union, Literal, Tuple
+
+from typing_extensions import Annotated
+from pydantic import Field, TypeAdapter, ValidationError, create_model
+
+from core.base_event import BaseEvent
+from core.io import InputModel
+from events.exc import NotFoundError
+from events.inputs import input_event_mapping
+
+
+class Dispatcher:
+    def __init__(self, mapping: Dict[str, Type[BaseEvent]]):
+        self.mapping = mapping
+        envelopes = tuple(self.__envelope(name, event) for name, event in mapping.items())
+        # конверт и полезная нагрузка валидируются за один проход, команда выбирается по полю "@"
+        self.adapter = TypeAdapter(Annotated[Union[envelopes], Field(discriminator="event")])
+
+    @staticmethod
+    def __envelope(name: str, event: Type[BaseEvent]) -> Type[InputModel]:
+        model = inspect.signature(event.__init__).parameters['model'].annotation
+        return create_model(
+            f"{event.__name__}Input",
+            __base__=InputModel,
+            event=(Literal[name], Field(alias="@")),
+            payload=(model, Field(alias="#")),
+        )
+
+    def decode(self, message: Union[str, bytes, dict]) -> Tuple[Type[BaseEvent], InputModel]:
+        try:
+            if isinstance(message, dict):
+                data = self.adapter.validate_python(message)  # уже разобран бинарным кодеком
+            else:
+                data = self.adapter.validate_json(message)
+        except ValidationError as e:
+            if e.errors(include_url=False)[0]["type"] == "union_tag_invalid":
+                raise NotFoundError("такой команды не существует")
+            raise
+        return self.mapping[data.event], data
+
+
+def field_name(loc: tuple) -> str:
+    # (команда, "#", поле, ...) -> "поле"
+    if len(loc) > 2 and loc[1] == "#":
+        loc = loc[2:]
+    elif len(loc) > 1:
+        loc = loc[1:]
+    return ".".join(str(i) for i in loc)
+
+
+dispatcher = Dispatcher(input_event_mapping)
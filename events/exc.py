@@ -1,17 +1,28 @@
-from typing import Optional
+from typing import Optional, Dict
 
-from core.io import IO_TYPE, Error
+from core.codecs import Frame
+from core.io import IO_TYPE, REQUEST_ID
 
 
 class InternalError(Exception):
-    def __init__(self, error: str, payload: Optional[IO_TYPE] = None):
-        self.error = Error(
-            error=error,
-            payload=payload
-        )
+    # ошибки без данных (NonAuthorized, RateLimited) - постоянные кадры, кодируются один раз
+    frames: Dict[str, Frame] = {}
 
-    def __call__(self):
-        return self.error.model_dump_json(by_alias=True)
+    def __init__(self, error: str, payload: Optional[IO_TYPE] = None):
+        self.error = error
+        self.payload = payload
+
+    def __call__(self, request_id: Optional[REQUEST_ID] = None) -> Frame:
+        # поля как у core.io.Error
+        if self.payload is not None:
+            data = {"!": self.error, "#": self.payload}
+            if request_id is not None:
+                data["&"] = request_id
+            return Frame(data)
+        frame = InternalError.frames.get(self.error)
+        if frame is None:
+            frame = InternalError.frames[self.error] = Frame({"!": self.error, "#": None}).freeze()
+        return frame.reply(request_id)
 
 
 class AccessDenied(InternalError):
@@ -39,6 +50,11 @@ class NotFoundError(InternalError):
         super().__init__("не найдено", data)
 
 
+class RateLimited(InternalError):
+    def __init__(self):
+        super().__init__("слишком много запросов")
+
+
 class UpdateError(InternalError):
     def __init__(self, data: Optional[IO_TYPE]):
         super().__init__("не обновлено", data)
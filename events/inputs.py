@@ -3,13 +3,17 @@ from pprint import pprint
 
 from pydantic import BaseModel
 
-from services.accounts.events import Create, Auth, GetOneUser, GetOnlineUserList, ChangeNick, Relocation, ChangePassword
-from services.messages.events import SendPublic
-from services.rooms.events import CreateRoom, UpdatePermission, GetOnlineRoomList
+from core.ratelimit import Limit, LimitScope
+from services.admin.events import GetMetrics
+from services.accounts.events import Create, Auth, Resume, GetOneUser, GetOnlineUserList, ChangeNick, Relocation, ChangePassword
+from services.messages.events import SendPublic, GetRoomHistory
+from services.rooms.events import CreateRoom, UpdatePermission, GetOnlineRoomList, SubscribePresence, \
+    UnsubscribePresence, ResyncPresence
 
 input_event_mapping = {
     "signup": Create,
     "signin": Auth,
+    "resume": Resume,
     "get one user": GetOneUser,
     "online list": GetOnlineUserList,
     "change nickname": ChangeNick,
@@ -18,9 +22,33 @@ input_event_mapping = {
     "create room": CreateRoom,
     "online room list": GetOnlineRoomList,
     "send public": SendPublic,
-    "update permission": UpdatePermission
+    "room history": GetRoomHistory,
+    "update permission": UpdatePermission,
+    "presence subscribe": SubscribePresence,
+    "presence unsubscribe": UnsubscribePresence,
+    "presence resync": ResyncPresence,
+    "metrics": GetMetrics
 }
 
+# лимиты по командам: (область, токенов в секунду, емкость); остальные команды - default_rate_limit
+rate_limit_mapping = {
+    "signup": (Limit(LimitScope.SOCKET, 0.2, 3),),
+    "signin": (Limit(LimitScope.SOCKET, 0.5, 5),),
+    "resume": (Limit(LimitScope.SOCKET, 1, 5),),
+    "change password": (Limit(LimitScope.USER, 0.2, 3),),
+    "change nickname": (Limit(LimitScope.USER, 0.5, 5),),
+    "create room": (Limit(LimitScope.USER, 0.2, 5),),
+    "relocate": (Limit(LimitScope.USER, 2, 10),),
+    "send public": (
+        Limit(LimitScope.SOCKET, 5, 20),
+        Limit(LimitScope.USER, 10, 30),
+        Limit(LimitScope.ROOM, 200, 400),
+    ),
+}
+default_rate_limit = (Limit(LimitScope.SOCKET, 20, 50),)
+# все кадры сокета до разбора: с запасом над лимитами команд, отсекает только флуд
+frame_rate_limit = Limit(LimitScope.SOCKET, 40, 100)
+
 # with open("doc.md", "w+", encoding="utf-8", newline="\n") as f:
 #     res_strings = []
 #     for k, v in input_event_mapping.items():
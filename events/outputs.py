@@ -1,13 +1,22 @@
 from abc import ABC, abstractmethod
-from typing import Optional, Union
+from typing import Optional, Union, Dict, Tuple
 
 from pydantic import BaseModel
 from websockets import WebSocketServerProtocol
 
-from core.io import IO_TYPE, OutputModel
+from core.batching import RoomBatcher
+from core.broadcast import broadcast, room_broadcast
+from core.codecs import Frame
+from core.io import IO_TYPE, REQUEST_ID, request_id_for
 
 
 class BaseOutEvent(ABC):
+    coalesce: bool = False
+    # ответ - одна из фиксированных строк: кадр кодируется один раз и дальше отправляется готовым
+    constant: bool = False
+
+    frames: Dict[Tuple[str, str], Frame] = {}
+
     @abstractmethod
     def __init__(self, name: str):
         self.name = name
@@ -16,18 +25,42 @@ class BaseOutEvent(ABC):
                        *sockets: WebSocketServerProtocol,
                        model: Optional[Union[BaseModel, IO_TYPE]] = None,
                        token: Optional[str] = None):
-        payload = model
-        if isinstance(model, BaseModel):
-            payload = model.model_dump(by_alias=True)
-        output = OutputModel(event=self.name,
-                             payload=payload,
-                             token=token
-                             ).model_dump_json(by_alias=True, exclude_none=True)
-        for s in sockets:
-            await s.send(output)
+        # ID запроса возвращаем только в ответе самому отправителю команды
+        request_id = request_id_for(sockets[0]) if len(sockets) == 1 else None
+        broadcast(sockets, self.frame(model, token, request_id), self.name if self.coalesce else None)
+
+    async def room(self,
+                   room_id: int,
+                   model: Optional[Union[BaseModel, IO_TYPE]] = None,
+                   exclude: Optional[WebSocketServerProtocol] = None):
+        # всем участникам комнаты, включая подключенных к другим воркерам. Сообщения, ждущие окна горячей
+        # комнаты, уходят раньше: системный кадр не должен обгонять то, что отправили до него
+        RoomBatcher.flush(room_id)
+        room_broadcast(room_id, self.frame(model), exclude, self.name if self.coalesce else None)
+
+    def frame(self,
+              model: Optional[Union[BaseModel, IO_TYPE]] = None,
+              token: Optional[str] = None,
+              request_id: Optional[REQUEST_ID] = None) -> Frame:
+        if self.constant and isinstance(model, str) and token is None:
+            frame = BaseOutEvent.frames.get((self.name, model))
+            if frame is None:
+                frame = BaseOutEvent.frames[(self.name, model)] = Frame({"@": self.name, "#": model}).freeze()
+            return frame.reply(request_id)
+        # модель кладется в кадр как есть: кодек сериализует ее сам, без промежуточного model_dump
+        data = {"@": self.name}
+        if model is not None:
+            data["#"] = model
+        if token is not None:
+            data["$"] = token
+        if request_id is not None:
+            data["&"] = request_id
+        return Frame(data)
 
 
 class Successfully(BaseOutEvent):
+    constant = True
+
     def __init__(self):
         super().__init__("success")
 
@@ -45,6 +78,7 @@ class OneUserInfo(BaseOutEvent):
 
 
 class OnlineUserListInfo(BaseOutEvent):
+    coalesce = True
 
     def __init__(self):
         super().__init__("online_list")
@@ -56,5 +90,17 @@ class SystemMessage(BaseOutEvent):
 
 
 class OnlineRoomList(BaseOutEvent):
+    coalesce = True
+
     def __init__(self):
         super().__init__("online room list")
+
+
+class RoomHistory(BaseOutEvent):
+    def __init__(self):
+        super().__init__("room history")
+
+
+class MetricsInfo(BaseOutEvent):
+    def __init__(self):
+        super().__init__("metrics")
@@ -1,77 +1,180 @@
 import asyncio
-import inspect
-from typing import List
+import contextlib
+import functools
+import json
+import logging
+import signal
+import time
+from typing import List, Type, Union, Optional
 
 import websockets
 from pydantic import ValidationError
 from websockets import WebSocketServerProtocol
 
 import core.database
-from events.exc import InternalError, NotFoundError
-from core.io import InputModel, output
-from core.user_cash import User, Cash
-from events.inputs import input_event_mapping
+from core.base_event import BaseEvent
+from core.batching import RoomBatcher
+from core.broadcast import send
+from core.codecs import select_subprotocol
+from events.dispatch import dispatcher, field_name
+from events.exc import InternalError, RateLimited
+from events.inputs import rate_limit_mapping, default_rate_limit, frame_rate_limit
+import core.backplane
+from core.bus import Bus
+from core.cluster import Cluster
+from core.config import PUBLIC_WRITE_BEHIND, PING_INTERVAL, PING_TIMEOUT, RATE_LIMIT, WORKERS, BUS_PATH, \
+    METRICS_PORT, BACKPLANE, NODE_ID
+from core.io import output, InputModel, REQUEST_ID, request_context
+from core.exporter import MetricsServer
+from core.managers import PasswordService
+from core.metrics import Metrics
+from core.ratelimit import RateLimiter
+from core.security import renew
+from core.lifecycle import ConnectionManager
+from core.user_cash import Cash
+from core.supervisor import Supervisor
+from core.writer import PublicWriter
 
+logger = logging.getLogger(__name__)
 
-async def handler(websocket: WebSocketServerProtocol):
-    Cash.online[websocket.id] = User(socket=websocket)  # запомнили подключение
-    await websocket.send(output("успешное подключение"))
-    while True:
+# постоянные кадры: кодируются во все форматы при импорте, дальше отправляются готовыми
+RATE_LIMITED = RateLimited()()
+INTERNAL_ERROR = InternalError("внутренняя ошибка")()
+CONNECTED = output("успешное подключение").freeze()
+
+
+def validation_error(e: ValidationError) -> InternalError:
+    errors = e.errors(include_url=False, include_input=False)
+    err_output: List[str] = []
+    for i in errors:
+        if i["type"] == "missing":
+            err_output.append(f"пропущено поле '{field_name(i['loc'])}'")
+        elif i["type"] == "union_tag_not_found":
+            err_output.append("пропущено поле '@'")
+        elif i["type"].endswith("_type"):
+            err_output.append(f"неверный тип поля '{field_name(i['loc'])}'")
+        elif i["type"] == "enum":
+            err_output.append(f"поле '{field_name(i['loc'])}' может принимать только значения: {i['ctx']}")
+        elif i["type"] == "json_invalid":
+            err_output.append("невалидный json")
+        else:
+            err_output.append(i)
+    return InternalError("ошибка валидации", err_output)
+
+
+def raw_request_id(message: Union[str, bytes, dict]) -> Optional[REQUEST_ID]:
+    # только для кадров, не прошедших валидацию: пытаемся вернуть ID запроса в ошибке
+    try:
+        request_id = (message if isinstance(message, dict) else json.loads(message)).get("&")
+    except (ValueError, AttributeError):
+        return None
+    return request_id if isinstance(request_id, (int, str)) else None
+
+
+async def execute(websocket: WebSocketServerProtocol, event: Type[BaseEvent], data: InputModel):
+    request_context.set((id(websocket), data.request_id))
+    start = time.perf_counter()
+    failed = True
+    try:
         try:
+            await event(websocket, data.payload, data.token)()
+            failed = False
+        except ValidationError as e:
+            raise validation_error(e)
+    except InternalError as e:
+        send(websocket, e(data.request_id))
+    except Exception:
+        # команда выполняется отдельной задачей: без перехвата ошибка теряется, а клиент не получает ответа
+        logger.exception("ошибка выполнения команды %s", data.event)
+        send(websocket, INTERNAL_ERROR.reply(data.request_id))
+    finally:
+        # и после отказа: истекший токен живого соединения иначе не обновить
+        user = Cash.get(websocket)
+        if user is not None:
+            renew(user)
+        Metrics.observe_command(data.event, time.perf_counter() - start, failed)
+
+
+async def handler(websocket: WebSocketServerProtocol):
+    user = ConnectionManager.register(websocket)  # запомнили подключение
+    send(websocket, CONNECTED)
+    try:
+        async for message in websocket:
+            # соединение могли снять с реестра, пока кадры ждали в буфере (сессию забрал Resume)
+            if Cash.get(websocket) is not user:
+                break
+            ConnectionManager.touch(user)
+            if RATE_LIMIT and not RateLimiter.allow_frame(user.handle):
+                # кадр не разбирался - ID запроса неизвестен
+                send(websocket, RATE_LIMITED)
+                continue
             try:
                 try:
-                    message = await websocket.recv()
-                    data = InputModel.model_validate_json(message)
-                    event = input_event_mapping.get(data.event)
-                    if event is None:
-                        raise NotFoundError("такой команды не существует")
-                    model = inspect.signature(event.__init__).parameters['model'].annotation
-                    await event(websocket, model(**data.payload), data.token)()
-
+                    message = user.codec.decode(message)
+                except ValueError:
+                    raise InternalError("ошибка валидации", [f"невалидный кадр {user.codec.name}"])
+                try:
+                    event, data = dispatcher.decode(message)
                 except ValidationError as e:
-                    errors = e.errors(include_url=False, include_input=False)
-                    err_output: List[str] = []
-                    for i in errors:
-                        if i["type"] == "missing":
-                            err_output.append(f"пропущено поле '{i['loc'][0]}'")
-                        elif i["type"].endswith("_type"):
-                            err_output.append(f"неверный тип поля '{i['loc'][0]}'")
-                        elif i["type"] == "enum":
-                            err_output.append(f"поле '{i['loc'][0]}' может принимать только значения: {i['ctx']}")
-                        elif i["type"] == "json_invalid":
-                            err_output.append("невалидный json")
-                        else:
-                            err_output.append(i)
-
-                    if err_output:
-                        raise InternalError("ошибка валидации", err_output)
-                # except Exception as e:
-                #     if isinstance(e, InternalError):
-                #         raise e
-                #     else:
-                #         print_tb(e.__traceback__)
-                #         print(e.args)
-                #         raise InternalError("внутренняя ошибка")
+                    raise validation_error(e)
             except InternalError as e:
-                await websocket.send(e())
-        except websockets.exceptions.WebSocketException:
-            if websocket.id in Cash.online:
-                user = Cash.online[websocket.id]
-                if user.location_id in Cash.location:
-                    Cash.location[user.location_id].remove(user.socket.id)
-                    if len(Cash.location[user.location_id]) == 0:
-                        del Cash.location[user.location_id]
-                del Cash.ids[user.ID]
-                del Cash.online[websocket.id]
-                del user
-            print("клиент отключен")
-
-
-async def main():
-    await core.database.init()
-    async with websockets.serve(handler, "", 8001):
-        await asyncio.Future()
+                send(websocket, e(raw_request_id(message)))
+                continue
+            if RATE_LIMIT and not RateLimiter.allow(data.event, user.handle, user.ID, user.location_id):
+                send(websocket, RATE_LIMITED.reply(data.request_id))
+                continue
+            await user.pipeline.submit(functools.partial(execute, websocket, event, data), ordered=event.ordered)
+    except websockets.exceptions.WebSocketException:
+        pass
+    finally:
+        # цикл завершается при закрытии сокета, очистка выполняется ровно один раз
+        ConnectionManager.unregister(websocket)
+        print("клиент отключен")
+
+
+async def main(worker: Optional[int] = None):
+    if worker is None:
+        await core.database.init()
+    # миграции воркеров уже применил супервизор
+    backplane = core.backplane.configured()
+    if backplane is not None:
+        await Bus.start(backplane, NODE_ID if worker is None else f"{NODE_ID}/{worker}")
+        await Cluster.start()
+    RateLimiter.configure(rate_limit_mapping, default_rate_limit, frame_rate_limit)
+    if PUBLIC_WRITE_BEHIND:
+        PublicWriter.start()
+    PasswordService.start()
+    ConnectionManager.start()
+    # у каждого воркера свой порт метрик: METRICS_PORT + номер воркера
+    await MetricsServer.start(METRICS_PORT + (worker or 0) if METRICS_PORT else 0)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+    try:
+        async with websockets.serve(handler, "", 8001,
+                                    select_subprotocol=select_subprotocol,
+                                    reuse_port=worker is not None,
+                                    ping_interval=PING_INTERVAL,
+                                    ping_timeout=PING_TIMEOUT):
+            await stop.wait()
+    finally:
+        RoomBatcher.stop()
+        await MetricsServer.stop()
+        await ConnectionManager.stop()
+        await PublicWriter.stop()
+        PasswordService.stop()
+        await Cluster.stop()
+        await Bus.close()
+
+
+def run_worker(index: int):
+    asyncio.run(main(index))
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    if WORKERS > 1:
+        Supervisor.run(WORKERS, run_worker, BUS_PATH if BACKPLANE == "unix" else None)
+    else:
+        asyncio.run(main())
@@ -1,22 +1,25 @@
 from typing import Optional
 
 from asyncpg import ForeignKeyViolationError, UniqueViolationError
-from sqlalchemy import CursorResult, insert, select, update, RowMapping
+from sqlalchemy import CursorResult, insert, select, update
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncConnection
 from websockets import WebSocketServerProtocol
 
 from core.base_event import BaseEvent
-from core.database import engine
-from events.exc import InternalError, DuplicateError, InvalidDataError, NotFoundError, UpdateError
-from core.managers import Token, PasswordManager
+from core.cache import profiles, room_title, local_rank, forget_profile, profile_changed
+from core.database import unit_of_work, replicas
+from events.exc import InternalError, DuplicateError, InvalidDataError, NotFoundError, UpdateError, NonAuthorized
+from core.managers import Token, PasswordService
 from events.outputs import Successfully, OneUserInfo, OnlineUserListInfo, SystemMessage, NewToken
-from core.schemas import accounts, locations, local_ranks, rooms
+from core.schemas import accounts, locations, rooms
+from core.presence import PresenceIndex
 from core.security import protected
+from core.sessions import SessionStore
 from core.user_cash import Cash, User
 from services.accounts.aliases import AccountAliases, AccountStatuses
 from services.accounts.models import AuthModel, GetOneUserOut, GetOneUserModel, GetOnlineUserListModel, \
-    ChangeNickModel, RelocationModel, ChangePasswordModel, AuthModelOut
+    ChangeNickModel, RelocationModel, ChangePasswordModel, AuthModelOut, ResumeModel
 from services.messages.models import PublicMessageOut, Author
 from services.rooms.aliases import RoomAliases, LocalRankAliases, LocalRanks
 from services.rooms.models import LocationShortInfoModel
@@ -24,6 +27,8 @@ from services.rooms.models import LocationShortInfoModel
 
 class Create(BaseEvent):
     __doc__ = """ Регистрация нового пользователя """
+    ordered = True
+
     def __init__(self, socket: WebSocketServerProtocol, model: AuthModel, token=None):
         super().__init__(socket, model, token)
 
@@ -47,73 +52,67 @@ class Create(BaseEvent):
 
     async def __call__(self):
         container = self.model.model_dump(by_alias=True)
-        container[AccountAliases.password] = PasswordManager.get_hash(self.model.password)
-        async with engine.connect() as db:
+        container[AccountAliases.password] = await PasswordService.get_hash(self.model.password)
+        async with unit_of_work() as db:
             user_id = await self.__create_user(db, container)
             await self.__add_location(db, user_id)
-            await db.commit()
-        token = Token.generate()
-        Cash.online[self.socket.id].ID = user_id
-        Cash.online[self.socket.id].nickname = self.model.nickname
-        Cash.online[self.socket.id].token = token
-        Cash.online[self.socket.id].location_id = 1
-        Cash.online[self.socket.id].local_rank = LocalRanks.USER
-        Cash.online[self.socket.id].token = token
+        token = Token.generate(user_id)
+        Cash.user(self.socket).ID = user_id
+        Cash.user(self.socket).nickname = self.model.nickname
+        Cash.user(self.socket).token = token
+        Cash.user(self.socket).local_rank = LocalRanks.USER
+        Cash.user(self.socket).location_id = 1
+        Cash.user(self.socket).token = token
+        SessionStore.issue(Cash.user(self.socket))
         await Successfully()(self.socket, model="успешная регистрация")
         await NewToken()(self.socket, model=AuthModelOut(token=token))
 
 
 class Auth(BaseEvent):
+    ordered = True
+
     def __init__(self, socket: WebSocketServerProtocol, model: AuthModel, token=None):
         super().__init__(socket, model, token)
 
-    async def __get_user(self, nickname: str) -> Optional[dict]:
-        async with engine.connect() as db:
-            cursor = await db.execute(
-                select(
-                    accounts.c[AccountAliases.ID],
-                    accounts.c[AccountAliases.nickname],
-                    accounts.c[AccountAliases.password],
-                    locations.c[RoomAliases.ID],
-                )
-                .join(locations, accounts.c[AccountAliases.ID] == locations.c[AccountAliases.ID], isouter=True)
-                .where(
-                    accounts.c[AccountAliases.nickname] == nickname
-                )
+    async def __get_user(self, db: AsyncConnection, nickname: str) -> Optional[dict]:
+        cursor = await db.execute(
+            select(
+                accounts.c[AccountAliases.ID],
+                accounts.c[AccountAliases.nickname],
+                accounts.c[AccountAliases.password],
+                locations.c[RoomAliases.ID],
+            )
+            .join(locations, accounts.c[AccountAliases.ID] == locations.c[AccountAliases.ID], isouter=True)
+            .where(
+                accounts.c[AccountAliases.nickname] == nickname
             )
-            result = cursor.mappings().fetchone()
-            result = None if not result else dict(result)
-            return result
-
-    async def __get_local_rank(self, db: AsyncConnection, user_id: int, room_id: int):
-        local_rank_cursor: CursorResult = await db.execute(
-            select(local_ranks.c[LocalRankAliases.rank])
-            .where(local_ranks.c[AccountAliases.ID] == user_id)
-            .where(local_ranks.c[RoomAliases.ID] == room_id)
         )
-        return local_rank_cursor.scalar()
+        result = cursor.mappings().fetchone()
+        result = None if not result else dict(result)
+        return result
 
     async def __call__(self) -> None:
-        user: Optional[dict] = await self.__get_user(self.model.nickname)
+        # соединение не держим во время проверки пароля. Учетные данные - только с основной базы:
+        # после смены пароля реплика с отставанием приняла бы старый
+        async with unit_of_work() as db:
+            user: Optional[dict] = await self.__get_user(db, self.model.nickname)
+        if user is not None and user[RoomAliases.ID] is not None:
+            user[LocalRankAliases.rank] = await local_rank(user[AccountAliases.ID], user[RoomAliases.ID])
         if user is not None:
-            if not PasswordManager.verify_hash(self.model.password, user[AccountAliases.password]):
+            if not await PasswordService.verify_hash(self.model.password, user[AccountAliases.password]):
                 raise InvalidDataError("неверный пароль")
             else:
-                if user[RoomAliases.ID] is not None:
-                    async with engine.connect() as db:
-                        user[LocalRankAliases.rank] = await self.__get_local_rank(db, user[AccountAliases.ID],
-                                                                                  user[RoomAliases.ID])
-
-                token = Token.generate()
-
-                Cash.online[self.socket.id].ID = user[AccountAliases.ID]
-                Cash.online[self.socket.id].nickname = self.model.nickname
-                Cash.online[self.socket.id].token = token
-                Cash.online[self.socket.id].location_id = user[RoomAliases.ID]
-                Cash.online[self.socket.id].local_rank = LocalRanks.USER if user[LocalRankAliases.rank] is None else \
+                token = Token.generate(user[AccountAliases.ID])
+
+                Cash.user(self.socket).ID = user[AccountAliases.ID]
+                Cash.user(self.socket).nickname = self.model.nickname
+                Cash.user(self.socket).token = token
+                Cash.user(self.socket).local_rank = LocalRanks.USER if user.get(LocalRankAliases.rank) is None else \
                     user[
                         LocalRankAliases.rank]
-                Cash.online[self.socket.id].token = token
+                Cash.user(self.socket).location_id = user[RoomAliases.ID]
+                Cash.user(self.socket).token = token
+                SessionStore.issue(Cash.user(self.socket))
 
                 await Successfully()(self.socket, model="успешная авторизация")
                 await NewToken()(self.socket, model=AuthModelOut(token=token))
@@ -121,6 +120,30 @@ class Auth(BaseEvent):
             raise NotFoundError("пользователя не существует")
 
 
+class Resume(BaseEvent):
+    __doc__ = """ Восстановление сессии по токену после переподключения, без проверки пароля """
+    ordered = True
+
+    def __init__(self, socket: WebSocketServerProtocol, model: ResumeModel, token=None):
+        super().__init__(socket, model, token)
+
+    async def __call__(self):
+        session = SessionStore.take(self.model.token)
+        if session is None:
+            raise NonAuthorized()
+        user: User = Cash.user(self.socket)
+        user.ID = session.user_id
+        user.nickname = session.nickname
+        user.token = Token.generate(session.user_id)
+        if session.location_id is not None:
+            # ранг мог измениться, пока пользователь был отключен: берем из кэша рангов
+            user.local_rank = await local_rank(session.user_id, session.location_id)
+            user.location_id = session.location_id
+        SessionStore.issue(user)
+        await Successfully()(self.socket, model="сессия восстановлена")
+        await NewToken()(self.socket, model=AuthModelOut(token=user.token))
+
+
 class GetOneUser(BaseEvent):
     @protected
     def __init__(self, socket: WebSocketServerProtocol, model: GetOneUserModel, token: str):
@@ -141,27 +164,45 @@ class GetOneUser(BaseEvent):
         )
         return cursor.mappings().fetchone()
 
+    @staticmethod
+    def __fresh(profile: dict, online: Optional[User]) -> bool:
+        # для пользователя онлайн источник правды - Cash: карточка должна с ним совпадать
+        if online is None:
+            return True
+        return (profile[AccountAliases.nickname] == online.nickname
+                and profile[AccountAliases.location][RoomAliases.ID] == online.location_id)
+
     async def __call__(self):
-        async with engine.connect() as storage:
-            result: Optional[dict] = await self.__get_info(storage, self.model.ID)
-        if not result:
-            raise NotFoundError("пользователь не найден")
-        status = AccountStatuses.ONLINE if result[AccountAliases.ID] in Cash.ids else AccountStatuses.OFFLINE
-        mess_out = GetOneUserOut(
-            **{
-                AccountAliases.ID: result[AccountAliases.ID],
-                AccountAliases.nickname: result[AccountAliases.nickname],
-                AccountAliases.created_at: result[AccountAliases.created_at],
-                AccountAliases.status: status,
-                AccountAliases.location: LocationShortInfoModel(
-                    **{
-                        RoomAliases.ID: result[RoomAliases.ID],
-                        RoomAliases.title: result[RoomAliases.title]
-                    }
-                ).model_dump(by_alias=True),
-            }
-        )
-        await OneUserInfo()(self.socket, model=GetOneUserOut(**mess_out.model_dump(by_alias=True)))
+        online: Optional[User] = Cash.find(self.model.ID)
+        profile: Optional[dict] = profiles.get(self.model.ID)
+        if profile is None or not self.__fresh(profile, online):
+            # карточка попадет в общий кэш: сразу после изменения реплика могла его еще не получить
+            async with unit_of_work(read_only=not profile_changed(self.model.ID)) as storage:
+                result: Optional[dict] = await self.__get_info(storage, self.model.ID)
+            if not result and replicas:
+                # промах реплики перепроверяем на основной базе: запись могла еще не дойти
+                async with unit_of_work() as storage:
+                    result = await self.__get_info(storage, self.model.ID)
+            if not result:
+                raise NotFoundError("пользователь не найден")
+            profile = GetOneUserOut(
+                **{
+                    AccountAliases.ID: result[AccountAliases.ID],
+                    AccountAliases.nickname: result[AccountAliases.nickname],
+                    AccountAliases.created_at: result[AccountAliases.created_at],
+                    AccountAliases.status: AccountStatuses.OFFLINE,
+                    AccountAliases.location: LocationShortInfoModel(
+                        **{
+                            RoomAliases.ID: result[RoomAliases.ID],
+                            RoomAliases.title: result[RoomAliases.title]
+                        }
+                    ),
+                }
+            ).model_dump(by_alias=True)
+            profiles.put(self.model.ID, profile)
+        # список онлайн общий для всех воркеров, Cash - только для своего
+        status = AccountStatuses.ONLINE if self.model.ID in PresenceIndex.users else AccountStatuses.OFFLINE
+        await OneUserInfo()(self.socket, model={**profile, AccountAliases.status: status})
 
 
 class GetOnlineUserList(BaseEvent):
@@ -169,24 +210,45 @@ class GetOnlineUserList(BaseEvent):
     def __init__(self, socket: WebSocketServerProtocol, model: GetOnlineUserListModel, token: Optional[str]):
         super().__init__(socket, model, token)
 
+    async def __get_room_id(self, db: AsyncConnection, title: str) -> Optional[int]:
+        cursor: CursorResult = await db.execute(
+            select(rooms.c[RoomAliases.ID]).where(rooms.c[RoomAliases.title] == title)
+        )
+        return cursor.scalar()
+
     async def __call__(self):
+        room_id = self.model.location_id
+        if self.model.location_name is not None:
+            async with unit_of_work() as db:
+                room_id_by_name = await self.__get_room_id(db, self.model.location_name)
+            if room_id_by_name is None or (room_id is not None and room_id != room_id_by_name):
+                await OnlineUserListInfo()(self.socket, model=[])
+                return
+            room_id = room_id_by_name
         result = [{
-            AccountAliases.ID: u.ID,
-            AccountAliases.nickname: u.nickname,
-            AccountAliases.location: u.location_id
-        } for u in Cash.online.values()]
+            AccountAliases.ID: user_id,
+            AccountAliases.nickname: nickname,
+            AccountAliases.location: location_id
+        } for user_id, nickname, location_id in PresenceIndex.page(
+            room_id=room_id,
+            prefix=self.model.nickname,
+            skip=self.model.skip,
+            limit=self.model.limit
+        )]
         await OnlineUserListInfo()(self.socket, model=result)
 
 
 class ChangeNick(BaseEvent):
+    ordered = True
+
     @protected
     def __init__(self, socket: WebSocketServerProtocol, model: ChangeNickModel, token: Optional[str]):
         super().__init__(socket,model, token)
 
     async def __call__(self):
-        user: User = Cash.online[self.socket.id]
+        user: User = Cash.user(self.socket)
 
-        async with engine.connect() as connection:
+        async with unit_of_work() as connection:
             try:
                 cursor: CursorResult = await connection.execute(
                     update(accounts)
@@ -194,14 +256,14 @@ class ChangeNick(BaseEvent):
                     .where(accounts.c[AccountAliases.ID] == user.ID)
                 )
                 if cursor.rowcount != 1:
-                    await connection.rollback()
                     raise UpdateError("ник не изменен")
             except IntegrityError as e:
                 if isinstance(e.orig.__cause__, UniqueViolationError):
                     raise DuplicateError("такой ник уже существует")
                 raise InternalError("внутренняя ошибка")
-            await connection.commit()
-        user.nickname = self.model.nickname
+        for session in Cash.users(user.ID):
+            session.nickname = self.model.nickname
+        forget_profile(user.ID)
 
         await Successfully()(self.socket, model="ник изменен")
 
@@ -213,21 +275,21 @@ class ChangePassword(BaseEvent):
         super().__init__(socket,model, token)
 
     async def __call__(self):
-        user: User = Cash.online[self.socket.id]
-        new_password = PasswordManager.get_hash(self.model.password)
-        async with engine.connect() as connection:
+        user: User = Cash.user(self.socket)
+        new_password = await PasswordService.get_hash(self.model.password)
+        async with unit_of_work() as connection:
             cursor: CursorResult = await connection.execute(
                 update(accounts)
                 .values({AccountAliases.password: new_password})
                 .where(accounts.c[AccountAliases.ID] == user.ID)
             )
             if cursor.rowcount != 1:
-                await connection.rollback()
                 raise UpdateError("пароль не изменен")
         await Successfully()(self.socket, model="ник изменен")
 
 
 class Relocation(BaseEvent):
+    ordered = True
 
     @protected
     def __init__(self, socket: WebSocketServerProtocol, model: RelocationModel, token: Optional[str]):
@@ -239,40 +301,26 @@ class Relocation(BaseEvent):
                 update(locations).values({RoomAliases.ID: room_id}).where(
                     locations.c[AccountAliases.ID] == user_id)
             )
-            await db.commit()
         except IntegrityError as e:
             if isinstance(e.orig.__cause__, ForeignKeyViolationError):
                 raise InvalidDataError(f"комнаты с ID {room_id} не существует")
             raise InternalError("внутренняя ошибка")
 
-    async def __get_target_room_rank_and_title(self, db: AsyncConnection, user_id: int, room_id: int):
-        lr = select(
-            local_ranks.c[LocalRankAliases.rank]
-        ).where(
-            local_ranks.c[AccountAliases.ID] == user_id
-        ).where(
-            local_ranks.c[RoomAliases.ID] == room_id
-        ).scalar_subquery().label(LocalRankAliases.rank)
-        cursor: CursorResult = await db.execute(
-            select(
-                rooms.c[RoomAliases.title],
-                lr
-            )
-            .where(rooms.c[RoomAliases.ID] == room_id)
-        )
-        return cursor.mappings().fetchone()
-
     async def __call__(self):
-        user: User = Cash.online[self.socket.id]
-        async with engine.connect() as db:
+        user: User = Cash.user(self.socket)
+        # название и ранг берутся из кэшей: при переходе между комнатами в БД только UPDATE
+        title = await room_title(self.model.room_id)
+        if title is None:
+            raise InvalidDataError(f"комнаты с ID {self.model.room_id} не существует")
+        rank = await local_rank(user.ID, self.model.room_id)
+        async with unit_of_work() as db:
             await self.__relocate(db, user.ID, self.model.room_id)
-            result: Optional[RowMapping] = await self.__get_target_room_rank_and_title(db, user.ID,
-                                                                                       self.model.room_id)
 
-        await SystemMessage()(
-            *{Cash.online[sid].socket for sid in Cash.location[user.location_id] if self.socket != Cash.online[sid].socket},
+        await SystemMessage().room(
+            user.location_id,
+            exclude=self.socket,
             model=PublicMessageOut(
-                text=f"[{user.nickname} перешел в комнату {result[RoomAliases.title]}]",
+                text=f"[{user.nickname} перешел в комнату {title}]",
                 creator=Author(
                     user_id=user.ID,
                     nickname=user.nickname,
@@ -281,12 +329,12 @@ class Relocation(BaseEvent):
             )
         )
 
+        user.local_rank = rank
         user.location_id = self.model.room_id
-        user.local_rank = result[LocalRankAliases.rank] if result[
-                                                               LocalRankAliases.rank] is not None else LocalRanks.USER
+        forget_profile(user.ID)
 
-        await SystemMessage()(
-            *{Cash.online[sid].socket for sid in Cash.location[self.model.room_id]},
+        await SystemMessage().room(
+            self.model.room_id,
             model=PublicMessageOut(
                 text=f"[{user.nickname} вошел в комнату]",
                 creator=Author(
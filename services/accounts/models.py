@@ -5,7 +5,7 @@ from typing import Optional
 from pydantic import BaseModel, Field
 
 from services.accounts.aliases import AccountAliases, AccountStatuses
-from services.models import Paginator
+from services.models import Paginator, PaginatorAliases
 from services.rooms.aliases import RoomAliases
 from services.rooms.models import LocationShortInfoModel
 
@@ -44,8 +44,11 @@ class Error:
 
 
 class GetOnlineUserListModel(Paginator):
+    skip: int = Field(0, alias=PaginatorAliases.SKIP, ge=0)
+    limit: int = Field(50, alias=PaginatorAliases.LIMIT, ge=1, le=200)
     location_id: Optional[int] = Field(None, alias=RoomAliases.ID)
     location_name: Optional[str] = Field(None, alias=RoomAliases.title, max_length=24)
+    nickname: Optional[str] = Field(None, alias=AccountAliases.nickname, max_length=16)
 
 
 class GetUserListOut(BaseModel):
@@ -59,6 +62,10 @@ class ChangeNickModel(BaseModel):
     nickname: str = Field(alias=AccountAliases.nickname)
 
 
+class ResumeModel(BaseModel):
+    token: str = Field(max_length=512)  # jwt длиннее opaque-токена
+
+
 class ChangePasswordModel(BaseModel):
     password: str = Field(alias=AccountAliases.password)
 
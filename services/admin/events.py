@@ -0,0 +1,26 @@
+from typing import Optional
+
+from websockets import WebSocketServerProtocol
+
+from core.base_event import BaseEvent
+from core.config import ADMIN_IDS
+from core.exporter import collect
+from core.security import protected
+from core.user_cash import Cash, User
+from events.exc import AccessDenied
+from events.outputs import MetricsInfo
+from services.admin.models import MetricsModel
+
+
+class GetMetrics(BaseEvent):
+    __doc__ = """ Метрики сервера, только для администраторов """
+
+    @protected
+    def __init__(self, socket: WebSocketServerProtocol, model: MetricsModel, token: Optional[str]):
+        super().__init__(socket, model, token)
+
+    async def __call__(self):
+        user: User = Cash.user(self.socket)
+        if user.ID not in ADMIN_IDS:
+            raise AccessDenied("команда доступна только администраторам")
+        await MetricsInfo()(self.socket, model=collect())
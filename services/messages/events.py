@@ -1,42 +1,50 @@
 import datetime
 from typing import Optional
 
-from sqlalchemy import CursorResult, insert
+from sqlalchemy import CursorResult, insert, select, and_, tuple_
+from sqlalchemy.ext.asyncio import AsyncConnection
 from websockets import WebSocketServerProtocol
 
 from core.base_event import BaseEvent
-from core.database import engine
-from events.exc import AccessDenied
-from core.io import output
-from core.schemas import public
+from core.batching import RoomBatcher
+from core.config import PUBLIC_WRITE_BEHIND
+from core.database import unit_of_work
+from events.exc import AccessDenied, NotFoundError
+from events.outputs import RoomHistory
+from core.schemas import public, accounts, local_ranks
 from core.security import protected
 from core.user_cash import Cash, User
+from core.writer import PublicWriter
 from services.accounts.aliases import AccountAliases
 from services.messages.aliases import PublicAliases
-from services.messages.models import NewPublicModel, PublicMessageOut, Author
-from services.rooms.aliases import LocalRankAliases, LocalRanks
+from services.messages.models import NewPublicModel, PublicMessageOut, Author, RoomHistoryModel, \
+    PublicMessageHistoryOut
+from services.rooms.aliases import LocalRankAliases, LocalRanks, RoomAliases
 
 
 class SendPublic(BaseEvent):
+    ordered = True
 
     @protected
     def __init__(self, socket: WebSocketServerProtocol, model: NewPublicModel, token: Optional[str]):
         super().__init__(socket, model, token)
 
     async def __call__(self):
-        user: User = Cash.online[self.socket.id]
+        user: User = Cash.user(self.socket)
 
         if user.local_rank is LocalRanks.BANNED:
             raise AccessDenied("вы в бане. парьтесь :)")
+        created_at = datetime.datetime.utcnow()
         data = {
             PublicAliases.creator: user.ID,
             PublicAliases.room: user.location_id,
-            PublicAliases.text: self.model.text
+            PublicAliases.text: self.model.text,
+            PublicAliases.created_at: created_at
         }
         message_out = PublicMessageOut(
             **{
                 PublicAliases.text: self.model.text,
-                PublicAliases.created_at: datetime.datetime.utcnow(),
+                PublicAliases.created_at: created_at,
                 PublicAliases.creator: Author(
                     **{
                         AccountAliases.ID: user.ID,
@@ -46,10 +54,82 @@ class SendPublic(BaseEvent):
                 )
             }
         )
-        for socket_id in Cash.location[user.location_id]:
-            await Cash.online[socket_id].socket.send(output("новое сообщение", message_out.model_dump(by_alias=True)))
-        async with engine.connect() as db:
+        RoomBatcher.publish(user.location_id, message_out.model_dump(by_alias=True))
+        if PUBLIC_WRITE_BEHIND:
+            await PublicWriter.put(data)
+            return
+        async with unit_of_work() as db:
             cursor: CursorResult = await db.execute(
                 insert(public).values(data)
             )
-            await db.commit()
+
+
+class GetRoomHistory(BaseEvent):
+    __doc__ = """ История сообщений текущей комнаты, постранично от новых к старым """
+
+    @protected
+    def __init__(self, socket: WebSocketServerProtocol, model: RoomHistoryModel, token: Optional[str]):
+        super().__init__(socket, model, token)
+
+    async def __get_anchor(self, db: AsyncConnection, room_id: int, message_id: int):
+        cursor: CursorResult = await db.execute(
+            select(public.c[PublicAliases.created_at])
+            .where(public.c[PublicAliases.ID] == message_id)
+            .where(public.c[PublicAliases.room] == room_id)
+        )
+        return cursor.scalar()
+
+    async def __get_page(self, db: AsyncConnection, room_id: int, before: Optional[int], limit: int):
+        query = (
+            select(
+                public.c[PublicAliases.ID],
+                public.c[PublicAliases.text],
+                public.c[PublicAliases.created_at],
+                accounts.c[AccountAliases.ID],
+                accounts.c[AccountAliases.nickname],
+                local_ranks.c[LocalRankAliases.rank],
+            )
+            .join(accounts, accounts.c[AccountAliases.ID] == public.c[PublicAliases.creator])
+            .join(local_ranks, and_(
+                local_ranks.c[AccountAliases.ID] == public.c[PublicAliases.creator],
+                local_ranks.c[RoomAliases.ID] == public.c[PublicAliases.room]
+            ), isouter=True)
+            .where(public.c[PublicAliases.room] == room_id)
+        )
+        if before is not None:
+            anchor = await self.__get_anchor(db, room_id, before)
+            if anchor is None:
+                raise NotFoundError("сообщение не найдено")
+            # keyset: диапазон по индексу (room_id, created_at, message_id) вместо OFFSET
+            query = query.where(
+                tuple_(public.c[PublicAliases.created_at], public.c[PublicAliases.ID]) < tuple_(anchor, before)
+            )
+        cursor: CursorResult = await db.execute(
+            query
+            .order_by(public.c[PublicAliases.created_at].desc(), public.c[PublicAliases.ID].desc())
+            .limit(limit)
+        )
+        return cursor.mappings().fetchall()
+
+    async def __call__(self):
+        user: User = Cash.user(self.socket)
+        async with unit_of_work() as db:
+            rows = await self.__get_page(db, user.location_id, self.model.before, self.model.limit)
+        result = [
+            PublicMessageHistoryOut(
+                **{
+                    PublicAliases.ID: row[PublicAliases.ID],
+                    PublicAliases.text: row[PublicAliases.text],
+                    PublicAliases.created_at: row[PublicAliases.created_at],
+                    PublicAliases.creator: Author(
+                        **{
+                            AccountAliases.ID: row[AccountAliases.ID],
+                            AccountAliases.nickname: row[AccountAliases.nickname],
+                            LocalRankAliases.rank: row[LocalRankAliases.rank] or LocalRanks.USER
+                        }
+                    )
+                }
+            ).model_dump(by_alias=True)
+            for row in rows
+        ]
+        await RoomHistory()(self.socket, model=result)
@@ -5,11 +5,12 @@ from pydantic import BaseModel, Field
 
 from services.accounts.aliases import AccountAliases
 from services.messages.aliases import PublicAliases
+from services.models import PaginatorAliases
 from services.rooms.aliases import LocalRanks, LocalRankAliases
 
 
 class NewPublicModel(BaseModel):
-    text: str = Field(alias=PublicAliases.text, max_length=256)
+    text: str = Field(alias=PublicAliases.text, max_length=128)
 
 
 class Author(BaseModel):
@@ -19,10 +20,16 @@ class Author(BaseModel):
 
 
 class PublicMessageOut(BaseModel):
-    text: str = Field(serialization_alias=PublicAliases.text, max_length=256)
+    text: str = Field(serialization_alias=PublicAliases.text, max_length=128)
     creator: Author = Field(serialization_alias=PublicAliases.creator)
     created_at: datetime.datetime = Field(serialization_alias=PublicAliases.created_at,
                                           default_factory=datetime.datetime.now)
 
 
+class PublicMessageHistoryOut(PublicMessageOut):
+    message_id: int = Field(serialization_alias=PublicAliases.ID)
 
+
+class RoomHistoryModel(BaseModel):
+    before: Optional[int] = Field(None, alias=PublicAliases.ID)
+    limit: int = Field(50, alias=PaginatorAliases.LIMIT, gt=0, le=100)
@@ -8,6 +8,8 @@ class RoomAliases:
     title = "title"
     owner_id = "owner_id"
     created_at = "created_at"
+    version = "version"
+    epoch = "epoch"
 
 
 class LocalRanks(str, Enum):
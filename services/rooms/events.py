@@ -1,25 +1,44 @@
 from typing import Optional
 
-from sqlalchemy import CursorResult, insert, update, delete, select
+from sqlalchemy import CursorResult, insert, update, delete
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncConnection
 from websockets import WebSocketServerProtocol
 
 from core.base_event import BaseEvent
-from core.database import engine
+from core.broadcast import send
+from core.bus import Bus
+from core.cache import room_titles, ranks, local_rank, forget_profile
+from core.database import unit_of_work
 from events.exc import DuplicateError, AccessDenied
-from core.io import output
+from core.io import output, request_id_for
 from events.outputs import Successfully, OnlineRoomList
 from core.schemas import rooms, locations, local_ranks
 from core.security import protected
-from core.user_cash import User, Cash
+from core.presence import PresenceFeed
+from core.user_cash import User, Cash, room_members
 from services.accounts.aliases import AccountAliases
 from services.models import Paginator
 from services.rooms.aliases import RoomAliases, LocalRankAliases, LocalRanks
-from services.rooms.models import CreateRoomModel, AddLocalPermissionModel, local_rank_level
+from services.rooms.models import CreateRoomModel, AddLocalPermissionModel, local_rank_level, \
+    PresenceSubscribeModel, PresenceResyncModel
+
+
+def apply_rank(user_id: int, room_id: int, rank: LocalRanks):
+    ranks.put((user_id, room_id), rank)
+    # ранг локальный: меняем его в кэше только у тех сессий цели, что сейчас в этой же комнате
+    target_users = [user for user in Cash.users(user_id) if user.location_id == room_id]
+    for user in target_users:
+        user.local_rank = rank
+    if target_users:
+        PresenceFeed.publish(room_id, PresenceFeed.RANK, target_users[-1].member())
+
+
+Bus.subscribe("rank", lambda message: apply_rank(message["user"], message["room"], LocalRanks(message["rank"])))
 
 
 class CreateRoom(BaseEvent):
+    ordered = True
 
     @protected
     def __init__(self, socket: WebSocketServerProtocol, model: CreateRoomModel, token: Optional[str]):
@@ -48,17 +67,22 @@ class CreateRoom(BaseEvent):
         )
 
     async def __call__(self):
-        user: User = Cash.online[self.socket.id]
+        user: User = Cash.user(self.socket)
         data: dict = self.model.model_dump(by_alias=True)
-        async with engine.connect() as db:
+        async with unit_of_work() as db:
             try:
                 room_id = await self.__create(db, data)
             except IntegrityError as e:
                 raise DuplicateError("такая комната уже есть")
             await self.__update_location(db, room_id, user.ID)
             await self.__add_local_rank(db, room_id, user.ID)
-            await db.commit()
-        await self.socket.send(output("комната создана"))
+        room_titles.put(room_id, self.model.title)
+        ranks.put((user.ID, room_id), LocalRanks.OWNER)
+        forget_profile(user.ID)
+        # создатель уже перенесен в новую комнату в БД - переносим и в кэше, ранг до комнаты
+        user.local_rank = LocalRanks.OWNER
+        user.location_id = room_id
+        send(self.socket, output("комната создана", request_id=request_id_for(self.socket)))
 
 
 class GetOnlineRoomList(BaseEvent):
@@ -67,14 +91,8 @@ class GetOnlineRoomList(BaseEvent):
         super().__init__(socket, model, token)
 
     async def __call__(self):
-        location_id = Cash.online[self.socket.id].location_id
-        sockets_in_room = Cash.location[location_id]
-        users_in_room = [{
-            AccountAliases.ID: Cash.online[s].ID,
-            AccountAliases.nickname: Cash.online[s].nickname,
-            LocalRankAliases.rank: Cash.online[s].local_rank
-        } for s in sockets_in_room]
-        await OnlineRoomList()(self.socket, model=users_in_room)
+        location_id = Cash.user(self.socket).location_id
+        await OnlineRoomList()(self.socket, model=room_members(location_id))
 
 
 class UpdatePermission(BaseEvent):
@@ -82,14 +100,6 @@ class UpdatePermission(BaseEvent):
     def __init__(self, socket: WebSocketServerProtocol, model: AddLocalPermissionModel, token: Optional[str]):
         super().__init__(socket, model, token)
 
-    async def __get_local_rank_target_user(self, connection: AsyncConnection, user_id: int, room_id: int):
-        cursor: CursorResult = await connection.execute(
-            select(local_ranks.c[LocalRankAliases.rank])
-            .where(local_ranks.c[AccountAliases.ID] == user_id)
-            .where(local_ranks.c[RoomAliases.ID] == room_id)
-        )
-        return cursor.scalar()
-
     async def __clear_data_stmt(self, connection: AsyncConnection, target_user_id: int, location_id: int):
         await connection.execute(
             delete(local_ranks)
@@ -112,35 +122,71 @@ class UpdatePermission(BaseEvent):
         )
 
     async def __call__(self):
-        requester_user: User = Cash.online[self.socket.id]
-        async with engine.connect() as connection:
-            target_user_local_rank = await self.__get_local_rank_target_user(
-                connection=connection,
-                user_id=self.model.target_user_id,
-                room_id=Cash.online[self.socket.id].location_id
-            )
-        if target_user_local_rank is None:
-            target_user_local_rank = LocalRanks.USER
+        requester_user: User = Cash.user(self.socket)
+        async with unit_of_work() as connection:
+            target_user_local_rank = await local_rank(self.model.target_user_id, requester_user.location_id)
 
-        if local_rank_level[requester_user.local_rank] > local_rank_level[LocalRanks.USER]:
-            if local_rank_level[requester_user.local_rank] > local_rank_level[self.model.rank]:
-                if local_rank_level[requester_user.local_rank] > local_rank_level[target_user_local_rank]:
-                    async with engine.connect() as connection:
+            if local_rank_level[requester_user.local_rank] > local_rank_level[LocalRanks.USER]:
+                if local_rank_level[requester_user.local_rank] > local_rank_level[self.model.rank]:
+                    if local_rank_level[requester_user.local_rank] > local_rank_level[target_user_local_rank]:
                         await self.__clear_data_stmt(connection, self.model.target_user_id, requester_user.location_id)
                         if self.model.rank is not LocalRanks.USER:
                             await self.__update_data_stmt(connection,
                                                           self.model.target_user_id,
                                                           requester_user.location_id,
                                                           self.model.rank)
-
-                        await connection.commit()
-                        if self.model.target_user_id in Cash.ids:
-                            socket_id = Cash.ids[self.model.target_user_id]
-                            Cash.online[socket_id].local_rank = self.model.rank
-                        await Successfully()(self.socket, model="ранг изменен")
+                    else:
+                        raise AccessDenied("ваш ранг должен быть выше чем у целевого пользователя")
                 else:
-                    raise AccessDenied("ваш ранг должен быть выше чем у целевого пользователя")
+                    raise AccessDenied("ваш ранг должен быть выше устанавливаемого")
             else:
-                raise AccessDenied("ваш ранг должен быть выше устанавливаемого")
-        else:
-            raise AccessDenied("ваш ранг должен быть выше чем USER")
+                raise AccessDenied("ваш ранг должен быть выше чем USER")
+        # пишем в кэш только после фиксации транзакции; цель может быть подключена к другому воркеру
+        apply_rank(self.model.target_user_id, requester_user.location_id, self.model.rank)
+        Bus.publish("rank", user=self.model.target_user_id, room=requester_user.location_id, rank=self.model.rank)
+        await Successfully()(self.socket, model="ранг изменен")
+
+
+class SubscribePresence(BaseEvent):
+    __doc__ = """ Подписка на изменения состава текущей комнаты: снимок с версией, затем дельты """
+
+    @protected
+    def __init__(self, socket: WebSocketServerProtocol, model: PresenceSubscribeModel, token: Optional[str]):
+        super().__init__(socket, model, token)
+
+    async def __call__(self):
+        user: User = Cash.user(self.socket)
+        if user.location_id is None:
+            raise AccessDenied("вы не находитесь в комнате")
+        user.subscribed = True
+        PresenceFeed.subscribe(user.location_id, user.handle, user.outbox, room_members(user.location_id),
+                               request_id_for(self.socket))
+
+
+class UnsubscribePresence(BaseEvent):
+
+    @protected
+    def __init__(self, socket: WebSocketServerProtocol, model: PresenceSubscribeModel, token: Optional[str]):
+        super().__init__(socket, model, token)
+
+    async def __call__(self):
+        user: User = Cash.user(self.socket)
+        if user.subscribed:
+            user.subscribed = False
+            PresenceFeed.unsubscribe(user.location_id, user.handle)
+        await Successfully()(self.socket, model="подписка отменена")
+
+
+class ResyncPresence(BaseEvent):
+    __doc__ = """ Догнать состав комнаты с известной версии: дельты из журнала или новый снимок """
+
+    @protected
+    def __init__(self, socket: WebSocketServerProtocol, model: PresenceResyncModel, token: Optional[str]):
+        super().__init__(socket, model, token)
+
+    async def __call__(self):
+        user: User = Cash.user(self.socket)
+        if user.location_id is None:
+            raise AccessDenied("вы не находитесь в комнате")
+        PresenceFeed.resync(user.location_id, user.outbox, self.model.epoch, self.model.version,
+                            room_members(user.location_id), request_id_for(self.socket))
@@ -24,6 +24,16 @@ class RemoveLocalPermissionModel(BaseModel):
     target_user_id: int = Field(alias=AccountAliases.ID)
 
 
+class PresenceSubscribeModel(BaseModel):
+    ...
+
+
+class PresenceResyncModel(BaseModel):
+    version: int = Field(alias=RoomAliases.version, ge=0)
+    # эпоха ленты из снимка: версии сравнимы только внутри одной эпохи
+    epoch: Optional[str] = Field(None, alias=RoomAliases.epoch, max_length=32)
+
+
 local_rank_level = {
     LocalRanks.BANNED: 0,
     LocalRanks.USER: 1,